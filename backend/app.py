@@ -1,14 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-from transformers import AutoProcessor, AutoModelForCausalLM
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 import os
+import io
 import base64
 from dotenv import load_dotenv
-from openai import OpenAI
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter as MetricCounter, Gauge, Histogram, generate_latest, multiprocess
 import tempfile
 import re
+import socket
+import sys
+import uuid
+import hashlib
+import random
+import math
+import heapq
 import json
+import sqlite3
+from contextlib import ExitStack
+from multiprocessing import resource_tracker, shared_memory
+import asyncio
+import contextvars
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timezone
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 
 # Load environment variables
 load_dotenv()
@@ -19,9 +37,180 @@ CORS(app)  # Enable CORS for React frontend
 # Global variables for model (load once)
 image_model = None
 image_processor = None
+onnx_captioner = None
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Captioning engine: "pytorch" (default) or "onnx" for int8-quantized ONNX Runtime inference
+CAPTION_MODEL_ID = "microsoft/git-base"
+CAPTION_ENGINE = os.getenv('CAPTION_ENGINE', 'pytorch').lower()
+CAPTION_ONNX_DIR = os.getenv('CAPTION_ONNX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onnx', 'git-base'))
+CAPTION_ONNX_THREADS = int(os.getenv('CAPTION_ONNX_THREADS', '0'))
+CAPTION_MAX_LENGTH = 50
+
+# Out-of-process captioning: web workers send images to one model-owning process
+CAPTION_SERVER_SOCKET = os.getenv('CAPTION_SERVER_SOCKET', '')
+CAPTION_SERVER_TIMEOUT_SECONDS = float(os.getenv('CAPTION_SERVER_TIMEOUT_SECONDS', '30'))
+
+# OpenAI clients, created on first use because importing openai is slow
+client = None
+async_client = None
+_client_lock = threading.Lock()
+
+# OpenAI transport: timeouts, retries and the pooled keep-alive connections
+OPENAI_TIMEOUT_SECONDS = float(os.getenv('OPENAI_TIMEOUT_SECONDS', '60'))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv('OPENAI_CONNECT_TIMEOUT_SECONDS', '5'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '1'))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '64'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '32'))
+OPENAI_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY_SECONDS', '60'))
+
+# Upstream resilience: slow calls are hedged with a duplicate, failing upstreams are short-circuited
+OPENAI_HEDGE_PERCENTILE = float(os.getenv('OPENAI_HEDGE_PERCENTILE', '95'))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv('OPENAI_HEDGE_MIN_SAMPLES', '20'))
+OPENAI_HEDGE_WORKERS = int(os.getenv('OPENAI_HEDGE_WORKERS', '32'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+# OpenAI rate limits; calls queue for quota (interactive before batch) instead of failing. 0 disables a limit.
+# Defaults are OpenAI's usage tier 2 limits for gpt-4 and tts-1; set them to your account's limits page
+OPENAI_CHAT_RPM = int(os.getenv('OPENAI_CHAT_RPM', '5000'))
+OPENAI_CHAT_TPM = int(os.getenv('OPENAI_CHAT_TPM', '40000'))
+OPENAI_TTS_RPM = int(os.getenv('OPENAI_TTS_RPM', '50'))
+# Buckets live in each process, so the account's limits are shared out between the web workers
+QUOTA_PROCESSES = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+OPENAI_RATE_LIMIT_RETRIES = int(os.getenv('OPENAI_RATE_LIMIT_RETRIES', '2'))
+# Share of the remaining request deadline the story call may use, leaving the rest for vocabulary and narration
+STORY_BUDGET_SHARE = float(os.getenv('STORY_BUDGET_SHARE', '0.6'))
+
+# Captioning model warm-up progress, reported by /ready
+model_state = {
+    "status": "not_started",
+    "stage": None,
+    "startedAt": None,
+    "readyAt": None,
+    "error": None
+}
+MODEL_RETRY_AFTER_SECONDS = 10
+
+# Caption batching: concurrent /process-image requests share one generate call
+CAPTION_BATCHING_ENABLED = os.getenv('CAPTION_BATCHING_ENABLED', 'true').lower() == 'true'
+CAPTION_BATCH_MAX_SIZE = int(os.getenv('CAPTION_BATCH_MAX_SIZE', '8'))
+CAPTION_BATCH_MAX_WAIT_MS = float(os.getenv('CAPTION_BATCH_MAX_WAIT_MS', '10'))
+
+# Caption cache: repeated uploads of the same sketch skip the model entirely
+CAPTION_CACHE_ENABLED = os.getenv('CAPTION_CACHE_ENABLED', 'true').lower() == 'true'
+CAPTION_CACHE_MAX_ENTRIES = int(os.getenv('CAPTION_CACHE_MAX_ENTRIES', '1024'))
+CAPTION_CACHE_DB = os.getenv('CAPTION_CACHE_DB', '')
+CAPTION_CACHE_MAX_DISK_ENTRIES = int(os.getenv('CAPTION_CACHE_MAX_DISK_ENTRIES', '100000'))
+
+# Upload decoding: decode close to the model's 224px input instead of full resolution
+# Uploads are decoded with their shortest side near this size (within a pixel budget), but never
+# below the captioning model's 224-pixel input, which the processor would otherwise upsample
+CAPTION_DECODE_SHORT_SIDE = int(os.getenv('CAPTION_DECODE_SHORT_SIDE', '448'))
+CAPTION_DECODE_MAX_PIXELS = int(os.getenv('CAPTION_DECODE_MAX_PIXELS', str(448 * 448 * 4)))
+CAPTION_MODEL_INPUT_SIDE = 224
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', '40000000'))
+
+# Uploads: size cap per file, header sniffing while the body arrives, and spooling to disk past a memory limit
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(16 * 1024 * 1024)))
+UPLOAD_SPOOL_MEMORY_BYTES = int(os.getenv('UPLOAD_SPOOL_MEMORY_BYTES', str(512 * 1024)))
+UPLOAD_SNIFF_BYTES = int(os.getenv('UPLOAD_SNIFF_BYTES', str(256 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES
+
+# Story cache: identical story requests share one GPT-4 completion
+STORY_CACHE_ENABLED = os.getenv('STORY_CACHE_ENABLED', 'true').lower() == 'true'
+STORY_CACHE_TTL_SECONDS = float(os.getenv('STORY_CACHE_TTL_SECONDS', '3600'))
+STORY_CACHE_MAX_ENTRIES = int(os.getenv('STORY_CACHE_MAX_ENTRIES', '512'))
+
+# Similar-story reuse: a TF-IDF index serves a stored story for a near-identical caption with the same lesson
+SIMILAR_STORY_REUSE_ENABLED = os.getenv('SIMILAR_STORY_REUSE_ENABLED', 'false').lower() == 'true'
+SIMILAR_STORY_THRESHOLD = float(os.getenv('SIMILAR_STORY_THRESHOLD', '0.8'))
+SIMILAR_STORY_MAX_ENTRIES = int(os.getenv('SIMILAR_STORY_MAX_ENTRIES', '2000'))
+SIMILAR_STORY_REFIT_EVERY = int(os.getenv('SIMILAR_STORY_REFIT_EVERY', '100'))
+
+# Post-story stages (vocabulary, narration) run in parallel under one deadline
+STORY_REQUEST_DEADLINE_SECONDS = float(os.getenv('STORY_REQUEST_DEADLINE_SECONDS', '90'))
+PIPELINE_MAX_WORKERS = int(os.getenv('PIPELINE_MAX_WORKERS', '16'))
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="story-pipeline")
+
+# Vocabulary: picked locally from bundled word data, or by GPT-4 when requested
+VOCABULARY_MODES = ('local', 'gpt')
+VOCABULARY_MODE = os.getenv('VOCABULARY_MODE', 'local')
+VOCABULARY_DATA_DIR = os.getenv('VOCABULARY_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# With GPT-4 vocabulary, 'combined' asks for story and vocabulary in one JSON completion
+STORY_GENERATION_MODE = os.getenv('STORY_GENERATION_MODE', 'combined')
+
+# Job mode: story pipelines run on a bounded worker pool instead of request threads
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '32'))
+JOB_RESULT_TTL_SECONDS = float(os.getenv('JOB_RESULT_TTL_SECONDS', '900'))
+JOB_RETRY_AFTER_SECONDS = int(os.getenv('JOB_RETRY_AFTER_SECONDS', '5'))
+
+# Classroom batches: a class's sketches are captioned together, then stories run with bounded concurrency
+CLASSROOM_MAX_IMAGES = int(os.getenv('CLASSROOM_MAX_IMAGES', '40'))
+CLASSROOM_CONCURRENCY = int(os.getenv('CLASSROOM_CONCURRENCY', '4'))
+classroom_executor = ThreadPoolExecutor(max_workers=CLASSROOM_CONCURRENCY, thread_name_prefix="classroom")
+
+# Streaming narration
+NARRATION_STREAM_CHUNK_BYTES = int(os.getenv('NARRATION_STREAM_CHUNK_BYTES', '16384'))
+TTS_MAX_INPUT_CHARS = 4096  # per TTS call; longer narrations are split into chunks
+NARRATION_MAX_CHARS = int(os.getenv('NARRATION_MAX_CHARS', '20000'))
+TTS_MODEL = "tts-1"
+TTS_SPEED = 0.9  # Slightly slower for children
+
+# Long narrations are split at paragraph/sentence boundaries and synthesized in parallel.
+# A short story (about 400 tokens) stays under the split threshold and is a single TTS call.
+NARRATION_SPLIT_MIN_CHARS = int(os.getenv('NARRATION_SPLIT_MIN_CHARS', '2000'))
+NARRATION_CHUNK_CHARS = min(int(os.getenv('NARRATION_CHUNK_CHARS', '1200')), TTS_MAX_INPUT_CHARS)
+NARRATION_PARALLELISM = int(os.getenv('NARRATION_PARALLELISM', '4'))
+tts_executor = ThreadPoolExecutor(max_workers=NARRATION_PARALLELISM, thread_name_prefix="tts-chunk")
+
+# Narration artifacts are served by URL from a size-capped local store
+AUDIO_STORE_DIR = os.getenv('AUDIO_STORE_DIR', os.path.join(tempfile.gettempdir(), 'sketch2story-audio'))
+AUDIO_STORE_MAX_BYTES = int(os.getenv('AUDIO_STORE_MAX_BYTES', str(512 * 1024 * 1024)))
+AUDIO_CACHE_MAX_AGE_SECONDS = 365 * 24 * 3600
+
+# Optionally narrate every new story in the recommended voice in the background
+NARRATION_PRERENDER_ENABLED = os.getenv('NARRATION_PRERENDER_ENABLED', 'false').lower() == 'true'
+NARRATION_PRERENDER_VOICE = os.getenv('NARRATION_PRERENDER_VOICE', 'nova')
+NARRATION_PRERENDER_WORKERS = int(os.getenv('NARRATION_PRERENDER_WORKERS', '2'))
+NARRATION_PRERENDER_QUEUE_LIMIT = int(os.getenv('NARRATION_PRERENDER_QUEUE_LIMIT', '16'))
+
+# Request tracing: slow requests, failures and a head-sampled share get their span waterfall logged
+TRACE_ENABLED = os.getenv('TRACE_ENABLED', 'true').lower() == 'true'
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH', os.path.join(tempfile.gettempdir(), 'sketch2story-traces.jsonl'))
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '5000'))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_FLUSH_SECONDS = float(os.getenv('TRACE_FLUSH_SECONDS', '1'))
+TRACE_MAX_PENDING = int(os.getenv('TRACE_MAX_PENDING', '10000'))
+
+# Prometheus metrics
+STAGE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+STAGE_LATENCY = Histogram(
+    'sketch2story_stage_seconds', 'Latency of each pipeline stage', ['stage'], buckets=STAGE_LATENCY_BUCKETS
+)
+STAGE_IN_FLIGHT = Gauge(
+    'sketch2story_stage_in_flight', 'Pipeline stages currently running', ['stage'], multiprocess_mode='livesum'
+)
+REQUEST_LATENCY = Histogram(
+    'sketch2story_request_seconds', 'HTTP request latency until the response starts',
+    ['endpoint', 'method', 'status'], buckets=STAGE_LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'sketch2story_requests_in_flight', 'HTTP requests currently being handled', ['endpoint'],
+    multiprocess_mode='livesum'
+)
+OPENAI_TOKENS = MetricCounter(
+    'sketch2story_openai_tokens_total', 'OpenAI chat tokens used', ['operation', 'kind', 'vocabulary_level']
+)
+TTS_CHARACTERS = MetricCounter(
+    'sketch2story_tts_characters_total', 'Characters sent to OpenAI TTS', ['vocabulary_level']
+)
+UPLOAD_BYTES = Histogram(
+    'sketch2story_upload_bytes', 'Size of each uploaded file',
+    buckets=(16384, 65536, 262144, 524288, 1048576, 2097152, 4194304, 8388608, 16777216, 33554432)
+)
+UPLOAD_REJECTIONS = MetricCounter(
+    'sketch2story_upload_rejections_total', 'Uploads rejected while streaming in', ['reason']
+)
 
 # Vocabulary difficulty levels
 VOCABULARY_LEVELS = {
@@ -45,222 +234,3474 @@ VOCABULARY_LEVELS = {
     }
 }
 
+# Available TTS voices
+AVAILABLE_VOICES = [
+    {"id": "alloy", "name": "Alloy", "description": "Neutral, balanced voice"},
+    {"id": "echo", "name": "Echo", "description": "Clear, crisp voice"},
+    {"id": "fable", "name": "Fable", "description": "Warm, storytelling voice"},
+    {"id": "onyx", "name": "Onyx", "description": "Deep, rich voice"},
+    {"id": "nova", "name": "Nova", "description": "Bright, cheerful voice (great for kids)"},
+    {"id": "shimmer", "name": "Shimmer", "description": "Gentle, soothing voice"}
+]
+
+
+class OnnxGitCaptioner:
+    """Greedy GIT captioning on ONNX Runtime with int8-quantized weights.
+
+    The model is exported as two graphs: a vision graph that turns pixels
+    into projected image tokens (run once per image) and a text graph that
+    maps image tokens plus the caption so far to next-token logits (run once
+    per generated token).
+    """
+
+    VISION_FILE = "vision_int8.onnx"
+    TEXT_FILE = "text_int8.onnx"
+
+    def __init__(self, vision_session, text_session, bos_token_id, eos_token_id, pad_token_id,
+                 max_length=CAPTION_MAX_LENGTH):
+        self.vision_session = vision_session
+        self.text_session = text_session
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_length = max_length
+
+    @classmethod
+    def exists(cls, model_dir):
+        """True if model_dir already holds both exported graphs"""
+        return all(os.path.exists(os.path.join(model_dir, name)) for name in (cls.VISION_FILE, cls.TEXT_FILE))
+
+    @classmethod
+    def load(cls, model_dir, tokenizer, threads=0):
+        """Open the exported graphs in model_dir with ONNX Runtime"""
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        def session(name):
+            return onnxruntime.InferenceSession(
+                os.path.join(model_dir, name), options, providers=["CPUExecutionProvider"]
+            )
+
+        return cls(
+            session(cls.VISION_FILE),
+            session(cls.TEXT_FILE),
+            bos_token_id=tokenizer.cls_token_id,
+            eos_token_id=tokenizer.sep_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        )
+
+    @classmethod
+    def export(cls, model, model_dir):
+        """Export a GitForCausalLM to the split graphs and quantize their weights to int8"""
+        import torch
+        from types import SimpleNamespace
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        class VisionGraph(torch.nn.Module):
+            def __init__(self, git):
+                super().__init__()
+                self.git = git
+
+            def forward(self, pixel_values):
+                features = self.git.image_encoder(pixel_values).last_hidden_state
+                return self.git.visual_projection(features)
+
+        class ImageTokens(torch.nn.Module):
+            # Stands in for the vision tower so precomputed image tokens flow straight through
+            def forward(self, pixel_values, **kwargs):
+                return SimpleNamespace(last_hidden_state=pixel_values[:, 0])
+
+        class TextGraph(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, visual_features, input_ids):
+                outputs = self.model(pixel_values=visual_features.unsqueeze(1), input_ids=input_ids, use_cache=False)
+                return outputs.logits[:, -1, :]
+
+        os.makedirs(model_dir, exist_ok=True)
+        model.eval()
+        git = model.git
+        pixel_values = torch.zeros(1, 3, 224, 224)
+        input_ids = torch.tensor([[model.config.bos_token_id or 101]])
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            vision_fp32 = os.path.join(work_dir, "vision.onnx")
+            text_fp32 = os.path.join(work_dir, "text.onnx")
+
+            with torch.no_grad():
+                torch.onnx.export(
+                    VisionGraph(git), (pixel_values,), vision_fp32,
+                    input_names=["pixel_values"], output_names=["visual_features"],
+                    dynamic_axes={"pixel_values": {0: "batch"}, "visual_features": {0: "batch"}},
+                    opset_version=17, dynamo=False
+                )
+                visual_features = VisionGraph(git)(pixel_values)
+
+                image_encoder, visual_projection = git.image_encoder, git.visual_projection
+                git.image_encoder, git.visual_projection = ImageTokens(), torch.nn.Identity()
+                try:
+                    torch.onnx.export(
+                        TextGraph(model), (visual_features, input_ids), text_fp32,
+                        input_names=["visual_features", "input_ids"], output_names=["logits"],
+                        dynamic_axes={
+                            "visual_features": {0: "batch"},
+                            "input_ids": {0: "batch", 1: "sequence"},
+                            "logits": {0: "batch"}
+                        },
+                        opset_version=17, dynamo=False
+                    )
+                finally:
+                    git.image_encoder, git.visual_projection = image_encoder, visual_projection
+
+            quantize_dynamic(vision_fp32, os.path.join(model_dir, cls.VISION_FILE), weight_type=QuantType.QInt8)
+            quantize_dynamic(text_fp32, os.path.join(model_dir, cls.TEXT_FILE), weight_type=QuantType.QInt8)
+
+    def generate(self, pixel_values):
+        """Greedy-decode caption token ids for a batch of preprocessed images"""
+        import numpy as np
+
+        visual_features = self.vision_session.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+        batch = visual_features.shape[0]
+        input_ids = np.full((batch, 1), self.bos_token_id, dtype=np.int64)
+        finished = np.zeros(batch, dtype=bool)
+
+        while input_ids.shape[1] < self.max_length and not finished.all():
+            logits = self.text_session.run(None, {"visual_features": visual_features, "input_ids": input_ids})[0]
+            next_ids = np.where(finished, self.pad_token_id, logits.argmax(axis=-1))
+            input_ids = np.concatenate([input_ids, next_ids[:, None].astype(np.int64)], axis=1)
+            finished |= next_ids == self.eos_token_id
+
+        return input_ids
+
+
+def get_openai_client():
+    """Return the shared OpenAI client, creating it on first use"""
+    global client
+    if client is None:
+        with _client_lock:
+            if client is None:
+                import httpx
+                from openai import DefaultHttpxClient, OpenAI
+                client = OpenAI(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+                    # ResilientUpstream retries within the stage budget instead
+                    max_retries=0,
+                    http_client=DefaultHttpxClient(limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS
+                    ))
+                )
+    return client
+
+
+def get_async_openai_client():
+    """Return the shared AsyncOpenAI client used by the ASGI server, creating it on first use.
+
+    It keeps its own connection pool with the same limits as the threaded
+    client; the pool belongs to the event loop that first uses it.
+    """
+    global async_client
+    if async_client is None:
+        with _client_lock:
+            if async_client is None:
+                import httpx
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                async_client = AsyncOpenAI(
+                    api_key=os.getenv('OPENAI_API_KEY'),
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS),
+                    # ResilientUpstream retries within the stage budget instead
+                    max_retries=0,
+                    http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY_SECONDS
+                    ))
+                )
+    return async_client
+
+
+# Absolute time.monotonic() deadline of the request being served, if it has one
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+# Scheduling lane of the work being done: single interactive requests go before batch work
+PRIORITY_LANES = ("interactive", "batch")
+request_priority = contextvars.ContextVar('request_priority', default="interactive")
+
+
+def submit_with_context(executor, fn, *args):
+    """Submit fn to an executor so it sees this thread's context variables (such as the deadline)"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an upstream call has no time left in the request's budget"""
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling upstream while its circuit breaker is open"""
+
+
+def stage_timeout(stage):
+    """Seconds an upstream call for this stage may take under the current request deadline.
+
+    The story gets ``STORY_BUDGET_SHARE`` of what remains so vocabulary and
+    narration still have time afterwards; later stages may use all of it.
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        return OPENAI_TIMEOUT_SECONDS
+    share = STORY_BUDGET_SHARE if stage == "story" else 1.0
+    return min(OPENAI_TIMEOUT_SECONDS, (deadline - time.monotonic()) * share)
+
+
+class QuotaTimeout(DeadlineExceeded):
+    """Raised when a call cannot get rate-limit quota before its deadline"""
+
+
+def is_rate_limited(error):
+    """True for an OpenAI 429 response"""
+    from openai import RateLimitError
+    return isinstance(error, RateLimitError)
+
+
+def retry_after_seconds(error, default=1.0):
+    """The Retry-After delay of a 429 response, or ``default``"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+def estimate_chat_tokens(messages, max_tokens):
+    """Rough token cost of a chat call: prompt characters / 4 plus the completion budget"""
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4 + max_tokens
+
+
+class TokenBucket:
+    """Continuously refilling allowance of ``per_minute`` units"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until ``amount`` units are available (after refill)"""
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class QuotaScheduler:
+    """Queue upstream calls so they stay under requests- and tokens-per-minute limits.
+
+    Callers wait in ``acquire`` instead of hitting a 429. Waiters are served
+    strictly by lane (``PRIORITY_LANES`` order) and then first come, first
+    served, so interactive requests overtake queued batch work. A 429 that
+    still gets through empties the buckets for its Retry-After time.
+    Coroutines wait in the same queue with ``acquire_async``.
+    """
+
+    # How often a waiting coroutine rechecks the queue
+    ASYNC_POLL_SECONDS = 0.05
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0):
+        self.name = name
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._sequence = 0
+        self._paused_until = 0.0
+        self._granted = Counter()
+        self._timeouts = 0
+        self._rate_limited = 0
+        self._wait_ms = {lane: deque(maxlen=500) for lane in PRIORITY_LANES}
+
+    def _buckets(self):
+        return [(bucket, amount) for bucket, amount in ((self._requests, 1), (self._tokens, None)) if bucket]
+
+    def _wait_time(self, tokens, now):
+        wait_for = max(0.0, self._paused_until - now)
+        for bucket, amount in self._buckets():
+            bucket.refill(now)
+            wait_for = max(wait_for, bucket.wait_time(tokens if amount is None else amount))
+        return wait_for
+
+    def _take(self, tokens, lane, waited):
+        for bucket, amount in self._buckets():
+            bucket.take(tokens if amount is None else amount)
+        self._granted[lane] += 1
+        self._wait_ms[lane].append(waited * 1000)
+
+    def _enqueue(self, lane):
+        rank = PRIORITY_LANES.index(lane) if lane in PRIORITY_LANES else len(PRIORITY_LANES)
+        self._sequence += 1
+        ticket = (rank, self._sequence)
+        heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _dequeue(self, ticket):
+        if ticket in self._waiters:
+            self._waiters.remove(ticket)
+            heapq.heapify(self._waiters)
+            self._cond.notify_all()
+
+    def _poll(self, ticket, tokens, lane, started, timeout):
+        """Grant quota if ticket is first in line and the buckets allow.
+
+        Returns ``(True, seconds waited)`` or ``(False, seconds to wait before
+        polling again, or None for "until notified")``.
+        """
+        now = time.monotonic()
+        wait_for = self._wait_time(tokens, now) if self._waiters[0] == ticket else None
+        if wait_for == 0.0:
+            heapq.heappop(self._waiters)
+            self._take(tokens, lane, now - started)
+            self._cond.notify_all()
+            return True, now - started
+        remaining = None if timeout is None else timeout - (now - started)
+        if remaining is not None and remaining <= 0:
+            self._timeouts += 1
+            raise QuotaTimeout(f"No {self.name} quota within {timeout:.1f}s")
+        waits = [t for t in (wait_for, remaining) if t is not None]
+        return False, min(waits) if waits else None
+
+    def acquire(self, tokens=0, timeout=None, lane=None):
+        """Block until quota for one call of ``tokens`` tokens is free; raise QuotaTimeout after ``timeout``"""
+        lane = lane or request_priority.get()
+        started = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(lane)
+            try:
+                while True:
+                    granted, seconds = self._poll(ticket, tokens, lane, started, timeout)
+                    if granted:
+                        return seconds
+                    self._cond.wait(seconds)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+    async def acquire_async(self, tokens=0, timeout=None, lane=None):
+        """Coroutine form of ``acquire``: waits in the same queue without holding a thread"""
+        lane = lane or request_priority.get()
+        started = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(lane)
+        try:
+            while True:
+                with self._cond:
+                    granted, seconds = self._poll(ticket, tokens, lane, started, timeout)
+                if granted:
+                    return seconds
+                await asyncio.sleep(min(seconds, self.ASYNC_POLL_SECONDS) if seconds else self.ASYNC_POLL_SECONDS)
+        except BaseException:
+            with self._cond:
+                self._dequeue(ticket)
+            raise
+
+    def try_acquire(self, tokens=0):
+        """Take quota only if it is free right now and nobody is queued (used for hedged duplicates)"""
+        with self._cond:
+            if self._waiters or self._wait_time(tokens, time.monotonic()) > 0:
+                return False
+            for bucket, amount in self._buckets():
+                bucket.take(tokens if amount is None else amount)
+            return True
+
+    def back_off(self, seconds):
+        """Hold every caller for ``seconds`` after upstream answered 429"""
+        with self._cond:
+            self._rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Queue depth per lane, grants, waits and bucket levels"""
+        with self._cond:
+            now = time.monotonic()
+            for bucket, _ in self._buckets():
+                bucket.refill(now)
+            queued = Counter(PRIORITY_LANES[rank] if rank < len(PRIORITY_LANES) else "other"
+                             for rank, _ in self._waiters)
+            return {
+                "queued": {lane: queued.get(lane, 0) for lane in PRIORITY_LANES},
+                "granted": {lane: self._granted.get(lane, 0) for lane in PRIORITY_LANES},
+                "p95WaitMs": {lane: round(percentile(list(waits), 95), 1) for lane, waits in self._wait_ms.items()},
+                "timeouts": self._timeouts,
+                "rateLimited": self._rate_limited,
+                "requestsAvailable": round(self._requests.level, 1) if self._requests else None,
+                "tokensAvailable": round(self._tokens.level) if self._tokens else None
+            }
+
+
+def is_upstream_failure(error):
+    """True for errors that suggest upstream is degraded rather than that our request was bad"""
+    if isinstance(error, (DeadlineExceeded, TimeoutError, ConnectionError)):
+        return True
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError))
+
+
+class ResilientUpstream:
+    """Circuit breaker and request hedging around calls to one upstream API.
+
+    ``call(request, stage)`` invokes ``request(timeout)`` with a timeout cut
+    from the request deadline. Once enough latencies of a stage are
+    recorded, a call still running past that stage's ``hedge_percentile``
+    latency gets a duplicate, and whichever finishes first wins. Latencies
+    are measured from when a call starts running, never from when it was
+    queued, and calls that have not started when the caller gives up are
+    cancelled. After ``failure_threshold``
+    consecutive upstream failures the breaker opens and calls fail fast
+    for ``reset_seconds``, after which a single trial call is let through.
+    With a ``scheduler``, admitted calls queue for rate-limit quota, and a
+    429 is retried after backing off instead of counting as a failure.
+    Other upstream failures are retried up to ``retries`` times, each try
+    getting only what is left of the stage budget; the OpenAI clients make
+    no retries of their own so a stage never outlives its budget.
+    ``call_async`` applies the same policy to ``async`` requests.
+    """
+
+    def __init__(self, name, executor, failure_threshold=5, reset_seconds=30.0,
+                 hedge_percentile=95.0, hedge_min_samples=20, window=200, scheduler=None, retries=0):
+        self.name = name
+        self.executor = executor
+        self.scheduler = scheduler
+        self.retries = retries
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.window = window
+        self._latencies = {}  # stage -> recent latencies of hedgeable calls
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._consecutive_failures = 0
+        self._calls = 0
+        self._failures = 0
+        self._short_circuited = 0
+        self._hedged_calls = 0
+        self._hedge_wins = 0
+
+    def hedge_delay(self, stage):
+        """Latency past which a call for ``stage`` is hedged, or None while there is too little history"""
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            latencies = self._latencies.get(stage, ())
+            if len(latencies) < self.hedge_min_samples:
+                return None
+            return percentile(list(latencies), self.hedge_percentile)
+
+    def _admit(self):
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.reset_seconds:
+                    self._short_circuited += 1
+                    raise UpstreamUnavailable(f"{self.name} is unavailable, failing fast")
+                self._state = "half_open"
+            if self._state == "half_open":
+                if self._trial_in_flight:
+                    self._short_circuited += 1
+                    raise UpstreamUnavailable(f"{self.name} is recovering, failing fast")
+                self._trial_in_flight = True
+            self._calls += 1
+
+    def _abandon(self):
+        """Undo ``_admit`` for a call that never reached upstream"""
+        with self._lock:
+            self._trial_in_flight = False
+            self._calls -= 1
+
+    def _acquire(self, stage, tokens):
+        """Admit a call through the breaker, then wait for its quota and return its timeout"""
+        timeout = stage_timeout(stage)
+        if timeout <= 0:
+            raise DeadlineExceeded(f"No time left for the {stage} stage")
+        # Admit before queueing so calls the breaker rejects never spend quota
+        self._admit()
+        if self.scheduler is None:
+            return timeout
+        try:
+            self.scheduler.acquire(tokens, timeout=timeout)
+        except BaseException:
+            self._abandon()
+            raise
+        return self._remaining(stage)
+
+    async def _acquire_async(self, stage, tokens):
+        timeout = stage_timeout(stage)
+        if timeout <= 0:
+            raise DeadlineExceeded(f"No time left for the {stage} stage")
+        self._admit()
+        if self.scheduler is None:
+            return timeout
+        try:
+            await self.scheduler.acquire_async(tokens, timeout=timeout)
+        except BaseException:
+            self._abandon()
+            raise
+        return self._remaining(stage)
+
+    def _remaining(self, stage):
+        timeout = stage_timeout(stage)
+        if timeout <= 0:
+            self._abandon()
+            raise DeadlineExceeded(f"No time left for the {stage} stage")
+        return timeout
+
+    def _should_retry(self, error, stage, retries_left):
+        """Retry a transient failure only while the breaker is closed and budget remains"""
+        if retries_left <= 0 or isinstance(error, DeadlineExceeded) or not is_upstream_failure(error):
+            return False
+        with self._lock:
+            if self._state != "closed":
+                return False
+        return stage_timeout(stage) > 0
+
+    def _record(self, error=None, latency=None, stage=None):
+        with self._lock:
+            self._trial_in_flight = False
+            if error is None:
+                self._consecutive_failures = 0
+                self._state = "closed"
+                # Only hedgeable calls feed the window; stream opens and the like are not comparable
+                if stage is not None:
+                    self._latencies.setdefault(stage, deque(maxlen=self.window)).append(latency)
+                return
+            if not is_upstream_failure(error) or (self.scheduler is not None and is_rate_limited(error)):
+                if self._state == "half_open":
+                    self._state = "closed"
+                return
+            self._failures += 1
+            self._consecutive_failures += 1
+            if self._state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state != "open":
+                    print(f"Circuit for {self.name} opened after {self._consecutive_failures} failures")
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    def call(self, request, stage, hedge=True, tokens=0):
+        """Run ``request(timeout)`` under the quota, stage budget, breaker and hedging policy.
+
+        ``tokens`` is the estimated token cost charged against the scheduler.
+        """
+        attempt = 0
+        retries_left = self.retries
+        while True:
+            timeout = self._acquire(stage, tokens)
+
+            try:
+                hedge_after = self.hedge_delay(stage) if hedge else None
+                if hedge_after is None or hedge_after >= timeout:
+                    started = time.monotonic()
+                    result = request(timeout)
+                    latency = time.monotonic() - started
+                else:
+                    result, latency = self._call_hedged(request, timeout, hedge_after, tokens)
+            except Exception as e:
+                self._record(error=e)
+                if self.scheduler is not None and is_rate_limited(e) and attempt < OPENAI_RATE_LIMIT_RETRIES:
+                    # Wait our turn again rather than failing into the fallback
+                    self.scheduler.back_off(retry_after_seconds(e))
+                    attempt += 1
+                    continue
+                if self._should_retry(e, stage, retries_left):
+                    retries_left -= 1
+                    continue
+                raise
+            self._record(latency=latency, stage=stage if hedge else None)
+            return result
+
+    async def call_async(self, request, stage, hedge=True, tokens=0):
+        """Await ``request(timeout)`` under the same policy as ``call``, without blocking a thread"""
+        attempt = 0
+        retries_left = self.retries
+        while True:
+            timeout = await self._acquire_async(stage, tokens)
+
+            started = time.monotonic()
+            try:
+                hedge_after = self.hedge_delay(stage) if hedge else None
+                if hedge_after is None or hedge_after >= timeout:
+                    result = await asyncio.wait_for(request(timeout), timeout)
+                else:
+                    result = await self._call_hedged_async(request, timeout, hedge_after, tokens)
+            except asyncio.TimeoutError:
+                error = DeadlineExceeded(f"{self.name} call exceeded {timeout:.1f}s")
+                self._record(error=error)
+                raise error
+            except Exception as e:
+                self._record(error=e)
+                if self.scheduler is not None and is_rate_limited(e) and attempt < OPENAI_RATE_LIMIT_RETRIES:
+                    self.scheduler.back_off(retry_after_seconds(e))
+                    attempt += 1
+                    continue
+                if self._should_retry(e, stage, retries_left):
+                    retries_left -= 1
+                    continue
+                raise
+            self._record(latency=time.monotonic() - started, stage=stage if hedge else None)
+            return result
+
+    async def _call_hedged_async(self, request, timeout, hedge_after, tokens=0):
+        started = time.monotonic()
+        primary = asyncio.ensure_future(request(timeout))
+        done, _ = await asyncio.wait([primary], timeout=hedge_after)
+        if not done and self.scheduler is not None and not self.scheduler.try_acquire(tokens):
+            done, _ = await asyncio.wait([primary], timeout=max(0.0, timeout - (time.monotonic() - started)))
+            if not done:
+                primary.cancel()
+                raise DeadlineExceeded(f"{self.name} call exceeded {timeout:.1f}s")
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self._hedged_calls += 1
+        backup = asyncio.ensure_future(request(timeout - (time.monotonic() - started)))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, timeout - (time.monotonic() - started)),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            with self._lock:
+                                self._hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+        finally:
+            # Unlike threads, the losing coroutine can be cancelled
+            for task in pending:
+                task.cancel()
+        raise error or DeadlineExceeded(f"{self.name} call exceeded {timeout:.1f}s")
+
+    def _call_hedged(self, request, timeout, hedge_after, tokens=0):
+        """Return (result, latency) of the first of the primary and a late duplicate to succeed"""
+        deadline = time.monotonic() + timeout
+        primary_started = threading.Event()
+
+        def attempt(started_event=None):
+            started = time.monotonic()
+            if started_event is not None:
+                started_event.set()
+            if deadline - started <= 0:
+                raise DeadlineExceeded(f"{self.name} call exceeded {timeout:.1f}s")
+            # Time spent queued on the executor is neither given to nor counted against upstream
+            return request(deadline - started), time.monotonic() - started
+
+        primary = self.executor.submit(attempt, primary_started)
+        futures = [primary]
+        try:
+            done, _ = wait(futures, timeout=hedge_after)
+            # A primary still queued is slow because of us, not upstream; a duplicate would queue too
+            if not done and primary_started.is_set() and (self.scheduler is None or self.scheduler.try_acquire(tokens)):
+                with self._lock:
+                    self._hedged_calls += 1
+                futures.append(self.executor.submit(attempt))
+
+            error = None
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    if future.exception() is None:
+                        if future is not primary:
+                            with self._lock:
+                                self._hedge_wins += 1
+                        # A slower duplicate already running finishes on its own; its result is discarded
+                        return future.result()
+                    error = future.exception()
+            raise error or DeadlineExceeded(f"{self.name} call exceeded {timeout:.1f}s")
+        finally:
+            # Calls still queued have no one waiting for them, so never send them
+            for future in futures:
+                future.cancel()
+
+    def stats(self):
+        """Breaker state and hedging counters"""
+        with self._lock:
+            stages = list(self._latencies)
+        hedge_after = {stage: self.hedge_delay(stage) for stage in stages}
+        with self._lock:
+            return {
+                "state": self._state,
+                "calls": self._calls,
+                "failures": self._failures,
+                "consecutiveFailures": self._consecutive_failures,
+                "shortCircuited": self._short_circuited,
+                "hedged": self._hedged_calls,
+                "hedgeWins": self._hedge_wins,
+                "hedgeAfterMs": {stage: round(delay * 1000, 1) if delay is not None else None
+                                 for stage, delay in hedge_after.items()}
+            }
 
-def load_image_model():
+
+upstream_executor = ThreadPoolExecutor(max_workers=OPENAI_HEDGE_WORKERS, thread_name_prefix="openai-hedge")
+chat_scheduler = QuotaScheduler(
+    "OpenAI chat",
+    requests_per_minute=OPENAI_CHAT_RPM / QUOTA_PROCESSES,
+    tokens_per_minute=OPENAI_CHAT_TPM / QUOTA_PROCESSES
+)
+tts_scheduler = QuotaScheduler("OpenAI TTS", requests_per_minute=OPENAI_TTS_RPM / QUOTA_PROCESSES)
+chat_upstream = ResilientUpstream(
+    "OpenAI chat", upstream_executor, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS,
+    hedge_percentile=OPENAI_HEDGE_PERCENTILE, hedge_min_samples=OPENAI_HEDGE_MIN_SAMPLES, scheduler=chat_scheduler,
+    retries=OPENAI_MAX_RETRIES
+)
+tts_upstream = ResilientUpstream(
+    "OpenAI TTS", upstream_executor, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS,
+    hedge_percentile=OPENAI_HEDGE_PERCENTILE, hedge_min_samples=OPENAI_HEDGE_MIN_SAMPLES, scheduler=tts_scheduler,
+    retries=OPENAI_MAX_RETRIES
+)
+
+def load_onnx_captioner(processor, token, model_dir=CAPTION_ONNX_DIR):
+    """Load the quantized ONNX captioner, exporting it from the PyTorch weights on first use"""
+    from transformers import AutoModelForCausalLM
+    
+    if not OnnxGitCaptioner.exists(model_dir):
+        print(f"Exporting {CAPTION_MODEL_ID} to quantized ONNX in {model_dir}...")
+        model = AutoModelForCausalLM.from_pretrained(CAPTION_MODEL_ID, token=token)
+        OnnxGitCaptioner.export(model, model_dir)
+        del model
+    return OnnxGitCaptioner.load(model_dir, processor.tokenizer, threads=CAPTION_ONNX_THREADS)
+
+def load_image_model(on_progress=None):
     """Load the model once when the app starts"""
-    global image_model, image_processor
+    global image_model, image_processor, onnx_captioner
+    report = on_progress or (lambda stage: None)
     
     token = os.getenv('HUGGINGFACE_HUB_TOKEN')
     if not token:
         raise ValueError("HUGGINGFACE_HUB_TOKEN not found in environment variables.")
     
-    print("Loading image captioning model...")
-    image_model = AutoModelForCausalLM.from_pretrained("microsoft/git-base", token=token)
-    image_processor = AutoProcessor.from_pretrained("microsoft/git-base", token=token)
+    print(f"Loading image captioning model ({CAPTION_ENGINE} engine)...")
+    report("importing")
+    from transformers import AutoProcessor, AutoModelForCausalLM
+    
+    report("loading_processor")
+    processor = AutoProcessor.from_pretrained(CAPTION_MODEL_ID, token=token)
+    report("loading_model")
+    if CAPTION_ENGINE == 'onnx':
+        onnx_captioner = load_onnx_captioner(processor, token)
+    else:
+        image_model = AutoModelForCausalLM.from_pretrained(CAPTION_MODEL_ID, token=token)
+    # Published last: a non-None processor is what marks the captioner as ready
+    image_processor = processor
     print("Image model loaded successfully!")
 
-def generate_image_caption(image):
-    """Generate caption for the uploaded image"""
-    # Generate caption
-    inputs = image_processor(images=image, return_tensors="pt")
-    generated_ids = image_model.generate(pixel_values=inputs["pixel_values"], max_length=50)
-    caption = image_processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    return caption
+def is_captioner_ready():
+    """True once the processor and a captioning engine are loaded"""
+    return image_processor is not None and (image_model is not None or onnx_captioner is not None)
+
+def warm_up_image_model():
+    """Load the captioning model and run one caption so the first request is not slow"""
+    def report(stage):
+        model_state["stage"] = stage
+    
+    model_state.update(status="loading", startedAt=time.time(), error=None)
+    try:
+        load_image_model(on_progress=report)
+        report("warming_up")
+        generate_image_captions([Image.new("RGB", (224, 224), "white")])
+        model_state.update(status="ready", stage=None, readyAt=time.time())
+        print(f"Captioning model ready after {model_state['readyAt'] - model_state['startedAt']:.1f}s")
+    except Exception as e:
+        print(f"❌ Failed to load captioning model: {e}")
+        model_state.update(status="failed", error=str(e))
+
+def start_model_warmup():
+    """Load the captioning model on a background thread while the server starts listening"""
+    thread = threading.Thread(target=warm_up_image_model, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+# Trace of the request being served; executors see it through submit_with_context
+request_trace = contextvars.ContextVar('request_trace', default=None)
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class RequestTrace:
+    """Span waterfall of one request, collected from every thread and task working on it"""
+
+    def __init__(self, trace_id, endpoint, method, sampled=False):
+        self.trace_id = trace_id
+        self.endpoint = endpoint
+        self.method = method
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, started, finished, error=None):
+        span = {
+            "name": name,
+            "startMs": round((started - self.started) * 1000, 2),
+            "durationMs": round((finished - started) * 1000, 2),
+            "thread": threading.current_thread().name
+        }
+        if error:
+            span["error"] = error
+        with self._lock:
+            self._spans.append(span)
+
+    def record(self, status, reason):
+        """JSON-serializable log entry for the finished request"""
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span["startMs"])
+        return {
+            "traceId": self.trace_id,
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "status": status,
+            "reason": reason,
+            "startedAt": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "durationMs": round((time.perf_counter() - self.started) * 1000, 2),
+            "spans": spans
+        }
+
+
+class TraceLog:
+    """Buffered JSON-lines writer running on its own thread.
+
+    ``submit`` only appends to an in-memory buffer, so request threads never
+    wait on the disk. Entries are written in batches every
+    ``flush_seconds``. When more than ``max_pending`` are waiting, new ones
+    are dropped and counted.
+    """
+
+    def __init__(self, path, flush_seconds=1.0, max_pending=10000):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._written = 0
+        self._dropped = 0
+        self._reasons = Counter()
+        self._thread = threading.Thread(target=self._run, name="trace-log", daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                return False
+            self._pending.append(record)
+            self._reasons[record["reason"]] += 1
+        return True
+
+    def flush(self):
+        """Write everything pending now (also called by the writer thread)"""
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+        if not batch:
+            return
+        lines = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in batch)
+        try:
+            with open(self.path, "a", encoding="utf-8") as log_file:
+                log_file.write(lines)
+        except OSError as e:
+            print(f"Error writing trace log: {e}")
+            with self._lock:
+                self._dropped += len(batch)
+            return
+        with self._lock:
+            self._written += len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def stats(self):
+        """Entries logged by reason, written, pending and dropped"""
+        with self._lock:
+            return {
+                "path": self.path,
+                "logged": dict(self._reasons),
+                "written": self._written,
+                "pending": len(self._pending),
+                "dropped": self._dropped
+            }
+
+
+trace_log = TraceLog(TRACE_LOG_PATH, flush_seconds=TRACE_FLUSH_SECONDS, max_pending=TRACE_MAX_PENDING) if TRACE_ENABLED else None
+
+
+def start_trace(endpoint, method, request_id=None):
+    """Create the trace of a new request, reusing a well-formed incoming request id"""
+    trace_id = request_id if request_id and REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+    return RequestTrace(trace_id, endpoint, method, sampled=random.random() < TRACE_SAMPLE_RATE)
+
+
+def finish_trace(trace, status):
+    """Log the trace if the request was slow, failed, or was sampled at its start"""
+    if trace_log is None:
+        return None
+    duration_ms = (time.perf_counter() - trace.started) * 1000
+    if duration_ms >= TRACE_SLOW_MS:
+        reason = "slow"
+    elif status >= 500:
+        reason = "error"
+    elif trace.sampled:
+        reason = "sampled"
+    else:
+        return None
+    trace_log.submit(trace.record(status, reason))
+    return reason
+
+
+class observe_stage:
+    """Time a pipeline stage into the stage histogram, in-flight gauge and the request's trace"""
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        STAGE_IN_FLIGHT.labels(self.stage).inc()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        finished = time.perf_counter()
+        STAGE_LATENCY.labels(self.stage).observe(finished - self.started)
+        STAGE_IN_FLIGHT.labels(self.stage).dec()
+        trace = request_trace.get()
+        if trace is not None:
+            trace.add_span(self.stage, self.started, finished, error=exc_type.__name__ if exc_type else None)
+        return False
+
+
+def level_label(vocabulary_level):
+    """Metric label for a client-supplied vocabulary level; unknown values share one series"""
+    if vocabulary_level in VOCABULARY_LEVELS or vocabulary_level == "none":
+        return vocabulary_level
+    return "other"
+
+
+def record_token_usage(operation, vocabulary_level, usage):
+    """Count prompt and completion tokens from an OpenAI usage object"""
+    if usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = getattr(usage, f"{kind}_tokens", None)
+        if isinstance(tokens, int):
+            OPENAI_TOKENS.labels(operation, kind, level_label(vocabulary_level)).inc(tokens)
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values (nearest rank), or 0.0 when empty"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class CaptionBatcher:
+    """Collect pending caption requests and run them through the model as one batch.
+
+    A request waits at most ``max_wait_ms`` after the oldest pending image
+    arrived, or until ``max_batch_size`` images are queued, whichever is first.
+    """
+
+    def __init__(self, caption_fn, max_batch_size=8, max_wait_ms=10.0, stats_window=1000):
+        self.caption_fn = caption_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._worker = None
+
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._queue_waits_ms = deque(maxlen=stats_window)
+        self._batch_latencies_ms = deque(maxlen=stats_window)
+        self._total_batches = 0
+        self._total_images = 0
+        self._errors = 0
+
+    def submit(self, image, timeout=None):
+        """Queue an image and block until its caption is ready"""
+        return self.enqueue(image).result(timeout=timeout)
+
+    def enqueue(self, image):
+        """Queue an image and return a Future for its caption"""
+        future = Future()
+        with self._cond:
+            self._ensure_worker()
+            self._pending.append((image, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="caption-batcher", daemon=True)
+            self._worker.start()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            deadline = self._pending[0][2] + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            size = min(len(self._pending), self.max_batch_size)
+            return [self._pending.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            # Skip images whose caller gave up, such as a closed classroom stream
+            batch = [item for item in self._next_batch() if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.monotonic()
+            waits = [(started - enqueued) * 1000.0 for _, _, enqueued in batch]
+
+            try:
+                captions = self.caption_fn([image for image, _, _ in batch])
+                if len(captions) != len(batch):
+                    raise RuntimeError(f"Expected {len(batch)} captions, got {len(captions)}")
+            except Exception as e:
+                print(f"Error in caption batch of {len(batch)}: {e}")
+                with self._stats_lock:
+                    self._errors += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future, _), caption in zip(batch, captions):
+                future.set_result(caption)
+
+            with self._stats_lock:
+                self._total_batches += 1
+                self._total_images += len(batch)
+                self._batch_sizes[len(batch)] += 1
+                self._queue_waits_ms.extend(waits)
+                self._batch_latencies_ms.append((time.monotonic() - started) * 1000.0)
+
+    def stats(self):
+        """Batch-size and queue-wait statistics for tuning throughput against latency"""
+        with self._stats_lock:
+            waits = list(self._queue_waits_ms)
+            latencies = list(self._batch_latencies_ms)
+            return {
+                "maxBatchSize": self.max_batch_size,
+                "maxWaitMs": self.max_wait * 1000.0,
+                "pending": len(self._pending),
+                "batches": self._total_batches,
+                "images": self._total_images,
+                "errors": self._errors,
+                "avgBatchSize": self._total_images / self._total_batches if self._total_batches else 0.0,
+                "batchSizeHistogram": {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                "queueWaitMs": {
+                    "p50": percentile(waits, 50),
+                    "p95": percentile(waits, 95),
+                    "p99": percentile(waits, 99),
+                    "max": max(waits) if waits else 0.0
+                },
+                "batchLatencyMs": {
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99)
+                }
+            }
+
+
+def generate_image_captions(images):
+    """Generate captions for several images in a single batched forward pass"""
+    if onnx_captioner is not None:
+        inputs = image_processor(images=images, return_tensors="np")
+        generated_ids = onnx_captioner.generate(inputs["pixel_values"])
+    else:
+        inputs = image_processor(images=images, return_tensors="pt")
+        generated_ids = image_model.generate(pixel_values=inputs["pixel_values"], max_length=CAPTION_MAX_LENGTH)
+    return image_processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+
+caption_batcher = CaptionBatcher(
+    lambda images: generate_image_captions(images),
+    max_batch_size=CAPTION_BATCH_MAX_SIZE,
+    max_wait_ms=CAPTION_BATCH_MAX_WAIT_MS
+)
+
+
+class ModelNotReady(Exception):
+    """Raised when a caption is requested before the model has finished loading"""
+
+
+def attach_shared_memory(name):
+    """Attach to a shared memory block owned by another process without adopting it"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with this process's
+        # resource tracker, which would unlink it when we exit
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class CaptionTimeout(Exception):
+    """Raised when the caption server does not answer within its timeout"""
+
+
+class CaptionServerClient:
+    """Caption images through the caption server over a Unix domain socket.
+
+    Pixels are copied into a shared memory block and only its name and the
+    image size go over the socket. Each thread keeps its own connection.
+    """
+
+    def __init__(self, socket_path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.timeout)
+        conn.connect(self.socket_path)
+        self._local.conn = conn
+        self._local.reader = conn.makefile('rb')
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.reader.close()
+            conn.close()
+        self._local.conn = None
+
+    def _request(self, message):
+        # A kept-alive connection may have been closed by a server restart; retry once on a fresh one
+        for attempt in range(2):
+            try:
+                if getattr(self._local, "conn", None) is None:
+                    self._connect()
+                self._local.conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+                line = self._local.reader.readline()
+                if not line:
+                    raise ConnectionError("Caption server closed the connection")
+                return json.loads(line)
+            except socket.timeout:
+                # The server is busy with this request; resending would only queue it twice
+                self._close()
+                raise CaptionTimeout(f"Caption server did not answer within {self.timeout:g}s")
+            except OSError:
+                self._close()
+                if attempt:
+                    raise
+
+    def caption(self, image):
+        """Caption one image on the server"""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        pixels = image.tobytes()
+        
+        shm = shared_memory.SharedMemory(create=True, size=len(pixels))
+        try:
+            shm.buf[:len(pixels)] = pixels
+            reply = self._request({"op": "caption", "shm": shm.name, "width": image.width, "height": image.height})
+        except OSError as e:
+            raise ModelNotReady(f"Caption server unavailable: {e}")
+        finally:
+            shm.close()
+            shm.unlink()
+        
+        if reply.get("notReady"):
+            raise ModelNotReady(reply["error"])
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply["caption"]
+
+    def status(self):
+        """The server's model status, or None if it cannot be reached"""
+        try:
+            return self._request({"op": "status"})
+        except (OSError, CaptionTimeout):
+            return None
+
+
+caption_server_client = CaptionServerClient(
+    CAPTION_SERVER_SOCKET,
+    timeout=CAPTION_SERVER_TIMEOUT_SECONDS
+) if CAPTION_SERVER_SOCKET else None
+
+
+def handle_caption_server_request(message):
+    """Answer one caption server request (runs in the model-owning process)"""
+    if message.get("op") == "status":
+        return {"ready": is_captioner_ready(), "model": model_state}
+    
+    if not is_captioner_ready():
+        return {"error": "The captioning model is still loading", "notReady": True}
+    
+    try:
+        width, height = int(message["width"]), int(message["height"])
+        shm = attach_shared_memory(message["shm"])
+        try:
+            image = Image.frombytes("RGB", (width, height), bytes(shm.buf[:width * height * 3]))
+        finally:
+            shm.close()
+        # Goes through the caption batcher, so requests from different workers share batches
+        return {"caption": generate_image_caption(image)}
+    except Exception as e:
+        print(f"Error in caption server request: {e}")
+        return {"error": f"Failed to caption image: {e}"}
+
+
+def make_caption_server(socket_path):
+    """Create the Unix socket server that answers caption requests"""
+    import socketserver
+
+    class CaptionRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                reply = handle_caption_server_request(json.loads(line))
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, CaptionRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def run_caption_server(socket_path):
+    """Own the single model copy and caption images for every web worker on this box"""
+    start_model_warmup()
+    server = make_caption_server(socket_path)
+    print(f"🚀 Caption server listening on {socket_path}...")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def generate_image_caption(image):
+    """Generate caption for the uploaded image"""
+    if caption_server_client is not None:
+        return caption_server_client.caption(image)
+    if not is_captioner_ready():
+        raise ModelNotReady("The captioning model is still loading")
+    if CAPTION_BATCHING_ENABLED:
+        return caption_batcher.submit(image)
+    return generate_image_captions([image])[0]
+
+
+def submit_captions(images):
+    """Queue many images for captioning at once and return a Future per image.
+
+    They go through the caption batcher, or the caption server when one is
+    configured, so the model is only ever run by the thread that owns it.
+    """
+    if caption_server_client is not None:
+        # The caption server batches concurrent requests itself
+        return [submit_with_context(pipeline_executor, caption_server_client.caption, image) for image in images]
+    if not is_captioner_ready():
+        raise ModelNotReady("The captioning model is still loading")
+    return [caption_batcher.enqueue(image) for image in images]
+
+
+class ImageTooLarge(Exception):
+    """Raised when an upload declares more pixels than MAX_IMAGE_PIXELS"""
+
+
+class ImageDecodeStats:
+    """Rolling decode time and bitmap size statistics for uploaded images"""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._decode_ms = deque(maxlen=window)
+        self._peak_bytes = deque(maxlen=window)
+        self._decoded = 0
+        self._draft_decodes = 0
+        self._rejected = 0
+
+    def record(self, decode_ms, peak_bytes, used_draft):
+        with self._lock:
+            self._decode_ms.append(decode_ms)
+            self._peak_bytes.append(peak_bytes)
+            self._decoded += 1
+            self._draft_decodes += 1 if used_draft else 0
+
+    def record_rejection(self):
+        with self._lock:
+            self._rejected += 1
+
+    def stats(self):
+        """Decode latency percentiles and largest bitmap sizes"""
+        with self._lock:
+            timings = list(self._decode_ms)
+            sizes = list(self._peak_bytes)
+            return {
+                "decoded": self._decoded,
+                "draftDecodes": self._draft_decodes,
+                "rejected": self._rejected,
+                "decodeMs": {
+                    "p50": percentile(timings, 50),
+                    "p95": percentile(timings, 95),
+                    "p99": percentile(timings, 99)
+                },
+                "peakBitmapBytes": {
+                    "p50": percentile(sizes, 50),
+                    "max": max(sizes) if sizes else 0
+                }
+            }
+
+
+image_decode_stats = ImageDecodeStats()
+
+
+class UploadRejected(HTTPException):
+    """Raised while an upload is still streaming in, so the rest of the body is never buffered"""
+
+    def __init__(self, code, description, reason):
+        super().__init__(description)
+        self.code = code
+        self.reason = reason
+
+
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*")
+
+
+def looks_like_image(head):
+    """True if the first bytes carry the signature of an image format we can decode"""
+    if head[:4] == b"RIFF":
+        return head[8:12] == b"WEBP"
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+class SniffedUpload(tempfile.SpooledTemporaryFile):
+    """Spooled upload that checks the image header as the first bytes arrive.
+
+    Non-images, files over ``max_bytes`` and images declaring more than
+    ``max_pixels`` are rejected mid-stream: with ``strict`` the whole request
+    fails, otherwise the rest of the file is discarded and ``rejection`` is
+    set. Files larger than ``memory_bytes`` roll over to a temporary file on
+    disk.
+    """
+
+    def __init__(self, max_bytes, memory_bytes, sniff_bytes, max_pixels, strict=True):
+        super().__init__(max_size=memory_bytes, mode="w+b")
+        self.max_bytes = max_bytes
+        self.sniff_bytes = sniff_bytes
+        self.max_pixels = max_pixels
+        self.strict = strict
+        self.rejection = None
+        self.received = 0
+        self.peak_memory_bytes = 0
+        self._head = bytearray()
+        self._sniffing = True
+
+    def write(self, data):
+        self.received += len(data)
+        if self.rejection:
+            return len(data)
+        try:
+            if self.received > self.max_bytes:
+                raise UploadRejected(413, f"Each file must be at most {self.max_bytes} bytes", "too_many_bytes")
+            if self._sniffing:
+                self._head += data[:self.sniff_bytes - len(self._head)]
+                self._sniff()
+        except UploadRejected as e:
+            self._reject(e)
+            return len(data)
+        written = super().write(data)
+        if not self._rolled:
+            self.peak_memory_bytes = self.received
+        return written
+
+    def _reject(self, rejection):
+        upload_stats.record_rejection(rejection.reason)
+        if self.strict:
+            raise rejection
+        self.rejection = rejection
+        self._head = bytearray()
+        self.truncate(0)
+
+    @property
+    def spooled_to_disk(self):
+        return self._rolled
+
+    def _sniff(self):
+        if len(self._head) < 12:
+            return
+        if not looks_like_image(self._head):
+            raise UploadRejected(400, "File must be an image", "not_an_image")
+        try:
+            width, height = Image.open(io.BytesIO(self._head)).size
+        except Exception:
+            # The header is not complete yet; give up after sniff_bytes and let decoding decide
+            self._sniffing = len(self._head) < self.sniff_bytes
+            return
+        self._sniffing = False
+        if width * height > self.max_pixels:
+            raise UploadRejected(413, f"Image is {width}x{height}, the limit is {self.max_pixels} pixels", "too_many_pixels")
+
+
+class UploadStats:
+    """Upload sizes, per-request buffered memory and rejection counts"""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._file_bytes = deque(maxlen=window)
+        self._request_memory = deque(maxlen=window)
+        self._files = 0
+        self._spooled = 0
+        self._rejected = Counter()
+
+    def record_request(self, uploads):
+        with self._lock:
+            for upload in uploads:
+                self._file_bytes.append(upload.received)
+                self._files += 1
+                self._spooled += 1 if upload.spooled_to_disk else 0
+            self._request_memory.append(sum(upload.peak_memory_bytes for upload in uploads))
+
+    def record_rejection(self, reason):
+        UPLOAD_REJECTIONS.labels(reason).inc()
+        with self._lock:
+            self._rejected[reason] += 1
+
+    def stats(self):
+        """File size percentiles, peak in-memory bytes per request, spooling and rejections"""
+        with self._lock:
+            sizes = list(self._file_bytes)
+            memory = list(self._request_memory)
+            return {
+                "files": self._files,
+                "spooledToDisk": self._spooled,
+                "rejected": dict(self._rejected),
+                "fileBytes": {
+                    "p50": percentile(sizes, 50),
+                    "p95": percentile(sizes, 95),
+                    "max": max(sizes) if sizes else 0
+                },
+                "requestMemoryBytes": {
+                    "p95": percentile(memory, 95),
+                    "max": max(memory) if memory else 0
+                }
+            }
+
+
+upload_stats = UploadStats()
+
+
+class UploadRequest(Request):
+    """Request whose file parts stream into SniffedUpload spools.
+
+    Views that report bad files one by one set ``strict_uploads`` to False
+    before touching ``request.files``.
+    """
+
+    strict_uploads = True
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        upload = SniffedUpload(UPLOAD_MAX_BYTES, UPLOAD_SPOOL_MEMORY_BYTES, UPLOAD_SNIFF_BYTES, MAX_IMAGE_PIXELS,
+                               strict=self.strict_uploads)
+        if not hasattr(self, "uploads"):
+            self.uploads = []
+        self.uploads.append(upload)
+        return upload
+
+
+app.request_class = UploadRequest
+
+
+def decode_target_size(width, height, short_side=None, max_decoded_pixels=None):
+    """Size to decode an image to: shortest side near short_side, within max_decoded_pixels.
+
+    Never upscales, and never takes the shortest side below the model's
+    input size, so wide panoramas keep their detail.
+    """
+    short_side = short_side or CAPTION_DECODE_SHORT_SIDE
+    max_decoded_pixels = max_decoded_pixels or CAPTION_DECODE_MAX_PIXELS
+    scale = min(1.0, short_side / min(width, height))
+    if width * height * scale * scale > max_decoded_pixels:
+        scale = math.sqrt(max_decoded_pixels / (width * height))
+    scale = max(scale, min(1.0, CAPTION_MODEL_INPUT_SIDE / min(width, height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def decode_upload_image(stream, short_side=None, max_pixels=None):
+    """Decode an uploaded image straight to an RGB bitmap of ``decode_target_size``.
+
+    The header is checked against max_pixels before any pixel data is read.
+    JPEGs are decoded by libjpeg at a reduced DCT scale (draft mode), and
+    everything else is shrunk with integer reduction before resampling.
+    """
+    max_pixels = max_pixels or MAX_IMAGE_PIXELS
+    started = time.perf_counter()
+    image = Image.open(stream)
+    
+    width, height = image.size
+    if width * height > max_pixels:
+        image_decode_stats.record_rejection()
+        raise ImageTooLarge(f"Image is {width}x{height}, the limit is {max_pixels} pixels")
+    
+    target = decode_target_size(width, height, short_side)
+    used_draft = False
+    if image.format == "JPEG" and target != (width, height):
+        # Picks the largest 1/2, 1/4 or 1/8 scale that stays at or above the target size
+        used_draft = image.draft("RGB", target) is not None
+    
+    image.load()
+    peak_bytes = image.width * image.height * len(image.getbands())
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    
+    # Transparent sketches get a white background rather than the black convert("RGB") gives
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    
+    image_decode_stats.record((time.perf_counter() - started) * 1000.0, peak_bytes, used_draft)
+    return image
+
+
+def perceptual_hash(image, hash_size=8):
+    """Perceptual hash of an image that survives re-encoding and resizing.
+
+    Combines a difference hash of the grayscale thumbnail with a coarse
+    average colour, so flat images of different colours do not collide.
+    """
+    width = hash_size + 1
+    gray = image.convert("L").resize((width, hash_size), Image.Resampling.LANCZOS)
+    pixels = gray.tobytes()
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * width + col]
+            right = pixels[row * width + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+
+    red, green, blue = image.convert("RGB").resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+    color = (red >> 6) << 4 | (green >> 6) << 2 | (blue >> 6)
+    return f"{bits:0{hash_size * hash_size // 4}x}-{color:02x}"
+
+
+class CaptionCache:
+    """Caption cache keyed by perceptual hash.
+
+    Keeps a bounded in-memory LRU and, when ``db_path`` is given, a SQLite
+    tier on disk that survives restarts and is trimmed least-recently-used first.
+    """
+
+    def __init__(self, max_entries=1024, db_path=None, max_disk_entries=100000):
+        self.max_entries = max(1, max_entries)
+        self.max_disk_entries = max(1, max_disk_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._disk_evictions = 0
+
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS captions "
+                "(key TEXT PRIMARY KEY, caption TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+            self._db.commit()
+
+    def get(self, key):
+        """Return the cached caption for key, or None on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+                if row:
+                    self._db.execute("UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._remember(key, row[0])
+                    self._disk_hits += 1
+                    return row[0]
+
+            self._misses += 1
+            return None
+
+    def put(self, key, caption):
+        """Store a caption in memory and, if configured, on disk"""
+        with self._lock:
+            self._remember(key, caption)
+
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO captions (key, caption, last_used) VALUES (?, ?, ?)",
+                    (key, caption, time.time())
+                )
+                excess = self._db.execute("SELECT COUNT(*) FROM captions").fetchone()[0] - self.max_disk_entries
+                if excess > 0:
+                    self._db.execute(
+                        "DELETE FROM captions WHERE key IN "
+                        "(SELECT key FROM captions ORDER BY last_used LIMIT ?)",
+                        (excess,)
+                    )
+                    self._disk_evictions += excess
+                self._db.commit()
+
+    def _remember(self, key, caption):
+        self._entries[key] = caption
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def clear(self):
+        """Drop every cached caption, including the disk tier"""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM captions")
+                self._db.commit()
+
+    def stats(self):
+        """Hit, miss and eviction counters"""
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "diskEnabled": self._db is not None,
+                "hits": self._hits,
+                "diskHits": self._disk_hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "diskEvictions": self._disk_evictions,
+                "hitRate": (self._hits + self._disk_hits) / lookups if lookups else 0.0
+            }
+
+
+caption_cache = CaptionCache(
+    max_entries=CAPTION_CACHE_MAX_ENTRIES,
+    db_path=CAPTION_CACHE_DB or None,
+    max_disk_entries=CAPTION_CACHE_MAX_DISK_ENTRIES
+) if CAPTION_CACHE_ENABLED else None
+
+def check_openai_api_key():
+    """Return an error message if the OpenAI API key is missing or malformed, else None"""
+    # Debug: Print API key status
+    api_key = os.getenv('OPENAI_API_KEY')
+    print(f"API Key exists: {api_key is not None}")
+    print(f"API Key starts with 'sk-': {api_key.startswith('sk-') if api_key else False}")
+    
+    if not api_key:
+        return "Error: OpenAI API key not found in environment variables."
+    
+    if not api_key.startswith('sk-'):
+        return "Error: OpenAI API key format is incorrect. It should start with 'sk-'."
+    
+    return None
+
+def build_story_messages(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Build the chat messages and token budget for a story request"""
+    # Get vocabulary level info
+    vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
+
+    # Create a detailed prompt
+    if story_length == "short":
+        length_instruction = "Write a short children's story (2-3 paragraphs)"
+        max_tokens = 400
+    else:
+        length_instruction = "Write a detailed children's story (4-5 paragraphs)"
+        max_tokens = 800
+    
+    prompt = f"""
+{length_instruction} based on the following:
+
+Image Description: {image_description}
+Story Theme/Keywords: {keywords}
+Vocabulary Level: {vocab_info['name']} - {vocab_info['description']}
+
+Requirements:
+- Make it educational and age-appropriate for children (ages 5-10)
+- Include a clear moral lesson about: {keywords}
+- Use vocabulary appropriate for {vocab_info['name']} level
+- Target word complexity: {vocab_info['target_length']}
+- Make the characters from the image description the main characters
+- Include dialogue to make it more engaging
+- End with a positive message
+- Incorporate some educational vocabulary words that children can learn
+
+Please write a complete, engaging children's story now:
+"""
+
+    messages = [
+        {
+            "role": "system", 
+            "content": f"You are a creative children's story writer who specializes in educational stories that teach important life lessons. Write engaging, age-appropriate stories for {vocab_info['name']} that are both fun and educational, using vocabulary appropriate for that age group."
+        },
+        {
+            "role": "user", 
+            "content": prompt
+        }
+    ]
+    return messages, max_tokens
+
+def generate_story(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Generate a story using GPT-4"""
+
+    try:
+        key_error = check_openai_api_key()
+        if key_error:
+            return key_error
+        
+        messages, max_tokens = build_story_messages(image_description, keywords, story_length, vocabulary_level)
+
+        with observe_stage("story"):
+            response = chat_upstream.call(lambda timeout: get_openai_client().chat.completions.create(
+                model="gpt-4",  # You can also try "gpt-3.5-turbo" if GPT-4 isn't available
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                top_p=0.9,
+                timeout=timeout
+            ), stage="story", tokens=estimate_chat_tokens(messages, max_tokens))
+        record_token_usage("story", vocabulary_level, response.usage)
+        
+        story = response.choices[0].message.content.strip()
+        print("Story generated successfully!")
+        return story
+        
+    except Exception as e:
+        print(f"Error with GPT-4: {str(e)}")
+        # Fallback to a simple response if GPT-4 fails
+        return story_apology(image_description, keywords)
+
+
+def story_apology(image_description, keywords):
+    """Text returned in place of a story when GPT-4 cannot be reached"""
+    return f"I'd love to tell you a story about {keywords} featuring {image_description}, but I'm having trouble connecting to my storytelling service right now. Please try again!"
+
+
+async def generate_story_async(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Coroutine form of generate_story using the AsyncOpenAI client"""
+    try:
+        key_error = check_openai_api_key()
+        if key_error:
+            return key_error
+        
+        messages, max_tokens = build_story_messages(image_description, keywords, story_length, vocabulary_level)
+        with observe_stage("story"):
+            response = await chat_upstream.call_async(lambda timeout: get_async_openai_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                top_p=0.9,
+                timeout=timeout
+            ), stage="story", tokens=estimate_chat_tokens(messages, max_tokens))
+        record_token_usage("story", vocabulary_level, response.usage)
+        return response.choices[0].message.content.strip()
+        
+    except Exception as e:
+        print(f"Error with GPT-4: {str(e)}")
+        return story_apology(image_description, keywords)
+
+VOCABULARY_ENTRY_FIELDS = ("word", "definition", "story_sentence", "example_sentence")
+
+
+def build_story_with_vocabulary_messages(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Story messages extended to ask for the vocabulary list in the same JSON reply"""
+    vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
+    messages, max_tokens = build_story_messages(image_description, keywords, story_length, vocabulary_level)
+    messages[-1]["content"] += f"""
+Then pick 6-8 vocabulary words from your story that are appropriate for {vocab_info['name']} \
+({vocab_info['description']}, target complexity: {vocab_info['target_length']}), avoiding very common words.
+
+Respond with only a JSON object in exactly this shape, with no other text:
+{{
+  "story": "the complete story, with paragraphs separated by blank lines",
+  "vocabulary": [
+    {{
+      "word": "example",
+      "definition": "child-friendly definition",
+      "story_sentence": "the sentence from the story where it appears",
+      "example_sentence": "fun example for kids"
+    }}
+  ]
+}}
+"""
+    return messages, max_tokens + 600
+
+
+def parse_story_with_vocabulary(content):
+    """Validate a combined JSON reply and return (story, vocabulary), or None if it does not match the schema"""
+    content = content.strip()
+    if content.startswith("```"):
+        content = re.sub(r'^```(?:json)?\s*|\s*```$', '', content)
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    
+    if not isinstance(data, dict):
+        return None
+    story = data.get("story")
+    vocabulary = data.get("vocabulary")
+    if not isinstance(story, str) or not story.strip() or not isinstance(vocabulary, list) or not vocabulary:
+        return None
+    for entry in vocabulary:
+        if not isinstance(entry, dict) or not all(isinstance(entry.get(field), str) for field in VOCABULARY_ENTRY_FIELDS):
+            return None
+    return story.strip(), [{field: entry[field] for field in VOCABULARY_ENTRY_FIELDS} for entry in vocabulary]
+
+
+def generate_story_with_vocabulary(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Generate the story and its vocabulary in one GPT-4 call.
+
+    Returns ``(story, vocabulary)``, or None when the call fails or the reply
+    does not parse, so the caller can fall back to the two-call path.
+    """
+    if check_openai_api_key():
+        return None
+    
+    messages, max_tokens = build_story_with_vocabulary_messages(image_description, keywords, story_length, vocabulary_level)
+    try:
+        with observe_stage("story"):
+            response = chat_upstream.call(lambda timeout: get_openai_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                top_p=0.9,
+                timeout=timeout
+            ), stage="story", tokens=estimate_chat_tokens(messages, max_tokens))
+        record_token_usage("story_with_vocabulary", vocabulary_level, response.usage)
+    except Exception as e:
+        print(f"Error with combined GPT-4 story call: {str(e)}")
+        return None
+    
+    result = parse_story_with_vocabulary(response.choices[0].message.content)
+    if result is None:
+        print("Combined story reply did not match the schema, falling back to separate calls")
+    else:
+        print("Story and vocabulary generated successfully!")
+    return result
+
+
+async def generate_story_with_vocabulary_async(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
+    """Coroutine form of generate_story_with_vocabulary"""
+    if check_openai_api_key():
+        return None
+    
+    messages, max_tokens = build_story_with_vocabulary_messages(image_description, keywords, story_length, vocabulary_level)
+    try:
+        with observe_stage("story"):
+            response = await chat_upstream.call_async(lambda timeout: get_async_openai_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                top_p=0.9,
+                timeout=timeout
+            ), stage="story", tokens=estimate_chat_tokens(messages, max_tokens))
+        record_token_usage("story_with_vocabulary", vocabulary_level, response.usage)
+    except Exception as e:
+        print(f"Error with combined GPT-4 story call: {str(e)}")
+        return None
+    
+    return parse_story_with_vocabulary(response.choices[0].message.content)
+
+
+def is_story_failure(story):
+    """True for the error and apology texts generate_story returns instead of a story"""
+    return story.startswith("Error:") or story.startswith("I'd love to tell you a story about")
+
+
+def story_cache_key(image_description, keywords, story_length, vocabulary_level):
+    """Normalize story parameters so trivially different requests share a cache entry"""
+    def normalize(text):
+        return " ".join(str(text).lower().split())
+
+    keyword_list = sorted({normalize(k) for k in str(keywords).split(",") if normalize(k)})
+    length = "short" if story_length == "short" else "long"
+    level = vocabulary_level if vocabulary_level in VOCABULARY_LEVELS else "intermediate"
+    return (normalize(image_description), ",".join(keyword_list), length, level)
+
+
+class StoryCache:
+    """Exact-match result cache with TTL, LRU size bound and single-flight.
+
+    Concurrent callers asking for a key that is already being computed wait
+    for that computation instead of starting their own upstream call.
+    """
+
+    def __init__(self, ttl_seconds=3600.0, max_entries=512):
+        self.ttl = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def get(self, key):
+        """Return the cached value for key without computing it, or None"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self._misses += 1
+            return value
+
+    def contains(self, key):
+        """True if a fresh value is cached for key; counts as neither a hit nor a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def put(self, key, value):
+        """Store a value computed outside get_or_compute"""
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_compute(self, key, compute, cacheable=lambda value: True):
+        """Return the cached value for key, computing it at most once at a time"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = compute()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            if cacheable(value):
+                self._store(key, value)
+        future.set_result(value)
+        return value
+
+    async def get_or_compute_async(self, key, compute, cacheable=lambda value: True):
+        """Coroutine form of get_or_compute; callers on one event loop share a single compute() task"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            task = self._async_inflight.get(key)
+            if task is None:
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            self._async_inflight[key] = task
+
+            def finish(done):
+                self._async_inflight.pop(key, None)
+                if not done.cancelled() and done.exception() is None and cacheable(done.result()):
+                    self.put(key, done.result())
+
+            task.add_done_callback(finish)
+        # One caller giving up must not cancel the computation the others wait on
+        return await asyncio.shield(task)
+
+    def clear(self):
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit, miss, coalescing and eviction counters"""
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "ttlSeconds": self.ttl,
+                "inFlight": len(self._inflight),
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "hitRate": (self._hits + self._coalesced) / lookups if lookups else 0.0
+            }
+
+
+story_cache = StoryCache(
+    ttl_seconds=STORY_CACHE_TTL_SECONDS,
+    max_entries=STORY_CACHE_MAX_ENTRIES
+) if STORY_CACHE_ENABLED else None
+
+
+class SimilarStoryIndex:
+    """Reuse stories written for near-identical image descriptions.
+
+    Stories are grouped by their lesson (normalized keywords, length and
+    vocabulary level). Within a group, descriptions are compared by cosine
+    similarity of character n-gram TF-IDF vectors. Stop words and caption
+    filler such as "a drawing of" are dropped first, so the comparison is
+    about what was drawn. A stored story is served when the best match
+    reaches ``threshold``. New descriptions are vectorized with the current
+    vocabulary; every ``refit_every`` additions the vectorizer is refitted
+    on a background thread and swapped in, so lookups never wait for a fit.
+    """
+
+    FILLER_WORDS = {"drawing", "picture", "sketch", "image", "cartoon", "illustration", "photo", "painting"}
+
+    def __init__(self, threshold=0.8, max_entries=2000, ttl_seconds=3600.0, refit_every=100):
+        from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, TfidfVectorizer
+
+        ignored = ENGLISH_STOP_WORDS | self.FILLER_WORDS
+        self._vectorizer_factory = lambda: TfidfVectorizer(
+            analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True,
+            preprocessor=lambda text: " ".join(w for w in re.findall(r"[a-z]+", text.lower()) if w not in ignored)
+        )
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self.refit_every = max(1, refit_every)
+        self._entries = OrderedDict()  # story_cache_key -> (story, stored at)
+        self._rows = {}  # story_cache_key -> TF-IDF row under the current vectorizer
+        self._lock = threading.Lock()
+        self._vectorizer = None
+        self._added_since_fit = 0
+        self._refitting = False
+        self._refits = 0
+        self._lookups = 0
+        self._hits = 0
+        self._similarities = deque(maxlen=1000)
+
+    def refit(self):
+        """Fit a new vectorizer on the stored descriptions without holding the lock, then swap it in"""
+        with self._lock:
+            keys = list(self._entries)
+            self._added_since_fit = 0
+        vectorizer = self._vectorizer_factory()
+        try:
+            matrix = vectorizer.fit_transform([key[0] for key in keys]) if keys else None
+        except ValueError:
+            # Every stored description was filler, so there is nothing to compare on
+            matrix = None
+        if matrix is None:
+            vectorizer = None
+
+        with self._lock:
+            self._vectorizer = vectorizer
+            self._rows = {}
+            if vectorizer is not None:
+                self._rows = {key: matrix[i] for i, key in enumerate(keys) if key in self._entries}
+                # Stories added while the fit ran are few; bring them into the new vocabulary here
+                for key in self._entries.keys() - self._rows.keys():
+                    self._rows[key] = vectorizer.transform([key[0]])
+            self._refits += 1
+            self._refitting = False
+
+    def _expire(self, now):
+        expired = [key for key, (_, stored_at) in self._entries.items() if now - stored_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+            self._rows.pop(key, None)
+
+    def add(self, key, story):
+        """Index a freshly generated story under its story_cache_key"""
+        with self._lock:
+            known = key in self._entries
+            self._entries[key] = (story, time.monotonic())
+            self._entries.move_to_end(key)
+            if known:
+                return
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._rows.pop(evicted, None)
+            if self._vectorizer is not None:
+                self._rows[key] = self._vectorizer.transform([key[0]])
+            self._added_since_fit += 1
+            # Until there is a vocabulary, a fit is cheap and needed before anything can match
+            first_fit = self._vectorizer is None
+            due = first_fit or self._added_since_fit >= self.refit_every
+            if not due or self._refitting:
+                return
+            self._refitting = True
+
+        if first_fit:
+            self.refit()
+        else:
+            threading.Thread(target=self.refit, name="similar-story-refit", daemon=True).start()
+
+    def lookup(self, key):
+        """Return (story, similarity) of the closest stored request with the same lesson, or (None, best similarity)"""
+        from scipy.sparse import vstack
+
+        with self._lock:
+            self._lookups += 1
+            self._expire(time.monotonic())
+            candidates = [stored for stored in self._rows if stored[1:] == key[1:]]
+            if not candidates:
+                return None, 0.0
+            query = self._vectorizer.transform([key[0]])
+            # Rows are L2-normalized, so the dot product is the cosine similarity
+            scores = (vstack([self._rows[stored] for stored in candidates]) @ query.T).toarray().ravel()
+            best = int(scores.argmax())
+            similarity = float(scores[best])
+            self._similarities.append(similarity)
+            if similarity < self.threshold:
+                return None, similarity
+            self._hits += 1
+            matched = candidates[best]
+            self._entries.move_to_end(matched)
+            return self._entries[matched][0], similarity
+
+    def stats(self):
+        """Hit rate and similarity distribution, to tune the threshold"""
+        with self._lock:
+            similarities = list(self._similarities)
+            return {
+                "entries": len(self._entries),
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "hitRate": round(self._hits / self._lookups, 3) if self._lookups else 0.0,
+                "threshold": self.threshold,
+                "refits": self._refits,
+                "similarityP50": round(percentile(similarities, 50), 3),
+                "similarityP95": round(percentile(similarities, 95), 3)
+            }
+
+
+def create_similar_story_index():
+    """Build the reuse tier if it is enabled and scikit-learn is installed"""
+    if not SIMILAR_STORY_REUSE_ENABLED:
+        return None
+    try:
+        return SimilarStoryIndex(
+            threshold=SIMILAR_STORY_THRESHOLD,
+            max_entries=SIMILAR_STORY_MAX_ENTRIES,
+            ttl_seconds=STORY_CACHE_TTL_SECONDS,
+            refit_every=SIMILAR_STORY_REFIT_EVERY
+        )
+    except ImportError:
+        print("WARNING: scikit-learn is not installed, similar-story reuse is disabled")
+        return None
+
+
+similar_story_index = create_similar_story_index()
+
+
+def build_vocabulary_messages(story_text, vocabulary_level="intermediate"):
+    """Build the chat messages asking GPT-4 for the story's vocabulary words"""
+    vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
+    
+    prompt = f"""
+Analyze the following children's story and extract vocabulary words appropriate for {vocab_info['name']} level learning.
+
+Story: {story_text}
+
+Please identify 6-8 vocabulary words from the story that are:
+1. Appropriate for {vocab_info['name']} ({vocab_info['description']})
+2. Educational and useful for children to learn
+3. Not too common (avoid words like "the", "and", "is")
+4. Target complexity: {vocab_info['target_length']}
+
+For each word, provide:
+- The word
+- A simple, child-friendly definition
+- The sentence from the story where it appears
+- A fun example sentence that a child would understand
+
+Format your response as a JSON array like this:
+[
+  {{
+    "word": "example",
+    "definition": "child-friendly definition",
+    "story_sentence": "sentence from the story",
+    "example_sentence": "fun example for kids"
+  }}
+]
+"""
+
+    return [
+        {
+            "role": "system",
+            "content": f"You are an educational content creator specializing in vocabulary development for children at {vocab_info['name']} level. Extract vocabulary words that are educational, age-appropriate, and help expand children's language skills."
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+def parse_vocabulary_reply(vocab_response, story_text, vocabulary_level):
+    """Parse the JSON array of a vocabulary reply, falling back to simple extraction"""
+    try:
+        # Clean the response in case there's extra text
+        json_start = vocab_response.find('[')
+        json_end = vocab_response.rfind(']') + 1
+        if json_start != -1 and json_end != -1:
+            json_str = vocab_response[json_start:json_end]
+            vocabulary_words = json.loads(json_str)
+            return vocabulary_words
+        else:
+            raise ValueError("No JSON array found in response")
+    except (json.JSONDecodeError, ValueError) as e:
+        print(f"Error parsing vocabulary JSON: {e}")
+        # Fallback: create a simple vocabulary list
+        return create_fallback_vocabulary(story_text, vocabulary_level)
+
+
+def extract_vocabulary_words(story_text, vocabulary_level="intermediate"):
+    """Extract vocabulary words from the story and create learning content"""
+    try:
+        messages = build_vocabulary_messages(story_text, vocabulary_level)
+
+        with observe_stage("vocabulary"):
+            response = chat_upstream.call(lambda timeout: get_openai_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=800,
+                temperature=0.3,
+                timeout=timeout
+            ), stage="vocabulary", tokens=estimate_chat_tokens(messages, 800))
+        record_token_usage("vocabulary", vocabulary_level, response.usage)
+        
+        vocab_response = response.choices[0].message.content.strip()
+        print("Vocabulary words extracted successfully!")
+        
+        # Try to parse JSON response
+        return parse_vocabulary_reply(vocab_response, story_text, vocabulary_level)
+            
+    except Exception as e:
+        print(f"Error extracting vocabulary: {str(e)}")
+        return create_fallback_vocabulary(story_text, vocabulary_level)
+
+
+async def extract_vocabulary_words_async(story_text, vocabulary_level="intermediate"):
+    """Coroutine form of extract_vocabulary_words"""
+    try:
+        messages = build_vocabulary_messages(story_text, vocabulary_level)
+        with observe_stage("vocabulary"):
+            response = await chat_upstream.call_async(lambda timeout: get_async_openai_client().chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=800,
+                temperature=0.3,
+                timeout=timeout
+            ), stage="vocabulary", tokens=estimate_chat_tokens(messages, 800))
+        record_token_usage("vocabulary", vocabulary_level, response.usage)
+        return parse_vocabulary_reply(response.choices[0].message.content.strip(), story_text, vocabulary_level)
+    except Exception as e:
+        print(f"Error extracting vocabulary: {str(e)}")
+        return create_fallback_vocabulary(story_text, vocabulary_level)
+
+def create_fallback_vocabulary(story_text, vocabulary_level):
+    """Create a simple fallback vocabulary list if AI extraction fails"""
+    vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
+    
+    # Simple word extraction based on length and common educational words
+    words = re.findall(r'\b[a-zA-Z]{4,}\b', story_text)
+    
+    # Filter and create simple vocabulary
+    common_words = {'that', 'with', 'have', 'this', 'will', 'your', 'from', 'they', 'know', 'want', 'been', 'good', 'much', 'some', 'time', 'very', 'when', 'come', 'here', 'just', 'like', 'long', 'make', 'many', 'over', 'such', 'take', 'than', 'them', 'well', 'were'}
+    
+    filtered_words = [word.lower() for word in words if word.lower() not in common_words and len(word) >= 5]
+    unique_words = list(dict.fromkeys(filtered_words))[:6]  # Remove duplicates and limit to 6
+    
+    fallback_vocab = []
+    for word in unique_words:
+        fallback_vocab.append({
+            "word": word.capitalize(),
+            "definition": f"An important word from our story - look it up together!",
+            "story_sentence": f"This word appears in our story.",
+            "example_sentence": f"Can you use '{word}' in your own sentence?"
+        })
+
+    return fallback_vocab
+
+
+def count_syllables(word):
+    """Estimate the syllables in a word from its vowel groups"""
+    word = word.lower()
+    groups = re.findall(r'[aeiouy]+', word)
+    count = len(groups)
+    if word.endswith('e') and not word.endswith(('le', 'ee')) and count > 1:
+        count -= 1  # silent e: "brave", "explore"
+    if word.endswith(('ed',)) and not word.endswith(('ted', 'ded')) and count > 1:
+        count -= 1  # "jumped", "climbed"
+    return max(1, count)
+
+
+def parse_syllable_range(target_length):
+    """Turn a level's target_length such as "2-3 syllables" or "3+ syllables" into (low, high)"""
+    match = re.match(r'\s*(\d+)\s*(?:-\s*(\d+)|(\+))?', target_length)
+    if not match:
+        return 1, 99
+    low = int(match.group(1))
+    if match.group(3):
+        return low, 99
+    return low, int(match.group(2) or low)
+
+
+class VocabularyEngine:
+    """Pick level-appropriate vocabulary from a story without calling GPT-4.
+
+    Uses a bundled word-frequency list (line order is rank), and a lexicon
+    of child-friendly definitions, example sentences and syllable counts.
+    Words are matched on their base form, filtered by the level's syllable
+    range and ranked by how rare they are relative to the level.
+    """
+
+    MIN_WORDS = 6
+    MAX_WORDS = 8
+    # The most frequent words ("the", "said", "little", ...) are never taught
+    STOP_RANK = 150
+    # Preferred rarity per level: 0 is the most common listed word, 1 the
+    # least common listed word, and unlisted words count as 1.5
+    TARGET_RARITY = {"beginner": 0.4, "intermediate": 1.0, "advanced": 1.5}
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+        self._ranks = None
+        self._lexicon = None
+
+    def _load(self):
+        if self._lexicon is not None:
+            return
+        with self._lock:
+            if self._lexicon is not None:
+                return
+            ranks = {}
+            with open(os.path.join(self.data_dir, 'word_frequency.txt'), encoding='utf-8') as f:
+                for line in f:
+                    word = line.strip().lower()
+                    if word and not word.startswith('#'):
+                        ranks.setdefault(word, len(ranks))
+            lexicon = {}
+            with open(os.path.join(self.data_dir, 'vocabulary_lexicon.tsv'), encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip() or line.startswith('#'):
+                        continue
+                    word, syllables, definition, example = line.rstrip('\n').split('\t')
+                    lexicon[word.lower()] = {
+                        "syllables": int(syllables),
+                        "definition": definition,
+                        "example_sentence": example
+                    }
+            self._ranks = ranks
+            self._lexicon = lexicon
+
+    def base_form(self, word):
+        """Map an inflected word ("wondered", "adventures", "bravely") to a lexicon headword"""
+        self._load()
+        candidates = [word]
+        for suffix, replacements in (('ies', ('y',)), ('ied', ('y',)), ('ily', ('y',)), ('es', ('', 'e')),
+                                     ('s', ('',)), ('ed', ('', 'e')), ('ing', ('', 'e')), ('ly', ('',))):
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                stem = word[:-len(suffix)]
+                candidates.extend(stem + ending for ending in replacements)
+                if len(stem) > 3 and stem[-1] == stem[-2]:
+                    candidates.append(stem[:-1])  # "stopped", "swimming"
+        for candidate in candidates:
+            if candidate in self._lexicon:
+                return candidate
+        return None
+
+    def rarity(self, word):
+        rank = self._ranks.get(word)
+        return 1.5 if rank is None else rank / max(1, len(self._ranks))
+
+    def extract(self, story_text, vocabulary_level="intermediate"):
+        """Return 6-8 vocabulary entries in the same shape as extract_vocabulary_words"""
+        self._load()
+        vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
+        low, high = parse_syllable_range(vocab_info['target_length'])
+        target_rarity = self.TARGET_RARITY.get(vocabulary_level, self.TARGET_RARITY["intermediate"])
+
+        sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', story_text) if s.strip()]
+        lowercase_words = set(re.findall(r'\b[a-z]+\b', story_text))
+
+        candidates = {}
+        for position, token in enumerate(re.findall(r"\b[A-Za-z]+\b", story_text)):
+            word = token.lower()
+            headword = self.base_form(word)
+            key = headword or word
+            if key in candidates or self._ranks.get(key, self.STOP_RANK) < self.STOP_RANK:
+                continue
+            if headword is None and (len(word) < 5 or word in self._ranks or word not in lowercase_words):
+                continue  # short or everyday filler, or a proper name such as "Luna"
+            syllables = self._lexicon[headword]["syllables"] if headword else count_syllables(word)
+            distance = max(0, low - syllables, syllables - high)
+            candidates[key] = (
+                (distance > 0, headword is None, distance, abs(self.rarity(key) - target_rarity), position),
+                word
+            )
+
+        ranked = sorted(candidates.items(), key=lambda item: item[1][0])
+        in_range = sum(1 for _, (score, _) in ranked if not score[0])
+        chosen = ranked[:min(self.MAX_WORDS, max(in_range, self.MIN_WORDS))]
+
+        vocabulary = []
+        for key, (_, form) in sorted(chosen, key=lambda item: item[1][0][-1]):
+            entry = self._lexicon.get(key)
+            pattern = re.compile(rf'\b{re.escape(form)}\b', re.IGNORECASE)
+            story_sentence = next((s for s in sentences if pattern.search(s)), "This word appears in our story.")
+            vocabulary.append({
+                "word": key.capitalize(),
+                "definition": entry["definition"] if entry else "An important word from our story - look it up together!",
+                "story_sentence": story_sentence,
+                "example_sentence": entry["example_sentence"] if entry else f"Can you use '{key}' in your own sentence?"
+            })
+        return vocabulary
+
+
+vocabulary_engine = VocabularyEngine(VOCABULARY_DATA_DIR)
+
+
+def extract_local_vocabulary(story_text, vocabulary_level="intermediate"):
+    """Pick vocabulary with the bundled word data, falling back to the simple list if it is unavailable"""
+    try:
+        with observe_stage("vocabulary"):
+            return vocabulary_engine.extract(story_text, vocabulary_level)
+    except (OSError, ValueError) as e:
+        print(f"Error loading vocabulary data: {e}")
+        return create_fallback_vocabulary(story_text, vocabulary_level)
+
+
+def build_vocabulary(story_text, vocabulary_level, vocabulary_mode=None):
+    """Vocabulary for a story: local by default, GPT-4 enrichment in 'gpt' mode"""
+    if (vocabulary_mode or VOCABULARY_MODE) == 'gpt':
+        return extract_vocabulary_words(story_text, vocabulary_level)
+    return extract_local_vocabulary(story_text, vocabulary_level)
+
+
+async def build_vocabulary_async(story_text, vocabulary_level, vocabulary_mode=None):
+    """Coroutine form of build_vocabulary; local extraction takes milliseconds and runs inline"""
+    if (vocabulary_mode or VOCABULARY_MODE) == 'gpt':
+        return await extract_vocabulary_words_async(story_text, vocabulary_level)
+    return extract_local_vocabulary(story_text, vocabulary_level)
+
+
+def narration_key(text, voice, model=TTS_MODEL, speed=TTS_SPEED):
+    """Audio store id of a narration: the SHA-256 of everything that changes the audio"""
+    return hashlib.sha256(json.dumps([model, voice, speed, text]).encode("utf-8")).hexdigest()
+
+
+class AudioStore:
+    """Content-addressed store for narration MP3s.
+
+    Files are named by the SHA-256 of their bytes, so identical audio is
+    stored once, or by a ``narration_key`` so a narration can be found again
+    without calling TTS. A narration key names the request, not the bytes:
+    once its file is collected, rendering it again can produce different
+    audio under the same id, so ``content_hash`` gives the ETag to serve.
+    When the directory grows past ``max_bytes`` the least recently used
+    files are removed.
+    """
+
+    ARTIFACT_ID = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._collected_files = 0
+        self._inflight = {}
+        self._async_inflight = {}
+        self._content_hashes = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, artifact_id):
+        """Filesystem path of an artifact, or None for a malformed id"""
+        if not self.ARTIFACT_ID.match(artifact_id):
+            return None
+        return os.path.join(self.root, f"{artifact_id}.mp3")
+
+    def put(self, data, artifact_id=None):
+        """Store audio bytes and return their artifact id (the SHA-256 of the bytes unless given)"""
+        spool = self.spool()
+        spool.write(data)
+        return spool.commit(artifact_id)
+
+    def spool(self):
+        """Start writing an artifact piece by piece, without holding it in memory"""
+        return AudioSpool(self)
+
+    def _commit(self, temp_path, digest, artifact_id):
+        path = self.path_for(artifact_id)
+        with self._lock:
+            if os.path.exists(path):
+                os.unlink(temp_path)
+                os.utime(path)
+            else:
+                os.replace(temp_path, path)
+                self._content_hashes[artifact_id] = digest
+            self._collect_garbage(keep=path)
+        return artifact_id
+
+    def content_hash(self, artifact_id, path):
+        """SHA-256 of the bytes stored at ``path``, read from disk only the first time"""
+        with self._lock:
+            digest = self._content_hashes.get(artifact_id)
+        if digest is None:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with self._lock:
+                self._content_hashes[artifact_id] = digest
+        return digest
+
+    def get_path(self, artifact_id):
+        """Path of a stored artifact, marking it recently used, or None if missing"""
+        path = self.path_for(artifact_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get_or_create(self, artifact_id, create):
+        """Return artifact_id, calling create() for its bytes only if it is not stored yet.
+
+        Concurrent callers for the same id wait for a single create() call.
+        """
+        if self.get_path(artifact_id):
+            with self._lock:
+                self._hits += 1
+            return artifact_id
+
+        with self._lock:
+            future = self._inflight.get(artifact_id)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[artifact_id] = future
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            self.put(create(), artifact_id=artifact_id)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[artifact_id]
+        future.set_result(artifact_id)
+        return artifact_id
+
+    async def get_or_create_async(self, artifact_id, create):
+        """Coroutine form of get_or_create; ``create`` is a coroutine function returning the bytes"""
+        if self.get_path(artifact_id):
+            with self._lock:
+                self._hits += 1
+            return artifact_id
+
+        task = self._async_inflight.get(artifact_id)
+        with self._lock:
+            if task is None:
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if task is None:
+            async def render():
+                data = await create()
+                # Writing the file and collecting garbage touch the disk, so keep them off the event loop
+                return await asyncio.to_thread(self.put, data, artifact_id)
+
+            task = asyncio.ensure_future(render())
+            self._async_inflight[artifact_id] = task
+            task.add_done_callback(lambda done: self._async_inflight.pop(artifact_id, None))
+        return await asyncio.shield(task)
+
+    def _collect_garbage(self, keep):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._content_hashes.pop(os.path.basename(path)[:-len(".mp3")], None)
+            total -= size
+            self._collected_files += 1
+
+    def stats(self):
+        """Current size, garbage collection and narration lookup counters"""
+        files = [entry for entry in os.scandir(self.root) if entry.name.endswith(".mp3")]
+        lookups = self._hits + self._misses + self._coalesced
+        return {
+            "files": len(files),
+            "bytes": sum(entry.stat().st_size for entry in files),
+            "maxBytes": self.max_bytes,
+            "collectedFiles": self._collected_files,
+            "hits": self._hits,
+            "misses": self._misses,
+            "coalesced": self._coalesced,
+            "hitRate": round(self._hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class AudioSpool:
+    """Temporary file in the audio store that is hashed as it is written and moved into place on commit"""
+
+    def __init__(self, store):
+        self.store = store
+        self._file = tempfile.NamedTemporaryFile(dir=store.root, delete=False, suffix=".part")
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._file.write(data)
+        self._digest.update(data)
+
+    def commit(self, artifact_id=None):
+        """Store the written bytes and return their artifact id (the SHA-256 of the bytes unless given)"""
+        self._file.close()
+        digest = self._digest.hexdigest()
+        return self.store._commit(self._file.name, digest, artifact_id or digest)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.unlink(self._file.name)
+        except OSError:
+            pass
+
+
+audio_store = AudioStore(AUDIO_STORE_DIR, AUDIO_STORE_MAX_BYTES)
+
+
+def split_narration_text(text, max_chars=None):
+    """Split text into TTS chunks of at most max_chars, breaking at paragraphs, then sentences.
+
+    Consecutive short paragraphs are packed together so a story needs as
+    few calls as possible.
+    """
+    max_chars = max_chars or NARRATION_CHUNK_CHARS
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text.strip()):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            # A single sentence longer than a chunk is cut at word boundaries
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(' ', 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].strip()
+            pieces.append(sentence)
+
+    chunks = []
+    for piece in filter(None, pieces):
+        if chunks and len(chunks[-1]) + len(piece) + 2 <= max_chars:
+            chunks[-1] = f"{chunks[-1]}\n\n{piece}"
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def narration_chunks(text):
+    """TTS inputs for a narration: the whole text unless it is longer than NARRATION_SPLIT_MIN_CHARS"""
+    if len(text) <= min(NARRATION_SPLIT_MIN_CHARS, TTS_MAX_INPUT_CHARS):
+        return [text]
+    return split_narration_text(text)
+
+
+MP3_BITRATES_KBPS = {
+    "mpeg1": (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    "mpeg2": (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def mp3_frame_length(header):
+    """Byte length of the Layer III frame starting with this 4-byte header, or None if it is not one"""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES_KBPS["mpeg1" if version == 3 else "mpeg2"][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+
+def strip_mp3_metadata(data):
+    """Return only the audio frames of an MP3: no ID3v2/ID3v1 tags and no Xing/Info header frame.
+
+    The Xing/Info frame describes the length of one file, so it would give
+    players the wrong duration once chunks are joined.
+    """
+    start, end = 0, len(data)
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        start = 10 + size + (10 if data[5] & 0x10 else 0)
+    if end - start >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    frame_length = mp3_frame_length(data[start:start + 4])
+    if frame_length and any(marker in data[start:start + frame_length] for marker in (b"Xing", b"Info")):
+        start += frame_length
+    return data[start:end]
+
+
+def synthesize_speech(text, voice):
+    """One TTS call for text that fits a single chunk; returns MP3 bytes"""
+    response = tts_upstream.call(lambda timeout: get_openai_client().audio.speech.create(
+        model=TTS_MODEL,
+        voice=voice,    
+        input=text,
+        speed=TTS_SPEED,
+        timeout=timeout
+    ), stage="tts")
+    return response.content
+
+
+def submit_narration_chunks(chunks, voice):
+    """Start synthesizing every chunk on the bounded TTS pool and return the futures in order"""
+    return [submit_with_context(tts_executor, synthesize_speech, chunk, voice) for chunk in chunks]
+
+
+def synthesize_narration(story_text, voice):
+    """MP3 bytes for a whole story, synthesizing long stories chunk by chunk in parallel"""
+    chunks = narration_chunks(story_text)
+    if len(chunks) <= 1:
+        return synthesize_speech(story_text, voice)
+    
+    futures = submit_narration_chunks(chunks, voice)
+    try:
+        return b"".join(strip_mp3_metadata(future.result()) for future in futures)
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def synthesize_speech_async(text, voice):
+    """Coroutine form of synthesize_speech"""
+    response = await tts_upstream.call_async(lambda timeout: get_async_openai_client().audio.speech.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text,
+        speed=TTS_SPEED,
+        timeout=timeout
+    ), stage="tts")
+    return response.content
+
+
+async def synthesize_narration_async(story_text, voice):
+    """Coroutine form of synthesize_narration, with at most NARRATION_PARALLELISM chunks in flight"""
+    chunks = narration_chunks(story_text)
+    if len(chunks) <= 1:
+        return await synthesize_speech_async(story_text, voice)
+    
+    slots = asyncio.Semaphore(NARRATION_PARALLELISM)
+    
+    async def synthesize(chunk):
+        async with slots:
+            return await synthesize_speech_async(chunk, voice)
+    
+    parts = await asyncio.gather(*(synthesize(chunk) for chunk in chunks))
+    return b"".join(strip_mp3_metadata(part) for part in parts)
+
+
+async def generate_audio_narration_async(story_text, voice="nova"):
+    """Coroutine form of generate_audio_narration"""
+    try:
+        with observe_stage("tts"):
+            return await audio_store.get_or_create_async(
+                narration_key(story_text, voice),
+                lambda: synthesize_narration_async(story_text, voice)
+            )
+    except Exception as e:
+        print(f"Error generating audio: {e}")
+        return None
+
+
+def generate_audio_narration(story_text, voice="nova"):
+    """Generate audio narration using OpenAI TTS and return its audio store id.
+
+    Narrations already in the audio store are returned without a TTS call.
+    """
+    try:
+        print("Generating audio narration...")
+        
+        # Create speech using OpenAI TTS
+        with observe_stage("tts"):
+            artifact_id = audio_store.get_or_create(
+                narration_key(story_text, voice),
+                lambda: synthesize_narration(story_text, voice)
+            )
+        
+        print("Audio generated successfully!")
+        return artifact_id
+        
+    except Exception as e:
+        print(f"Error generating audio: {e}")
+        return None
+
+
+class NarrationPrerenderer:
+    """Narrate new stories in one voice in the background so a later request finds the audio stored.
+
+    Work runs in the batch priority lane without a request deadline. At most
+    ``queue_limit`` stories wait; beyond that new ones are skipped.
+    """
+
+    def __init__(self, voice="nova", workers=2, queue_limit=16):
+        self.voice = voice
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="narration-prerender")
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max(0, queue_limit))
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._skipped = 0
+        self._rendered = 0
+        self._failed = 0
+
+    def submit(self, story_text):
+        """Queue a narration unless it is already stored or the queue is full; returns True if queued"""
+        if audio_store.get_path(narration_key(story_text, self.voice)) or not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._skipped += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+        # A fresh context: no request deadline applies to background work
+        self._executor.submit(contextvars.Context().run, self._render, story_text)
+        return True
+
+    def _render(self, story_text):
+        request_priority.set("batch")
+        try:
+            artifact_id = generate_audio_narration(story_text, self.voice)
+        finally:
+            self._slots.release()
+        with self._lock:
+            if artifact_id:
+                self._rendered += 1
+            else:
+                self._failed += 1
+
+    def stats(self):
+        """Queued, skipped, rendered and failed pre-renders"""
+        with self._lock:
+            return {
+                "voice": self.voice,
+                "submitted": self._submitted,
+                "skipped": self._skipped,
+                "rendered": self._rendered,
+                "failed": self._failed
+            }
+
+
+narration_prerenderer = NarrationPrerenderer(
+    voice=NARRATION_PRERENDER_VOICE,
+    workers=NARRATION_PRERENDER_WORKERS,
+    queue_limit=NARRATION_PRERENDER_QUEUE_LIMIT
+) if NARRATION_PRERENDER_ENABLED else None
+
+
+def audio_url(artifact_id):
+    """Public URL of a stored narration"""
+    return f"/audio/{artifact_id}.mp3"
+
+
+def parse_story_request(data):
+    """Validate a story request body and return (params, error message)"""
+    if not data:
+        return None, "No data provided"
+    
+    params = {
+        "image_description": data.get('imageDescription', ''),
+        "keywords": data.get('keywords', ''),
+        "story_length": data.get('storyLength', 'short'),
+        "vocabulary_level": data.get('vocabularyLevel', 'intermediate'),
+        "generate_audio": data.get('generateAudio', False),
+        "voice": data.get('voice', 'nova'),
+        "audio_delivery": data.get('audioDelivery', 'url'),
+        "vocabulary_mode": data.get('vocabularyMode', VOCABULARY_MODE)
+    }
+    
+    if not params["image_description"]:
+        return None, "Image description is required"
+    
+    if not params["keywords"]:
+        return None, "Keywords are required"
+    
+    if params["vocabulary_mode"] not in VOCABULARY_MODES:
+        return None, f"vocabularyMode must be one of: {', '.join(VOCABULARY_MODES)}"
+    
+    return params, None
+
+
+def has_exact_story(params, cache_key):
+    """True if the exact story cache will answer this request, so the similarity tier is not needed"""
+    if story_cache is None:
+        return False
+    if params["vocabulary_mode"] == 'gpt' and STORY_GENERATION_MODE == 'combined' and story_cache.contains(cache_key + ("combined",)):
+        return True
+    return story_cache.contains(cache_key)
+
+
+def run_story_pipeline(params, deadline, on_stage=None):
+    """Run story, then vocabulary and narration in parallel, and build the response.
+
+    ``on_stage(stage, state)`` is called as each stage starts and finishes.
+    Upstream calls in every stage are budgeted against ``deadline``.
+    Returns ``(response_data, status_code)``.
+    """
+    token = request_deadline.set(deadline)
+    try:
+        return _run_story_pipeline(params, deadline, on_stage)
+    finally:
+        request_deadline.reset(token)
+
+
+def _run_story_pipeline(params, deadline, on_stage):
+    report = on_stage or (lambda stage, state: None)
+    image_description = params["image_description"]
+    keywords = params["keywords"]
+    story_length = params["story_length"]
+    vocabulary_level = params["vocabulary_level"]
+    generate_audio = params["generate_audio"]
+    voice = params["voice"]
+    
+    # Generate the story with vocabulary level consideration
+    report("story", "running")
+    cache_key = story_cache_key(image_description, keywords, story_length, vocabulary_level)
+    story = vocabulary_words = None
+    if similar_story_index and not has_exact_story(params, cache_key):
+        story, _ = similar_story_index.lookup(cache_key)
+    reused = story is not None
+    
+    if not reused and params["vocabulary_mode"] == 'gpt' and STORY_GENERATION_MODE == 'combined':
+        # One completion returns story and vocabulary; a reply that does not
+        # parse falls through to the separate story and vocabulary calls
+        compute = lambda: generate_story_with_vocabulary(image_description, keywords, story_length, vocabulary_level)
+        if story_cache:
+            result = story_cache.get_or_compute(cache_key + ("combined",), compute, cacheable=lambda result: result is not None)
+        else:
+            result = compute()
+        if result is not None:
+            story, vocabulary_words = result
+    
+    if story is None:
+        if story_cache:
+            story = story_cache.get_or_compute(
+                cache_key,
+                lambda: generate_story(image_description, keywords, story_length, vocabulary_level),
+                cacheable=lambda result: not is_story_failure(result)
+            )
+        else:
+            story = generate_story(image_description, keywords, story_length, vocabulary_level)
+    
+    if story.startswith("Error:"):
+        report("story", "failed")
+        return {"error": story}, 500
+    if similar_story_index and not reused and not is_story_failure(story):
+        similar_story_index.add(cache_key, story)
+    report("story", "completed")
+    if narration_prerenderer and not (generate_audio and voice == narration_prerenderer.voice):
+        narration_prerenderer.submit(story)
+    
+    # Vocabulary and narration only depend on the story, so run them side by side
+    if vocabulary_words is None:
+        report("vocabulary", "running")
+        vocab_future = submit_with_context(pipeline_executor, build_vocabulary, story, vocabulary_level, params["vocabulary_mode"])
+        vocab_future.add_done_callback(lambda f: report("vocabulary", "completed"))
+    else:
+        vocab_future = Future()
+        vocab_future.set_result(vocabulary_words)
+        report("vocabulary", "completed")
+    audio_future = None
+    if generate_audio:
+        report("audio", "running")
+        TTS_CHARACTERS.labels(level_label(vocabulary_level)).inc(len(story))
+        audio_future = submit_with_context(pipeline_executor, generate_audio_narration, story, voice)
+        audio_future.add_done_callback(lambda f: report("audio", "completed" if not f.exception() and f.result() else "failed"))
+    wait([f for f in (vocab_future, audio_future) if f], timeout=max(0.0, deadline - time.monotonic()))
+    
+    # Extract vocabulary words from the story
+    if vocab_future.done() and not vocab_future.exception():
+        vocabulary_words = vocab_future.result()
+    else:
+        print("Vocabulary extraction missed the request deadline, using fallback")
+        vocabulary_words = create_fallback_vocabulary(story, vocabulary_level)
+    
+    artifact_id = audio_error = None
+    if generate_audio:
+        if audio_future.done():
+            artifact_id = None if audio_future.exception() else audio_future.result()
+            audio_error = "Failed to generate audio"
+        else:
+            # Late narration still lands in the audio store and is collected from there
+            print("Audio narration missed the request deadline")
+            audio_error = "Audio generation timed out"
+    
+    return build_story_response(params, story, vocabulary_words, artifact_id, audio_error), 200
+
+
+def build_story_response(params, story, vocabulary_words, artifact_id=None, audio_error=None):
+    """The /generate-story response body for a finished pipeline"""
+    voice = params["voice"]
+    response_data = {
+        "success": True,
+        "story": story,
+        "imageDescription": params["image_description"],
+        "keywords": params["keywords"],
+        "vocabularyLevel": params["vocabulary_level"],
+        "vocabularyWords": vocabulary_words,
+        "model": "GPT-4"
+    }
+    
+    # Generate audio if requested
+    if params["generate_audio"]:
+        if artifact_id:
+            response_data.update({
+                "audioGenerated": True,
+                "audioUrl": audio_url(artifact_id),
+                "voice": voice
+            })
+            
+            # Legacy clients can still ask for the audio inlined as a data URI
+            if params["audio_delivery"] == 'inline':
+                with observe_stage("base64"), open(audio_store.path_for(artifact_id), 'rb') as audio_file:
+                    audio_base64 = base64.b64encode(audio_file.read()).decode('utf-8')
+                response_data["audioData"] = f"data:audio/mp3;base64,{audio_base64}"
+        else:
+            response_data.update({
+                "audioGenerated": False,
+                "audioError": audio_error
+            })
+    
+    return response_data
+
+
+async def run_story_pipeline_async(params, deadline):
+    """Coroutine form of run_story_pipeline for the ASGI server.
+
+    Upstream waits cost a coroutine instead of a thread; stage progress is
+    not reported because no job or stream observes it.
+    """
+    token = request_deadline.set(deadline)
+    try:
+        return await _run_story_pipeline_async(params, deadline)
+    finally:
+        request_deadline.reset(token)
+
+
+async def _run_story_pipeline_async(params, deadline):
+    image_description = params["image_description"]
+    keywords = params["keywords"]
+    story_length = params["story_length"]
+    vocabulary_level = params["vocabulary_level"]
+    voice = params["voice"]
+    
+    cache_key = story_cache_key(image_description, keywords, story_length, vocabulary_level)
+    story = vocabulary_words = None
+    if similar_story_index and not has_exact_story(params, cache_key):
+        # TF-IDF lookups are CPU work, so keep them off the event loop
+        story, _ = await asyncio.to_thread(similar_story_index.lookup, cache_key)
+    reused = story is not None
+    
+    if not reused and params["vocabulary_mode"] == 'gpt' and STORY_GENERATION_MODE == 'combined':
+        compute = lambda: generate_story_with_vocabulary_async(image_description, keywords, story_length, vocabulary_level)
+        if story_cache:
+            result = await story_cache.get_or_compute_async(cache_key + ("combined",), compute, cacheable=lambda result: result is not None)
+        else:
+            result = await compute()
+        if result is not None:
+            story, vocabulary_words = result
+    
+    if story is None:
+        compute = lambda: generate_story_async(image_description, keywords, story_length, vocabulary_level)
+        if story_cache:
+            story = await story_cache.get_or_compute_async(cache_key, compute, cacheable=lambda result: not is_story_failure(result))
+        else:
+            story = await compute()
+    
+    if story.startswith("Error:"):
+        return {"error": story}, 500
+    if similar_story_index and not reused and not is_story_failure(story):
+        await asyncio.to_thread(similar_story_index.add, cache_key, story)
+    if narration_prerenderer and not (params["generate_audio"] and voice == narration_prerenderer.voice):
+        narration_prerenderer.submit(story)
+    
+    # Vocabulary and narration only depend on the story, so run them side by side
+    if vocabulary_words is None:
+        vocab_task = asyncio.ensure_future(build_vocabulary_async(story, vocabulary_level, params["vocabulary_mode"]))
+    else:
+        vocab_task = asyncio.get_running_loop().create_future()
+        vocab_task.set_result(vocabulary_words)
+    audio_task = None
+    if params["generate_audio"]:
+        TTS_CHARACTERS.labels(level_label(vocabulary_level)).inc(len(story))
+        audio_task = asyncio.ensure_future(generate_audio_narration_async(story, voice))
+    await asyncio.wait([t for t in (vocab_task, audio_task) if t], timeout=max(0.0, deadline - time.monotonic()))
+    
+    if vocab_task.done() and not vocab_task.exception():
+        vocabulary_words = vocab_task.result()
+    else:
+        print("Vocabulary extraction missed the request deadline, using fallback")
+        vocab_task.cancel()
+        vocabulary_words = create_fallback_vocabulary(story, vocabulary_level)
+    
+    artifact_id = audio_error = None
+    if audio_task:
+        if audio_task.done():
+            artifact_id = None if audio_task.exception() else audio_task.result()
+            audio_error = "Failed to generate audio"
+        else:
+            # Left running: the narration still lands in the audio store
+            print("Audio narration missed the request deadline")
+            audio_error = "Audio generation timed out"
+    
+    if params["audio_delivery"] == 'inline' and artifact_id:
+        # Inlining reads the MP3 from disk
+        return await asyncio.to_thread(build_story_response, params, story, vocabulary_words, artifact_id, audio_error), 200
+    return build_story_response(params, story, vocabulary_words, artifact_id, audio_error), 200
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue has no room for another pipeline"""
+
+
+class JobManager:
+    """Run story pipelines as background jobs on a bounded worker pool.
 
-def generate_story(image_description, keywords, story_length="short", vocabulary_level="intermediate"):
-    """Generate a story using GPT-4"""
+    At most ``workers`` jobs run at once and at most ``queue_limit`` more wait;
+    beyond that ``submit`` raises JobQueueFull so callers can shed load.
+    Finished jobs are kept for ``result_ttl`` seconds for polling.
+    """
 
-    try:
-        # Debug: Print API key status
-        api_key = os.getenv('OPENAI_API_KEY')
-        print(f"API Key exists: {api_key is not None}")
-        print(f"API Key starts with 'sk-': {api_key.startswith('sk-') if api_key else False}")
+    def __init__(self, workers=4, queue_limit=32, result_ttl=900.0):
+        self.workers = max(1, workers)
+        self.queue_limit = max(0, queue_limit)
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="story-job")
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._queued = 0
+        self._running = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, params):
+        """Queue a pipeline run and return its job id"""
+        if not self._slots.acquire(blocking=False):
+            with self._cond:
+                self._rejected += 1
+            raise JobQueueFull()
         
-        if not api_key:
-            return "Error: OpenAI API key not found in environment variables."
+        job_id = uuid.uuid4().hex
+        stages = {"story": "pending", "vocabulary": "pending"}
+        if params["generate_audio"]:
+            stages["audio"] = "pending"
         
-        if not api_key.startswith('sk-'):
-            return "Error: OpenAI API key format is incorrect. It should start with 'sk-'."
+        with self._cond:
+            self._prune()
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "stages": stages,
+                "createdAt": time.time(),
+                "finishedAt": None,
+                "result": None,
+                "error": None,
+                "version": 0
+            }
+            self._queued += 1
+            self._submitted += 1
         
-        # Get vocabulary level info
-        vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
-    
-        # Create a detailed prompt
-        if story_length == "short":
-            length_instruction = "Write a short children's story (2-3 paragraphs)"
-            max_tokens = 400
-        else:
-            length_instruction = "Write a detailed children's story (4-5 paragraphs)"
-            max_tokens = 800
+        self._executor.submit(self._run, job_id, params)
+        return job_id
+
+    def _update(self, job_id, **changes):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            stages = changes.pop("stages", None)
+            if stages:
+                job["stages"].update(stages)
+            job.update(changes)
+            job["version"] += 1
+            self._cond.notify_all()
+
+    def _run(self, job_id, params):
+        with self._cond:
+            self._queued -= 1
+            self._running += 1
+        self._update(job_id, status="running")
         
-        prompt = f"""
-{length_instruction} based on the following:
+        try:
+            deadline = time.monotonic() + STORY_REQUEST_DEADLINE_SECONDS
+            result, status_code = run_story_pipeline(
+                params,
+                deadline,
+                on_stage=lambda stage, state: self._update(job_id, stages={stage: state})
+            )
+            if status_code == 200:
+                self._update(job_id, status="completed", result=result, finishedAt=time.time())
+            else:
+                self._update(job_id, status="failed", error=result.get("error"), finishedAt=time.time())
+        except Exception as e:
+            print(f"Error running story job {job_id}: {str(e)}")
+            self._update(job_id, status="failed", error=f"Failed to generate story: {str(e)}", finishedAt=time.time())
+        finally:
+            with self._cond:
+                self._running -= 1
+                if self._jobs[job_id]["status"] == "completed":
+                    self._completed += 1
+                else:
+                    self._failed += 1
+            self._slots.release()
 
-Image Description: {image_description}
-Story Theme/Keywords: {keywords}
-Vocabulary Level: {vocab_info['name']} - {vocab_info['description']}
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finishedAt"] is not None and job["finishedAt"] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
 
-Requirements:
-- Make it educational and age-appropriate for children (ages 5-10)
-- Include a clear moral lesson about: {keywords}
-- Use vocabulary appropriate for {vocab_info['name']} level
-- Target word complexity: {vocab_info['target_length']}
-- Make the characters from the image description the main characters
-- Include dialogue to make it more engaging
-- End with a positive message
-- Incorporate some educational vocabulary words that children can learn
+    def get(self, job_id):
+        """Snapshot of a job, or None if unknown or expired"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, stages=dict(job["stages"]))
 
-Please write a complete, engaging children's story now:
-"""
+    def wait_for_update(self, job_id, version, timeout):
+        """Block until the job changes past ``version`` or timeout, then return a snapshot"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: job_id not in self._jobs or self._jobs[job_id]["version"] > version,
+                timeout=timeout
+            )
+        return self.get(job_id)
 
-        response = client.chat.completions.create(
-            model="gpt-4",  # You can also try "gpt-3.5-turbo" if GPT-4 isn't available
-            messages=[
-                {
-                    "role": "system", 
-                    "content": f"You are a creative children's story writer who specializes in educational stories that teach important life lessons. Write engaging, age-appropriate stories for {vocab_info['name']} that are both fun and educational, using vocabulary appropriate for that age group."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            max_tokens=max_tokens,
-            temperature=0.7,
-            top_p=0.9
-        )
-        
-        story = response.choices[0].message.content.strip()
-        print("Story generated successfully!")
-        return story
-        
-    except Exception as e:
-        print(f"Error with GPT-4: {str(e)}")
-        # Fallback to a simple response if GPT-4 fails
-        return f"I'd love to tell you a story about {keywords} featuring {image_description}, but I'm having trouble connecting to my storytelling service right now. Please try again!"
+    def stats(self):
+        """Queue depth, worker utilization and job counters"""
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queueLimit": self.queue_limit,
+                "queueDepth": self._queued,
+                "running": self._running,
+                "utilization": self._running / self.workers,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "failed": self._failed
+            }
 
-def extract_vocabulary_words(story_text, vocabulary_level="intermediate"):
-    """Extract vocabulary words from the story and create learning content"""
-    try:
-        vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
-        
-        prompt = f"""
-Analyze the following children's story and extract vocabulary words appropriate for {vocab_info['name']} level learning.
 
-Story: {story_text}
+job_manager = JobManager(workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, result_ttl=JOB_RESULT_TTL_SECONDS)
 
-Please identify 6-8 vocabulary words from the story that are:
-1. Appropriate for {vocab_info['name']} ({vocab_info['description']})
-2. Educational and useful for children to learn
-3. Not too common (avoid words like "the", "and", "is")
-4. Target complexity: {vocab_info['target_length']}
 
-For each word, provide:
-- The word
-- A simple, child-friendly definition
-- The sentence from the story where it appears
-- A fun example sentence that a child would understand
+def metrics_endpoint_label():
+    """Route pattern of the current request, so ids in URLs do not explode label cardinality"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
 
-Format your response as a JSON array like this:
-[
-  {{
-    "word": "example",
-    "definition": "child-friendly definition",
-    "story_sentence": "sentence from the story",
-    "example_sentence": "fun example for kids"
-  }}
-]
-"""
 
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": f"You are an educational content creator specializing in vocabulary development for children at {vocab_info['name']} level. Extract vocabulary words that are educational, age-appropriate, and help expand children's language skills."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            max_tokens=800,
-            temperature=0.3
-        )
-        
-        vocab_response = response.choices[0].message.content.strip()
-        print("Vocabulary words extracted successfully!")
-        
-        # Try to parse JSON response
-        
-        try:
-            # Clean the response in case there's extra text
-            json_start = vocab_response.find('[')
-            json_end = vocab_response.rfind(']') + 1
-            if json_start != -1 and json_end != -1:
-                json_str = vocab_response[json_start:json_end]
-                vocabulary_words = json.loads(json_str)
-                return vocabulary_words
-            else:
-                raise ValueError("No JSON array found in response")
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"Error parsing vocabulary JSON: {e}")
-            # Fallback: create a simple vocabulary list
-            return create_fallback_vocabulary(story_text, vocabulary_level)
-            
-    except Exception as e:
-        print(f"Error extracting vocabulary: {str(e)}")
-        return create_fallback_vocabulary(story_text, vocabulary_level)
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(metrics_endpoint_label()).inc()
 
-def create_fallback_vocabulary(story_text, vocabulary_level):
-    """Create a simple fallback vocabulary list if AI extraction fails"""
-    vocab_info = VOCABULARY_LEVELS.get(vocabulary_level, VOCABULARY_LEVELS["intermediate"])
-    
-    # Simple word extraction based on length and common educational words
-    words = re.findall(r'\b[a-zA-Z]{4,}\b', story_text)
-    
-    # Filter and create simple vocabulary
-    common_words = {'that', 'with', 'have', 'this', 'will', 'your', 'from', 'they', 'know', 'want', 'been', 'good', 'much', 'some', 'time', 'very', 'when', 'come', 'here', 'just', 'like', 'long', 'make', 'many', 'over', 'such', 'take', 'than', 'them', 'well', 'were'}
-    
-    filtered_words = [word.lower() for word in words if word.lower() not in common_words and len(word) >= 5]
-    unique_words = list(dict.fromkeys(filtered_words))[:6]  # Remove duplicates and limit to 6
-    
-    fallback_vocab = []
-    for word in unique_words:
-        fallback_vocab.append({
-            "word": word.capitalize(),
-            "definition": f"An important word from our story - look it up together!",
-            "story_sentence": f"This word appears in our story.",
-            "example_sentence": f"Can you use '{word}' in your own sentence?"
-        })
-    
-    return fallback_vocab
 
+@app.before_request
+def start_request_trace():
+    if TRACE_ENABLED:
+        g.trace = start_trace(metrics_endpoint_label(), request.method, request.headers.get("X-Request-ID"))
+        request_trace.set(g.trace)
 
-def generate_audio_narration(story_text, voice="nova"):
-    """Generate audio narration using OpenAI TTS"""
-    try:
-        print("Generating audio narration...")
-        
-        # Create speech using OpenAI TTS
-        response = client.audio.speech.create(
-            model="tts-1",  
-            voice=voice,    
-            input=story_text,
-            speed=0.9       # Slightly slower for children
+
+def keep_trace_current(trace, body):
+    """Make a streamed body's trace current while it is produced, so its spans are recorded"""
+    request_trace.set(trace)
+    yield from body
+
+
+def finish_streamed_trace(trace, status):
+    finish_trace(trace, status)
+    request_trace.set(None)
+
+
+@app.after_request
+def attach_request_id(response):
+    trace = g.get('trace')
+    if trace is not None:
+        response.headers["X-Request-ID"] = trace.trace_id
+        g.response_status = response.status_code
+        if response.is_streamed and not response.direct_passthrough:
+            # The work happens while the body streams, so the trace ends when the response closes
+            g.pop('trace')
+            response.response = keep_trace_current(trace, response.response)
+            response.call_on_close(lambda: finish_streamed_trace(trace, response.status_code))
+    return response
+
+
+@app.teardown_request
+def finish_request_trace(exc):
+    # Streamed responses tear down again after their last event; only the first call logs
+    trace = g.pop('trace', None)
+    if trace is not None:
+        finish_trace(trace, 500 if exc else g.get('response_status', 500))
+        # Worker threads are reused, so do not leave this trace behind for the next request
+        request_trace.set(None)
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        REQUEST_LATENCY.labels(metrics_endpoint_label(), request.method, str(response.status_code)).observe(
+            time.perf_counter() - started
         )
-        
-        # Create a temporary file to store the audio
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        temp_file.write(response.content)
-        temp_file.close()
-        
-        print("Audio generated successfully!")
-        return temp_file.name
-        
-    except Exception as e:
-        print(f"Error generating audio: {e}")
-        return None
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Streamed responses tear down twice; the popped flag makes only the first call count
+    if g.pop('request_started', None) is not None:
+        REQUESTS_IN_FLIGHT.labels(metrics_endpoint_label()).dec()
+        uploads = getattr(request, "uploads", None)
+        if uploads:
+            for upload in uploads:
+                UPLOAD_BYTES.observe(upload.received)
+            upload_stats.record_request(uploads)
+
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return jsonify({"error": e.description}), e.code
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    upload_stats.record_rejection("too_many_bytes")
+    return jsonify({"error": f"Request body must be at most {request.max_content_length} bytes"}), 413
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics: per-stage and per-endpoint latency, in-flight gauges and usage counters"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # Several worker processes: aggregate what each one wrote to the shared directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
 
 @app.route('/health', methods=['GET'])
@@ -275,6 +3716,43 @@ def health_check():
     })
 
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: 200 once the captioning model is loaded, 503 while it loads"""
+    if caption_server_client is not None:
+        status = caption_server_client.status()
+        ready = bool(status and status["ready"])
+        model = status["model"] if status else {"status": "unreachable", "socket": CAPTION_SERVER_SOCKET}
+    else:
+        ready = is_captioner_ready()
+        model = dict(model_state, engine=CAPTION_ENGINE)
+    
+    return jsonify({
+        "ready": ready,
+        "model": model
+    }), 200 if ready else 503
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Runtime performance statistics used to tune batching and caching"""
+    return jsonify({
+        "success": True,
+        "captionBatcher": caption_batcher.stats(),
+        "captionCache": caption_cache.stats() if caption_cache else None,
+        "storyCache": story_cache.stats() if story_cache else None,
+        "similarStories": similar_story_index.stats() if similar_story_index else None,
+        "audioStore": audio_store.stats(),
+        "narrationPrerender": narration_prerenderer.stats() if narration_prerenderer else None,
+        "jobs": job_manager.stats(),
+        "imageDecode": image_decode_stats.stats(),
+        "uploads": upload_stats.stats(),
+        "upstream": {"chat": chat_upstream.stats(), "tts": tts_upstream.stats()},
+        "quota": {"chat": chat_scheduler.stats(), "tts": tts_scheduler.stats()},
+        "traces": trace_log.stats() if trace_log else None
+    })
+
+
 @app.route('/vocabulary-levels', methods=['GET'])
 def get_vocabulary_levels():
     """Get available vocabulary difficulty levels"""
@@ -301,17 +3779,42 @@ def process_image():
             return jsonify({"error": "File must be an image"}), 400
         
         # Load and process image
-        image = Image.open(file.stream).convert("RGB")
+        try:
+            with observe_stage("decode"):
+                image = decode_upload_image(file.stream)
+        except UnidentifiedImageError:
+            return jsonify({"error": "File must be an image"}), 400
+        except ImageTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+
+        # Reuse the caption of a perceptually identical upload if we have one
+        cache_key = perceptual_hash(image) if caption_cache else None
+        caption = caption_cache.get(cache_key) if caption_cache else None
+        cached = caption is not None
 
         # Generate caption
-        caption = generate_image_caption(image)
-        
+        if not cached:
+            try:
+                with observe_stage("caption"):
+                    caption = generate_image_caption(image)
+            except ModelNotReady as e:
+                response = jsonify({"error": str(e), "modelStatus": model_state["status"]})
+                response.headers["Retry-After"] = str(MODEL_RETRY_AFTER_SECONDS)
+                return response, 503
+            except CaptionTimeout as e:
+                return jsonify({"error": str(e)}), 504
+            if caption_cache:
+                caption_cache.put(cache_key, caption)
         
         return jsonify({
             "success": True,
-            "caption": caption
+            "caption": caption,
+            "cached": cached
         })
         
+    except HTTPException:
+        # Oversized or non-image uploads rejected while the body streamed in
+        raise
     except Exception as e:
         print(f"Error processing image: {str(e)}")
         return jsonify({"error": f"Failed to process image: {str(e)}"}), 500
@@ -321,94 +3824,562 @@ def process_image():
 def generate_story_endpoint():
     """Generate a story with vocabulary learning and optionally create audio narration"""
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-        
-        image_description = data.get('imageDescription', '')
-        keywords = data.get('keywords', '')
-        story_length = data.get('storyLength', 'short')
-        vocabulary_level = data.get('vocabularyLevel', 'intermediate')
-        generate_audio = data.get('generateAudio', False)
-        voice = data.get('voice', 'nova')
-        
-        if not image_description:
-            return jsonify({"error": "Image description is required"}), 400
-        
-        if not keywords:
-            return jsonify({"error": "Keywords are required"}), 400
+        deadline = time.monotonic() + STORY_REQUEST_DEADLINE_SECONDS
+        params, error = parse_story_request(request.get_json())
+        if error:
+            return jsonify({"error": error}), 400
         
-        # Generate the story with vocabulary level consideration
-        story = generate_story(image_description, keywords, story_length, vocabulary_level)
+        response_data, status_code = run_story_pipeline(params, deadline)
+        return jsonify(response_data), status_code
         
-        if story.startswith("Error:"):
-            return jsonify({"error": story}), 500
+    except Exception as e:
+        print(f"Error generating story: {str(e)}")
+        return jsonify({"error": f"Failed to generate story: {str(e)}"}), 500
+    
+
+def format_sse(event, data):
+    """Encode one Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/generate-story/stream', methods=['POST'])
+def generate_story_stream_endpoint():
+    """Stream the story over Server-Sent Events as GPT-4 writes it.
+
+    Emits ``token`` events with text fragments, then a ``done`` event carrying
+    the full story, vocabulary list and metadata (or an ``error`` event).
+    """
+    params, error = parse_story_request(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    image_description = params["image_description"]
+    keywords = params["keywords"]
+    story_length = params["story_length"]
+    vocabulary_level = params["vocabulary_level"]
+    
+    key_error = check_openai_api_key()
+    if key_error:
+        return jsonify({"error": key_error}), 500
+    
+    cache_key = story_cache_key(image_description, keywords, story_length, vocabulary_level)
+
+    def events():
+        story = story_cache.get(cache_key) if story_cache else None
+        if story is None and similar_story_index:
+            story, _ = similar_story_index.lookup(cache_key)
+        cached = story is not None
         
-        # Extract vocabulary words from the story
-        vocabulary_words = extract_vocabulary_words(story, vocabulary_level)
+        if cached:
+            yield format_sse("token", {"text": story})
+        else:
+            messages, max_tokens = build_story_messages(image_description, keywords, story_length, vocabulary_level)
+            parts = []
+            try:
+                with observe_stage("story"):
+                    # Streams are not hedged: a duplicate could not be merged into tokens already sent
+                    stream = chat_upstream.call(lambda timeout: get_openai_client().chat.completions.create(
+                        model="gpt-4",
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=0.7,
+                        top_p=0.9,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                        timeout=timeout
+                    ), stage="story", hedge=False, tokens=estimate_chat_tokens(messages, max_tokens))
+                    for chunk in stream:
+                        if not chunk.choices:
+                            # The final chunk carries token usage and no choices
+                            record_token_usage("story", vocabulary_level, getattr(chunk, "usage", None))
+                            continue
+                        text = chunk.choices[0].delta.content
+                        if text:
+                            parts.append(text)
+                            yield format_sse("token", {"text": text})
+            except Exception as e:
+                print(f"Error streaming story from GPT-4: {str(e)}")
+                yield format_sse("error", {"error": "Failed to generate story, please try again"})
+                return
+            
+            story = "".join(parts).strip()
+            if not story:
+                yield format_sse("error", {"error": "Failed to generate story, please try again"})
+                return
+            print("Story streamed successfully!")
+            if story_cache:
+                story_cache.put(cache_key, story)
+            if similar_story_index:
+                similar_story_index.add(cache_key, story)
         
-        response_data = {
+        yield format_sse("done", {
             "success": True,
             "story": story,
             "imageDescription": image_description,
             "keywords": keywords,
             "vocabularyLevel": vocabulary_level,
-            "vocabularyWords": vocabulary_words,
-            "model": "GPT-4"
-        }
-        
-        # Generate audio if requested
-        if generate_audio:
-            audio_file_path = generate_audio_narration(story, voice)
-            if audio_file_path:
-                # Convert audio to base64 for embedding in response
-                with open(audio_file_path, 'rb') as audio_file:
-                    audio_content = audio_file.read()
-                    audio_base64 = base64.b64encode(audio_content).decode('utf-8')
-                
-                response_data.update({
-                    "audioGenerated": True,
-                    "audioData": f"data:audio/mp3;base64,{audio_base64}",
-                    "voice": voice
-                })
-                
-                # Clean up temp file
-                os.unlink(audio_file_path)
-            else:
-                response_data.update({
-                    "audioGenerated": False,
-                    "audioError": "Failed to generate audio"
-                })
-        
-        return jsonify(response_data)
-        
+            "vocabularyWords": build_vocabulary(story, vocabulary_level, params["vocabulary_mode"]),
+            "model": "GPT-4",
+            "cached": cached
+        })
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route('/narrate', methods=['GET', 'POST'])
+def narrate_endpoint():
+    """Stream TTS narration to the client as audio/mpeg chunks while it is synthesized.
+
+    Accepts ``text`` and ``voice`` as JSON (POST) or query parameters (GET, so
+    the URL can be used directly as an ``<audio>`` source).
+    """
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    data = data or {}
+    text = data.get('text', '')
+    voice = data.get('voice', 'nova')
+    
+    if not text:
+        return jsonify({"error": "Text is required"}), 400
+    
+    if len(text) > NARRATION_MAX_CHARS:
+        return jsonify({"error": f"Text must be at most {NARRATION_MAX_CHARS} characters"}), 400
+    
+    if voice not in {v["id"] for v in AVAILABLE_VOICES}:
+        return jsonify({"error": f"Unknown voice: {voice}"}), 400
+    
+    # Replays of a narration that is already stored need no TTS call
+    artifact_id = narration_key(text, voice)
+    path = audio_store.get_path(artifact_id)
+    if path:
+        return send_file(path, mimetype="audio/mpeg", conditional=True,
+                         etag=audio_store.content_hash(artifact_id, path))
+    
+    TTS_CHARACTERS.labels(level_label(data.get('vocabularyLevel', 'none'))).inc(len(text))
+    
+    chunks = narration_chunks(text)
+    if len(chunks) > 1:
+        return narrate_in_chunks(chunks, voice, artifact_id)
+    
+    # Open the upstream response before answering so failures still get an error status
+    stack = ExitStack()
+    try:
+        upstream = tts_upstream.call(lambda timeout: stack.enter_context(
+            get_openai_client().audio.speech.with_streaming_response.create(
+                model=TTS_MODEL,
+                voice=voice,
+                input=text,
+                speed=TTS_SPEED,
+                response_format="mp3",
+                timeout=timeout
+            )
+        ), stage="tts", hedge=False)
     except Exception as e:
-        print(f"Error generating story: {str(e)}")
-        return jsonify({"error": f"Failed to generate story: {str(e)}"}), 500
+        stack.close()
+        print(f"Error starting audio stream: {e}")
+        return jsonify({"error": "Failed to generate audio"}), 502
+    
+    def audio_chunks():
+        # Keep the complete narration on disk, not in memory, so the next replay is served from the store
+        spool = audio_store.spool()
+        try:
+            for chunk in upstream.iter_bytes(chunk_size=NARRATION_STREAM_CHUNK_BYTES):
+                spool.write(chunk)
+                yield chunk
+            spool.commit(artifact_id)
+        except Exception as e:
+            print(f"Error streaming audio: {e}")
+        finally:
+            spool.discard()
+            stack.close()
+    
+    return Response(
+        audio_chunks(),
+        mimetype="audio/mpeg",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+
+def narrate_in_chunks(chunks, voice, artifact_id):
+    """Synthesize chunks in parallel and relay each one, in order, as soon as it is ready"""
+    futures = submit_narration_chunks(chunks, voice)
+    
+    # Wait for the first chunk before answering so failures still get an error status
+    try:
+        first = strip_mp3_metadata(futures[0].result())
+    except Exception as e:
+        for future in futures:
+            future.cancel()
+        print(f"Error starting chunked audio: {e}")
+        return jsonify({"error": "Failed to generate audio"}), 502
+    
+    def audio_chunks():
+        spool = audio_store.spool()
+        try:
+            spool.write(first)
+            yield first
+            for future in futures[1:]:
+                chunk = strip_mp3_metadata(future.result())
+                spool.write(chunk)
+                yield chunk
+            spool.commit(artifact_id)
+        except Exception as e:
+            print(f"Error streaming audio: {e}")
+        finally:
+            spool.discard()
+            for future in futures:
+                future.cancel()
+    
+    return Response(
+        audio_chunks(),
+        mimetype="audio/mpeg",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route('/audio/<artifact_id>.mp3', methods=['GET'])
+def get_audio(artifact_id):
+    """Serve a stored narration with Range, ETag and long-lived cache support"""
+    path = audio_store.get_path(artifact_id)
+    if not path:
+        return jsonify({"error": "Audio not found"}), 404
+    
+    etag = audio_store.content_hash(artifact_id, path)
+    response = send_file(
+        path,
+        mimetype="audio/mpeg",
+        conditional=True,
+        etag=etag,
+        max_age=AUDIO_CACHE_MAX_AGE_SECONDS
+    )
+    # Only ids that hash the bytes themselves can never change; narration keys may be re-rendered
+    immutable = ", immutable" if etag == artifact_id else ""
+    response.headers["Cache-Control"] = f"public, max-age={AUDIO_CACHE_MAX_AGE_SECONDS}{immutable}"
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue a /generate-story pipeline as a background job and return its id"""
+    params, error = parse_story_request(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+    
+    try:
+        job_id = job_manager.submit(params)
+    except JobQueueFull:
+        response = jsonify({"error": "Too many stories in progress, please retry shortly"})
+        response.headers["Retry-After"] = str(JOB_RETRY_AFTER_SECONDS)
+        return response, 429
+    
+    return jsonify({
+        "success": True,
+        "jobId": job_id,
+        "statusUrl": f"/jobs/{job_id}",
+        "eventsUrl": f"/jobs/{job_id}/events"
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Poll a job's status, per-stage progress and result"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """Subscribe to a job's progress over Server-Sent Events"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    def events():
+        current = job
+        while True:
+            if current is None:
+                yield format_sse("error", {"error": "Job expired"})
+                return
+            if current["status"] in ("completed", "failed"):
+                yield format_sse("done", current)
+                return
+            yield format_sse("progress", {"status": current["status"], "stages": current["stages"]})
+            current = job_manager.wait_for_update(job_id, current["version"], timeout=15)
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route('/classroom', methods=['POST'])
+def classroom_batch():
+    """Turn a whole class's sketches into stories, streamed back per child.
+
+    Accepts several ``images`` files plus shared form fields (``keywords``,
+    ``vocabularyLevel``, ``storyLength``, ``voice``, ``generateAudio``,
+    ``vocabularyMode``) and optional ``names`` in upload order. Uncached
+    images are all queued for captioning up front, and story pipelines run
+    ``CLASSROOM_CONCURRENCY`` at a time, each starting once its caption is
+    ready. Emits a ``child`` event as each story finishes and a final
+    ``done`` event.
+    """
+    # The body cap covers a full class; each file is still held to UPLOAD_MAX_BYTES,
+    # and a bad file fails only its own child
+    request.max_content_length = UPLOAD_MAX_BYTES * CLASSROOM_MAX_IMAGES
+    request.strict_uploads = False
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({"error": "No images provided"}), 400
+    if len(files) > CLASSROOM_MAX_IMAGES:
+        return jsonify({"error": f"At most {CLASSROOM_MAX_IMAGES} images per batch"}), 413
+    
+    form = request.form
+    shared = {
+        "keywords": form.get('keywords', ''),
+        "storyLength": form.get('storyLength', 'short'),
+        "vocabularyLevel": form.get('vocabularyLevel', 'intermediate'),
+        "voice": form.get('voice', 'nova'),
+        "generateAudio": form.get('generateAudio', 'false').lower() == 'true',
+        "vocabularyMode": form.get('vocabularyMode', VOCABULARY_MODE)
+    }
+    _, error = parse_story_request(dict(shared, imageDescription="classroom batch"))
+    if error:
+        return jsonify({"error": error}), 400
+    names = form.getlist('names')
+    
+    # Decode every upload and look up cached captions
+    children = []
+    for index, file in enumerate(files):
+        child = {
+            "index": index,
+            "name": names[index] if index < len(names) else None,
+            "filename": file.filename
+        }
+        try:
+            if getattr(file.stream, "rejection", None):
+                raise file.stream.rejection
+            if not (file.content_type or '').startswith('image/'):
+                raise UnidentifiedImageError()
+            with observe_stage("decode"):
+                image = decode_upload_image(file.stream)
+        except UnidentifiedImageError:
+            child["error"] = "File must be an image"
+        except ImageTooLarge as e:
+            child["error"] = str(e)
+        except UploadRejected as e:
+            child["error"] = e.description
+        else:
+            child["image"] = image
+            child["cacheKey"] = perceptual_hash(image) if caption_cache else None
+            child["caption"] = caption_cache.get(child["cacheKey"]) if caption_cache else None
+            child["cached"] = child["caption"] is not None
+        children.append(child)
+    
+    # Queue the uncached images together so they share caption batches
+    pending = [child for child in children if "image" in child and not child["cached"]]
+    captions = {}
+    if pending:
+        try:
+            caption_futures = submit_captions([child["image"] for child in pending])
+        except ModelNotReady as e:
+            response = jsonify({"error": str(e), "modelStatus": model_state["status"]})
+            response.headers["Retry-After"] = str(MODEL_RETRY_AFTER_SECONDS)
+            return response, 503
+        captions = {child["index"]: future for child, future in zip(pending, caption_futures)}
+    cache_keys = {child["index"]: child.pop("cacheKey", None) for child in children}
+    for child in children:
+        child.pop("image", None)
     
+    def run_child(child):
+        # Classroom stories queue for OpenAI quota behind interactive requests
+        request_priority.set("batch")
+        if child["index"] in captions:
+            try:
+                with observe_stage("caption"):
+                    caption = captions[child["index"]].result()
+            except Exception as e:
+                print(f"Error captioning classroom image: {str(e)}")
+                return dict(child, error="Failed to caption image")
+            child = dict(child, caption=caption)
+            if caption_cache:
+                caption_cache.put(cache_keys[child["index"]], caption)
+        params, _ = parse_story_request(dict(shared, imageDescription=child["caption"]))
+        result, status = run_story_pipeline(params, time.monotonic() + STORY_REQUEST_DEADLINE_SECONDS)
+        return dict(child, **result) if status == 200 else dict(child, error=result.get("error"))
+    
+    def events():
+        futures = {
+            submit_with_context(classroom_executor, run_child, child): child for child in children if "error" not in child
+        }
+        completed = failed = 0
+        try:
+            for child in children:
+                if "error" in child:
+                    failed += 1
+                    yield format_sse("child", child)
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error in classroom story: {str(e)}")
+                    result = dict(futures[future], error="Failed to generate story")
+                if "error" in result:
+                    failed += 1
+                else:
+                    completed += 1
+                yield format_sse("child", result)
+            yield format_sse("done", {"total": len(children), "completed": completed, "failed": failed})
+        finally:
+            # Stop queued stories if the client went away
+            for future in futures:
+                future.cancel()
+            for future in captions.values():
+                future.cancel()
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @app.route('/voices', methods=['GET'])
 def get_available_voices():
     """Get list of available TTS voices"""
-    voices = [
-        {"id": "alloy", "name": "Alloy", "description": "Neutral, balanced voice"},
-        {"id": "echo", "name": "Echo", "description": "Clear, crisp voice"},
-        {"id": "fable", "name": "Fable", "description": "Warm, storytelling voice"},
-        {"id": "onyx", "name": "Onyx", "description": "Deep, rich voice"},
-        {"id": "nova", "name": "Nova", "description": "Bright, cheerful voice (great for kids)"},
-        {"id": "shimmer", "name": "Shimmer", "description": "Gentle, soothing voice"}
-    ]
-    
     return jsonify({
         "success": True,
-        "voices": voices,
+        "voices": AVAILABLE_VOICES,
         "recommended": "nova"  # Best for children's stories
     })
 
+async def read_asgi_body(receive, limit):
+    """Read a whole ASGI request body, or return None once it grows past limit bytes"""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return bytes(body)
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body", False):
+            return bytes(body)
+
+
+async def send_asgi_json(send, status, payload, request_id=None):
+    body = json.dumps(payload).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode("ascii")),
+        # Same CORS policy flask-cors applies to the Flask routes
+        (b"access-control-allow-origin", b"*")
+    ]
+    if request_id:
+        headers.append((b"x-request-id", request_id.encode("ascii")))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def generate_story_asgi(scope, receive, send):
+    """``POST /generate-story`` served natively on the event loop, with the same body and responses as the Flask route"""
+    started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels("/generate-story").inc()
+    headers = dict(scope.get("headers") or [])
+    trace = start_trace("/generate-story", "POST", headers.get(b"x-request-id", b"").decode("latin-1")) if TRACE_ENABLED else None
+    if trace is not None:
+        request_trace.set(trace)
+    try:
+        deadline = time.monotonic() + STORY_REQUEST_DEADLINE_SECONDS
+        body = await read_asgi_body(receive, UPLOAD_MAX_BYTES)
+        if body is None:
+            status, payload = 413, {"error": f"Request body must be at most {UPLOAD_MAX_BYTES} bytes"}
+        else:
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                data = None
+            params, error = parse_story_request(data if isinstance(data, dict) else None)
+            if error:
+                status, payload = 400, {"error": error}
+            else:
+                payload, status = await run_story_pipeline_async(params, deadline)
+    except Exception as e:
+        print(f"Error generating story: {str(e)}")
+        status, payload = 500, {"error": f"Failed to generate story: {str(e)}"}
+    finally:
+        REQUESTS_IN_FLIGHT.labels("/generate-story").dec()
+    
+    await send_asgi_json(send, status, payload, request_id=trace.trace_id if trace else None)
+    REQUEST_LATENCY.labels("/generate-story", "POST", str(status)).observe(time.perf_counter() - started)
+    if trace is not None:
+        finish_trace(trace, status)
+
+
+class AsgiApp:
+    """ASGI entry point: ``POST /generate-story`` runs as a coroutine on AsyncOpenAI.
+
+    Every other route is the Flask app behind asgiref's WSGI adapter, which
+    runs it on a thread pool (``ASGI_THREADS``), so captioning and the other
+    blocking work stay off the event loop. Use ``create_asgi_app``.
+    """
+
+    def __init__(self, wsgi_app):
+        from asgiref.wsgi import WsgiToAsgi
+        self.wsgi = WsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/generate-story":
+            await generate_story_asgi(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Load the model in the background so the server accepts traffic immediately
+                if caption_server_client is None:
+                    start_model_warmup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if async_client is not None:
+                    await async_client.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_asgi_app():
+    """Factory for ASGI servers: ``uvicorn --factory app:create_asgi_app``"""
+    return AsgiApp(app)
+
+
 if __name__ == '__main__':
+    # `python app.py caption-server` runs the model-owning caption process instead of the web server
+    if len(sys.argv) > 1 and sys.argv[1] == 'caption-server':
+        run_caption_server(CAPTION_SERVER_SOCKET or '/tmp/sketch2story-caption.sock')
+        sys.exit(0)
+    
+    # `python app.py asgi` serves the ASGI app with uvicorn instead of the Flask dev server
+    if len(sys.argv) > 1 and sys.argv[1] == 'asgi':
+        import uvicorn
+        uvicorn.run(create_asgi_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+        sys.exit(0)
+    
     try:
-        load_image_model()
+        # Load the model in the background so the server accepts traffic immediately
+        if caption_server_client is None:
+            start_model_warmup()
+        else:
+            print(f"Using caption server at {CAPTION_SERVER_SOCKET}")
         
         api_key = os.getenv('OPENAI_API_KEY')
         if not api_key:
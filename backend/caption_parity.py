@@ -0,0 +1,167 @@
+"""Compare PyTorch and quantized ONNX Runtime captions on a fixed image set.
+
+Usage:
+    python caption_parity.py [image_dir]
+
+Without an image directory a fixed set of synthetic sketches is used, so
+runs are comparable across machines. Reports both engines' captions, their
+similarity, per-image latency and the memory each engine adds. The ONNX
+model is exported first if needed, and its memory is measured by loading it
+in a fresh process, so neither the export nor the freed PyTorch model skews it.
+"""
+import difflib
+import math
+import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+from PIL import Image, ImageDraw
+from transformers import AutoModelForCausalLM, AutoProcessor
+
+from app import CAPTION_MAX_LENGTH, CAPTION_MODEL_ID, CAPTION_ONNX_DIR, OnnxGitCaptioner, load_onnx_captioner
+
+load_dotenv()
+
+# Captions whose similarity ratio falls below this are reported as mismatches
+MIN_SIMILARITY = 0.6
+
+
+def current_rss_mb():
+    """Resident set size of this process in MiB (Linux)"""
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def fixed_parity_images():
+    """Deterministic line-drawing sketches standing in for children's drawings"""
+    images = {}
+
+    house = Image.new("RGB", (640, 480), "white")
+    draw = ImageDraw.Draw(house)
+    draw.rectangle([200, 220, 440, 420], outline="black", width=6)
+    draw.polygon([(180, 220), (320, 100), (460, 220)], outline="black", width=6)
+    draw.rectangle([295, 330, 345, 420], outline="black", width=5)
+    images["house"] = house
+
+    sun = Image.new("RGB", (512, 512), "white")
+    draw = ImageDraw.Draw(sun)
+    draw.ellipse([176, 176, 336, 336], outline="orange", fill="yellow", width=6)
+    for angle in range(0, 360, 30):
+        dx = round(150 * math.cos(math.radians(angle)))
+        dy = round(150 * math.sin(math.radians(angle)))
+        draw.line([256 + dx * 0.6, 256 + dy * 0.6, 256 + dx, 256 + dy], fill="orange", width=6)
+    images["sun"] = sun
+
+    tree = Image.new("RGB", (480, 640), "white")
+    draw = ImageDraw.Draw(tree)
+    draw.rectangle([210, 380, 270, 600], fill="saddlebrown")
+    draw.ellipse([100, 120, 380, 420], fill="forestgreen", outline="darkgreen", width=5)
+    images["tree"] = tree
+
+    cat = Image.new("RGB", (600, 600), "white")
+    draw = ImageDraw.Draw(cat)
+    draw.ellipse([180, 260, 420, 500], outline="black", width=6)
+    draw.ellipse([220, 120, 380, 280], outline="black", width=6)
+    draw.polygon([(230, 160), (240, 80), (290, 130)], outline="black", width=6)
+    draw.polygon([(370, 160), (360, 80), (310, 130)], outline="black", width=6)
+    draw.line([410, 420, 520, 320], fill="black", width=6)
+    images["cat"] = cat
+
+    return images
+
+
+def load_directory_images(image_dir):
+    images = {}
+    for name in sorted(os.listdir(image_dir)):
+        path = os.path.join(image_dir, name)
+        try:
+            images[name] = Image.open(path).convert("RGB")
+        except OSError:
+            continue
+    return images
+
+
+def time_captions(caption_fn, images):
+    """Caption each image on its own and return (captions, seconds per image)"""
+    caption_fn([next(iter(images.values()))])  # warm-up run, not timed
+    captions, timings = {}, {}
+    for name, image in images.items():
+        started = time.perf_counter()
+        captions[name] = caption_fn([image])[0]
+        timings[name] = time.perf_counter() - started
+    return captions, timings
+
+
+def measure_onnx_rss(token):
+    """Print the memory loading the exported ONNX model adds to a process that only has the processor"""
+    processor = AutoProcessor.from_pretrained(CAPTION_MODEL_ID, token=token)
+    before = current_rss_mb()
+    captioner = load_onnx_captioner(processor, token)
+    print(current_rss_mb() - before)
+    return 0 if captioner else 1
+
+
+def onnx_rss_in_fresh_process():
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--onnx-rss"],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv):
+    token = os.getenv('HUGGINGFACE_HUB_TOKEN')
+    if len(argv) > 1 and argv[1] == "--onnx-rss":
+        return measure_onnx_rss(token)
+    images = load_directory_images(argv[1]) if len(argv) > 1 else fixed_parity_images()
+    if not images:
+        print("No readable images found")
+        return 1
+
+    processor = AutoProcessor.from_pretrained(CAPTION_MODEL_ID, token=token)
+
+    baseline_rss = current_rss_mb()
+    torch_model = AutoModelForCausalLM.from_pretrained(CAPTION_MODEL_ID, token=token)
+    torch_rss = current_rss_mb() - baseline_rss
+
+    def torch_captions(batch):
+        inputs = processor(images=batch, return_tensors="pt")
+        generated_ids = torch_model.generate(pixel_values=inputs["pixel_values"], max_length=CAPTION_MAX_LENGTH)
+        return processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+    reference, torch_times = time_captions(torch_captions, images)
+    if not OnnxGitCaptioner.exists(CAPTION_ONNX_DIR):
+        # Export from the model already loaded, outside any memory measurement
+        print(f"Exporting {CAPTION_MODEL_ID} to quantized ONNX in {CAPTION_ONNX_DIR}...")
+        OnnxGitCaptioner.export(torch_model, CAPTION_ONNX_DIR)
+    del torch_model
+
+    onnx_rss = onnx_rss_in_fresh_process()
+    captioner = load_onnx_captioner(processor, token)
+
+    def onnx_captions(batch):
+        inputs = processor(images=batch, return_tensors="np")
+        return processor.batch_decode(captioner.generate(inputs["pixel_values"]), skip_special_tokens=True)
+
+    candidate, onnx_times = time_captions(onnx_captions, images)
+
+    mismatches = 0
+    print(f"{'image':<16} {'torch ms':>9} {'onnx ms':>9} {'similar':>8}  captions")
+    for name in images:
+        similarity = difflib.SequenceMatcher(None, reference[name], candidate[name]).ratio()
+        mismatches += similarity < MIN_SIMILARITY
+        print(f"{name:<16} {torch_times[name] * 1000:>9.1f} {onnx_times[name] * 1000:>9.1f} {similarity:>8.2f}  "
+              f"{reference[name]!r} | {candidate[name]!r}")
+
+    torch_total = sum(torch_times.values())
+    onnx_total = sum(onnx_times.values())
+    print(f"\nSpeedup: {torch_total / onnx_total:.2f}x  "
+          f"(torch {torch_total * 1000:.0f} ms, onnx {onnx_total * 1000:.0f} ms)")
+    print(f"Model RSS: torch +{torch_rss:.0f} MiB, onnx +{onnx_rss:.0f} MiB")
+    print(f"Mismatches below {MIN_SIMILARITY:.0%} similarity: {mismatches}/{len(images)}")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
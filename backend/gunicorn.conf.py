@@ -0,0 +1,36 @@
+# Gunicorn settings for running several web workers: `gunicorn -c gunicorn.conf.py app:app`
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+# Workers read this to split the OpenAI rate limits between them
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = "gthread"
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+
+def on_starting(server):
+    """Start with an empty Prometheus directory so metrics from a previous run are not summed in"""
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+def post_worker_init(worker):
+    """Load the captioning model in each worker, unless a caption server owns it"""
+    from app import caption_server_client, start_model_warmup, CAPTION_SERVER_SOCKET
+
+    if caption_server_client is None:
+        start_model_warmup()
+    else:
+        print(f"Using caption server at {CAPTION_SERVER_SOCKET}")
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's in-flight gauges so /metrics stops counting them"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,267 @@
+"""Local stand-in for the OpenAI API used by the benchmark suite.
+
+Serves the three endpoints the backend calls -- chat completions (plain and
+streamed) and speech -- with latencies drawn from a log-normal distribution
+and payloads of configurable size, so load tests never touch real quota.
+
+Run on its own with:
+    python benchmark/fake_openai.py --port 8089
+and point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8089/v1.
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STORY_WORDS = (
+    "the little fox looked up at the bright moon and wondered where the river went "
+    "so she packed a tiny bag and set off on a brave adventure with her curious friend "
+    "they learned that kindness and patience make every journey magnificent"
+).split()
+
+VOCABULARY = [
+    {
+        "word": word,
+        "definition": f"A word that means something like {word}",
+        "story_sentence": f"The fox was {word}.",
+        "example_sentence": f"Can you be {word} today?"
+    }
+    for word in ("adventure", "curious", "patience", "magnificent", "wondered", "kindness")
+]
+
+
+@dataclass
+class LatencyModel:
+    """Log-normal latency with a given median and spread (sigma of the underlying normal)"""
+    median_ms: float = 0.0
+    sigma: float = 0.0
+
+    def sample(self, rng):
+        if self.median_ms <= 0:
+            return 0.0
+        return self.median_ms * math.exp(self.sigma * rng.gauss(0.0, 1.0)) / 1000.0
+
+
+@dataclass
+class FakeOpenAIConfig:
+    """Latency and payload knobs for the fake API"""
+    chat_latency: LatencyModel = field(default_factory=lambda: LatencyModel(1500, 0.4))
+    first_token_latency: LatencyModel = field(default_factory=lambda: LatencyModel(400, 0.3))
+    tokens_per_second: float = 40.0
+    speech_latency: LatencyModel = field(default_factory=lambda: LatencyModel(2000, 0.4))
+    story_words: int = 300
+    audio_bytes: int = 600 * 1024
+    audio_chunk_bytes: int = 16 * 1024
+    seed: int = 7
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def sleep(self, latency_model):
+        with self.server.rng_lock:
+            delay = latency_model.sample(self.server.rng)
+        time.sleep(delay)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.count(self.path)
+        if self.path.endswith("/chat/completions"):
+            self.chat_completions(self.read_json())
+        elif self.path.endswith("/audio/speech"):
+            self.read_json()
+            self.speech()
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def story_text(self, max_tokens):
+        words = min(self.config.story_words, max(1, int(max_tokens * 0.75)))
+        return " ".join(STORY_WORDS[i % len(STORY_WORDS)] for i in range(words))
+
+    def chat_completions(self, body):
+        prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+        prompt_tokens = max(1, len(prompt) // 4)
+        story = self.story_text(body.get("max_tokens") or 400)
+        if "JSON object" in prompt:
+            content = json.dumps({"story": story, "vocabulary": VOCABULARY})
+        elif "JSON array" in prompt:
+            content = json.dumps(VOCABULARY)
+        else:
+            content = story
+        completion_tokens = max(1, len(content) // 4)
+
+        if body.get("stream"):
+            self.stream_chat(body, content, prompt_tokens, completion_tokens)
+            return
+
+        self.sleep(self.config.chat_latency)
+        self.send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+    def stream_chat(self, body, content, prompt_tokens, completion_tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None):
+            return json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            })
+
+        self.sleep(self.config.first_token_latency)
+        interval = 1.0 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0.0
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            send_event(chunk({"content": word if index == 0 else " " + word}))
+            time.sleep(interval)
+        send_event(chunk({}, finish_reason="stop"))
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send_event(json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4"),
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
+                }
+            }))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def speech(self):
+        self.sleep(self.config.speech_latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Content-Length", str(self.config.audio_bytes))
+        self.end_headers()
+
+        frame = b"\xff\xfb\x90\x64" + b"\x00" * 413  # one silent 128 kbps MPEG-1 Layer III frame
+        remaining = self.config.audio_bytes
+        while remaining > 0:
+            size = min(self.config.audio_chunk_bytes, remaining)
+            self.wfile.write((frame * (size // len(frame) + 1))[:size])
+            remaining -= size
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering OpenAI-style requests with synthetic data"""
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), config=None):
+        super().__init__(address, FakeOpenAIHandler)
+        self.config = config or FakeOpenAIConfig()
+        self.rng = random.Random(self.config.seed)
+        self.rng_lock = threading.Lock()
+        self.requests = {}
+        self._count_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, path):
+        with self._count_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        """Serve on a background thread and return self"""
+        threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+
+def add_arguments(parser):
+    """Latency and payload flags shared with run_benchmark.py"""
+    parser.add_argument("--chat-median-ms", type=float, default=1500, help="median chat completion latency")
+    parser.add_argument("--chat-sigma", type=float, default=0.4, help="log-normal spread of chat latency")
+    parser.add_argument("--first-token-ms", type=float, default=400, help="median time to first streamed token")
+    parser.add_argument("--tokens-per-second", type=float, default=40, help="streamed tokens per second")
+    parser.add_argument("--speech-median-ms", type=float, default=2000, help="median TTS latency")
+    parser.add_argument("--speech-sigma", type=float, default=0.4, help="log-normal spread of TTS latency")
+    parser.add_argument("--story-words", type=int, default=300, help="words per generated story")
+    parser.add_argument("--audio-kb", type=int, default=600, help="size of each TTS response in KiB")
+    parser.add_argument("--seed", type=int, default=7, help="random seed for latency sampling")
+
+
+def config_from_args(args):
+    return FakeOpenAIConfig(
+        chat_latency=LatencyModel(args.chat_median_ms, args.chat_sigma),
+        first_token_latency=LatencyModel(args.first_token_ms, args.chat_sigma),
+        tokens_per_second=args.tokens_per_second,
+        speech_latency=LatencyModel(args.speech_median_ms, args.speech_sigma),
+        story_words=args.story_words,
+        audio_bytes=args.audio_kb * 1024,
+        seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer((args.host, args.port), config_from_args(args))
+    print(f"Fake OpenAI API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
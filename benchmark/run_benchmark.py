@@ -0,0 +1,300 @@
+"""Drive the backend at rising concurrency against a local fake OpenAI API.
+
+Usage:
+    python benchmark/run_benchmark.py [--scenario process-image generate-story ...]
+                                      [--concurrency 1 2 4 8 16] [--requests 40]
+                                      [--captioner synthetic|model] [--json report.json]
+
+The Flask app runs in-process on a threaded WSGI server, with
+OPENAI_BASE_URL pointed at benchmark/fake_openai.py, so no real quota is used.
+Story and caption caches are disabled unless --with-caches is given, so every
+request exercises the full pipeline, and the OpenAI rate limits are lifted
+unless --with-quota is given, so the run measures the service, not the
+throttle. A request only counts as a success if it returned a real story,
+caption or narration, not a fallback. Each concurrency level reports req/s,
+p50/p95/p99 latency, errors and the peak RSS of the process so far.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.fake_openai import FakeOpenAIServer, add_arguments, config_from_args
+
+SKETCH_SIZES = [(640, 480), (1024, 768), (2048, 1536), (4032, 3024)]
+SKETCH_COLOURS = ["black", "red", "blue", "green", "orange", "purple", "brown"]
+
+SCENARIOS = ["process-image", "generate-story", "generate-story-audio", "generate-story-stream"]
+
+
+def synthetic_sketch(rng, size):
+    """A random crayon-style drawing: strokes, blobs and outlines on white paper"""
+    width, height = size
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    stroke = max(2, width // 120)
+    for _ in range(rng.randint(6, 14)):
+        colour = rng.choice(SKETCH_COLOURS)
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = rng.randrange(width), rng.randrange(height)
+        box = [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+        shape = rng.choice(("line", "ellipse", "rectangle", "scribble"))
+        if shape == "line":
+            draw.line([x0, y0, x1, y1], fill=colour, width=stroke)
+        elif shape == "ellipse":
+            draw.ellipse(box, outline=colour, width=stroke)
+        elif shape == "rectangle":
+            draw.rectangle(box, outline=colour, width=stroke)
+        else:
+            points = [(rng.randrange(width), rng.randrange(height)) for _ in range(8)]
+            draw.line(points, fill=colour, width=stroke, joint="curve")
+    return image
+
+
+def synthetic_sketch_uploads(count, seed=0):
+    """Encode ``count`` sketches as (filename, content type, bytes), mixing phone-photo JPEGs and PNG scans"""
+    rng = random.Random(seed)
+    uploads = []
+    for index in range(count):
+        size = SKETCH_SIZES[index % len(SKETCH_SIZES)]
+        image = synthetic_sketch(rng, size)
+        buffer = io.BytesIO()
+        if index % 2 == 0:
+            image.save(buffer, format="JPEG", quality=90)
+            uploads.append((f"sketch-{index}.jpg", "image/jpeg", buffer.getvalue()))
+        else:
+            image.save(buffer, format="PNG")
+            uploads.append((f"sketch-{index}.png", "image/png", buffer.getvalue()))
+    return uploads
+
+
+def multipart_body(field, filename, content_type, data):
+    boundary = uuid.uuid4().hex
+    head = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return head + data + tail, f"multipart/form-data; boundary={boundary}"
+
+
+def build_request(scenario, base_url, index, uploads):
+    """Return a urllib Request for one call of the given scenario"""
+    if scenario == "process-image":
+        filename, content_type, data = uploads[index % len(uploads)]
+        body, header = multipart_body("image", filename, content_type, data)
+        return urllib.request.Request(f"{base_url}/process-image", data=body,
+                                      headers={"Content-Type": header}, method="POST")
+
+    payload = {
+        "imageDescription": f"a child's drawing of a fox under the moon number {index}",
+        "keywords": "fox, moon, river",
+        "storyLength": "short",
+        "vocabularyLevel": ["beginner", "intermediate", "advanced"][index % 3],
+        "generateAudio": scenario == "generate-story-audio"
+    }
+    path = "/generate-story/stream" if scenario == "generate-story-stream" else "/generate-story"
+    return urllib.request.Request(f"{base_url}{path}", data=json.dumps(payload).encode("utf-8"),
+                                  headers={"Content-Type": "application/json"}, method="POST")
+
+
+def parse_sse(body):
+    """(event, data) pairs of a Server-Sent Events body"""
+    events = []
+    for block in body.decode("utf-8").strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if ": " in line)
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields.get("data", "null"))))
+    return events
+
+
+def response_ok(scenario, body):
+    """True if the body carries a real result rather than an error or fallback story"""
+    from backend.app import is_story_failure
+
+    try:
+        if scenario == "generate-story-stream":
+            events = parse_sse(body)
+            if not events or events[-1][0] != "done":
+                return False
+            data = events[-1][1]
+        else:
+            data = json.loads(body)
+    except ValueError:
+        return False
+    if not data.get("success"):
+        return False
+    if scenario == "process-image":
+        return bool(data.get("caption"))
+    if not data.get("story") or is_story_failure(data["story"]):
+        return False
+    return scenario != "generate-story-audio" or bool(data.get("audioGenerated"))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(scenario, concurrency, latencies, errors, elapsed):
+    completed = len(latencies)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": completed + errors,
+        "errors": errors,
+        "requestsPerSecond": round(completed / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50Ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95Ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99Ms": round(percentile(latencies, 99) * 1000, 1),
+        "peakRssMb": round(peak_rss_mb(), 1)
+    }
+
+
+def run_level(scenario, base_url, concurrency, total_requests, uploads, timeout):
+    """Send ``total_requests`` with ``concurrency`` client threads and return the level summary"""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    counter = iter(range(total_requests))
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            request = build_request(scenario, base_url, index, uploads)
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    body = response.read()
+                ok = response_ok(scenario, body)
+            except (urllib.error.URLError, OSError):
+                ok = False
+            duration = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(duration)
+                else:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(scenario, concurrency, latencies, errors, time.perf_counter() - started)
+
+
+def configure_environment(args, fake_base_url):
+    """Point the backend at the fake API; must run before backend.app is imported"""
+    os.environ["OPENAI_BASE_URL"] = fake_base_url
+    os.environ["OPENAI_API_KEY"] = "sk-benchmark"
+    os.environ.setdefault("AUDIO_STORE_DIR", tempfile.mkdtemp(prefix="sketch2story-bench-audio-"))
+    if not args.with_caches:
+        os.environ["STORY_CACHE_ENABLED"] = "false"
+        os.environ["CAPTION_CACHE_ENABLED"] = "false"
+    if not args.with_quota:
+        # The fake API has no limits; queueing for real-account quota would only measure the throttle
+        for name in ("OPENAI_CHAT_RPM", "OPENAI_CHAT_TPM", "OPENAI_TTS_RPM"):
+            os.environ[name] = "0"
+
+
+def install_synthetic_captioner(app_module, caption_ms):
+    """Replace the vision model with a fixed-latency stand-in so runs need no model download"""
+    def synthetic_captions(images):
+        time.sleep(caption_ms / 1000.0)
+        return ["a child's drawing of a fox under the moon" for _ in images]
+
+    app_module.generate_image_captions = synthetic_captions
+    app_module.image_processor = app_module.image_model = "synthetic"
+    app_module.model_state.update({"status": "ready", "stage": "ready"})
+
+
+def print_report(rows):
+    print(f"\n{'scenario':<22} {'conc':>5} {'reqs':>5} {'err':>4} {'req/s':>8} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak RSS':>9}")
+    for row in rows:
+        print(f"{row['scenario']:<22} {row['concurrency']:>5} {row['requests']:>5} {row['errors']:>4} "
+              f"{row['requestsPerSecond']:>8.2f} {row['p50Ms']:>9.1f} {row['p95Ms']:>9.1f} "
+              f"{row['p99Ms']:>9.1f} {row['peakRssMb']:>7.0f}MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=["process-image", "generate-story"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=40, help="requests per concurrency level")
+    parser.add_argument("--captioner", choices=["synthetic", "model"], default="synthetic",
+                        help="fixed-latency stand-in or the real captioning model")
+    parser.add_argument("--caption-ms", type=float, default=150, help="synthetic captioner latency per batch")
+    parser.add_argument("--sketches", type=int, default=16, help="distinct synthetic sketches to upload")
+    parser.add_argument("--with-caches", action="store_true", help="keep story and caption caches enabled")
+    parser.add_argument("--with-quota", action="store_true", help="keep the configured OpenAI rate limits")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout per request in seconds")
+    parser.add_argument("--json", help="also write the report to this file")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    fake = FakeOpenAIServer(config=config_from_args(args)).start()
+    configure_environment(args, fake.base_url)
+
+    from werkzeug.serving import make_server
+    import backend.app as app_module
+
+    if args.captioner == "synthetic":
+        install_synthetic_captioner(app_module, args.caption_ms)
+    else:
+        app_module.warm_up_image_model()
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-app", daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    uploads = synthetic_sketch_uploads(args.sketches)
+    print(f"Backend on {base_url}, fake OpenAI on {fake.base_url}, "
+          f"{len(uploads)} sketches ({sum(len(u[2]) for u in uploads) / 1024 / 1024:.1f} MiB)")
+
+    rows = []
+    for scenario in args.scenario:
+        for concurrency in args.concurrency:
+            row = run_level(scenario, base_url, concurrency, args.requests, uploads, args.timeout)
+            rows.append(row)
+            print(f"  {scenario} x{concurrency}: {row['requestsPerSecond']} req/s, p95 {row['p95Ms']} ms")
+
+    server.shutdown()
+    fake.shutdown()
+    print_report(rows)
+    print(f"\nFake OpenAI calls: {fake.requests}")
+
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump({"config": vars(args), "results": rows, "upstreamCalls": fake.requests}, report_file, indent=2)
+    return 1 if any(row["errors"] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
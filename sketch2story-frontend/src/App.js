@@ -142,7 +142,9 @@ function App() {
       if (response.ok) {
         setStory(data.story);
         setVocabularyWords(data.vocabularyWords || []);
-        if (data.audioGenerated && data.audioData) {
+        if (data.audioGenerated && data.audioUrl) {
+          setAudioData(`http://localhost:5000${data.audioUrl}`);
+        } else if (data.audioGenerated && data.audioData) {
           setAudioData(data.audioData);
         }
         setCurrentStep(3);
@@ -1,22 +1,49 @@
 import unittest
+import asyncio
 import json
 import os
 import io
+import socket
+import hashlib
 import sys
-from unittest.mock import patch, MagicMock
+import tempfile
+import threading
+import time
+from unittest.mock import patch, AsyncMock, MagicMock
 from PIL import Image
+from prometheus_client import REGISTRY
 
 os.environ['OPENAI_API_KEY'] = 'sk-test-fake-key-for-testing'
 os.environ['HUGGINGFACE_HUB_TOKEN'] = 'hf_test_fake_token_for_testing'
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from backend.app import app, generate_image_caption, generate_story, generate_audio_narration,extract_vocabulary_words, create_fallback_vocabulary, VOCABULARY_LEVELS
+from backend.app import app, generate_image_caption, generate_story, generate_audio_narration,extract_vocabulary_words, create_fallback_vocabulary, VOCABULARY_LEVELS, level_label
+from backend.app import CaptionBatcher, percentile, CaptionCache, perceptual_hash, caption_cache
+from backend.app import StoryCache, story_cache, story_cache_key
+from backend.app import AudioStore, NarrationPrerenderer, narration_key
+from backend.app import JobManager
+from backend.app import OnnxGitCaptioner, generate_image_captions
+from backend.app import ImageTooLarge, decode_target_size, decode_upload_image, image_decode_stats
+from backend.app import SniffedUpload, UploadRejected, upload_stats
+from backend.app import model_state, warm_up_image_model
+from backend.app import CaptionServerClient, CaptionTimeout, ModelNotReady, make_caption_server
+from backend.app import count_syllables, parse_syllable_range, vocabulary_engine
+from backend.app import parse_story_with_vocabulary
+from backend.app import DeadlineExceeded, ResilientUpstream, UpstreamUnavailable, request_deadline, request_priority, stage_timeout
+from backend.app import QuotaScheduler, QuotaTimeout, estimate_chat_tokens
+from backend.app import SimilarStoryIndex
+from backend.app import generate_story_asgi, upstream_executor
+from backend.app import TraceLog
+from backend.app import split_narration_text, strip_mp3_metadata, NARRATION_MAX_CHARS, TTS_MAX_INPUT_CHARS
+from concurrent.futures import ThreadPoolExecutor
 
 class TestFlaskApp(unittest.TestCase):
     def setUp(self):
         """Set up test client"""
         self.app = app.test_client()
         self.app.testing = True
+        caption_cache.clear()
+        story_cache.clear()
 
     def create_test_image(self):
         """Create a test image file"""
@@ -155,22 +182,20 @@ class TestCoreFunctions(unittest.TestCase):
     
     @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
     @patch('backend.app.client')
-    @patch('tempfile.NamedTemporaryFile')
-    def test_generate_audio_narration(self, mock_temp_file, mock_client):
+    def test_generate_audio_narration(self, mock_client):
         """Test audio generation"""
         # Mock OpenAI TTS response
         mock_response = MagicMock()
         mock_response.content = b"fake audio data"
         mock_client.audio.speech.create.return_value = mock_response
         
-        # Mock temp file
-        mock_file = MagicMock()
-        mock_file.name = "/tmp/test.mp3"
-        mock_temp_file.return_value = mock_file
-        
-        result = generate_audio_narration("Test story", "nova")
-        
-        self.assertEqual(result, "/tmp/test.mp3")
+        with tempfile.TemporaryDirectory() as tmp:
+            store = AudioStore(tmp, max_bytes=1024)
+            with patch('backend.app.audio_store', store):
+                result = generate_audio_narration("Test story", "nova")
+            
+            with open(store.path_for(result), 'rb') as audio_file:
+                self.assertEqual(audio_file.read(), b"fake audio data")
         mock_client.audio.speech.create.assert_called_once()
 
     @patch('backend.app.client')
@@ -252,6 +277,8 @@ class TestIntegration(unittest.TestCase):
         """Set up test client"""
         self.app = app.test_client()
         self.app.testing = True
+        caption_cache.clear()
+        story_cache.clear()
     
     @patch('backend.app.generate_image_caption')
     @patch('backend.app.generate_story')
@@ -295,6 +322,1775 @@ class TestIntegration(unittest.TestCase):
 
 
 
+class TestCaptionBatcher(unittest.TestCase):
+    """Test micro-batching of caption requests"""
+
+    def test_concurrent_requests_share_a_batch(self):
+        """Images submitted together are captioned in one call"""
+        calls = []
+
+        def caption_fn(images):
+            calls.append(len(images))
+            time.sleep(0.01)
+            return [f"caption {image}" for image in images]
+
+        batcher = CaptionBatcher(caption_fn, max_batch_size=4, max_wait_ms=200)
+        results = {}
+
+        def worker(i):
+            results[i] = batcher.submit(i, timeout=5)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {i: f"caption {i}" for i in range(4)})
+        self.assertEqual(calls, [4])
+        stats = batcher.stats()
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['batchSizeHistogram'], {'4': 1})
+
+    def test_wait_window_flushes_partial_batch(self):
+        """A lone request is not held longer than the wait window"""
+        batcher = CaptionBatcher(lambda images: ["solo"] * len(images), max_batch_size=8, max_wait_ms=5)
+        self.assertEqual(batcher.submit("img", timeout=5), "solo")
+        self.assertLess(batcher.stats()['queueWaitMs']['max'], 1000)
+
+    def test_errors_propagate_to_waiters(self):
+        """A failing batch raises in every waiting request"""
+        def caption_fn(images):
+            raise RuntimeError("model exploded")
+
+        batcher = CaptionBatcher(caption_fn, max_batch_size=2, max_wait_ms=1)
+        with self.assertRaises(RuntimeError):
+            batcher.submit("img", timeout=5)
+        self.assertEqual(batcher.stats()['errors'], 1)
+
+    def test_cancelled_images_are_skipped(self):
+        """Images whose caller gave up are dropped from the batch"""
+        calls = []
+
+        def caption_fn(images):
+            calls.append(list(images))
+            return [f"caption {image}" for image in images]
+
+        batcher = CaptionBatcher(caption_fn, max_batch_size=4, max_wait_ms=50)
+        abandoned = batcher.enqueue("gone")
+        kept = batcher.enqueue("kept")
+        abandoned.cancel()
+        self.assertEqual(kept.result(timeout=5), "caption kept")
+        self.assertEqual(calls, [["kept"]])
+
+    def test_percentile(self):
+        """Nearest-rank percentile helper"""
+        self.assertEqual(percentile([], 99), 0.0)
+        self.assertEqual(percentile(list(range(1, 101)), 50), 50)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+
+    def test_stats_endpoint(self):
+        """Batcher stats are exposed over HTTP"""
+        response = app.test_client().get('/stats')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertIn('queueWaitMs', data['captionBatcher'])
+
+
+class TestCaptionCache(unittest.TestCase):
+    """Test the perceptual-hash caption cache"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+        story_cache.clear()
+
+    def create_sketch(self, size=(200, 200)):
+        img = Image.new('RGB', size, color='white')
+        for x in range(size[0] // 4, size[0] // 2):
+            for y in range(size[1] // 4, 3 * size[1] // 4):
+                img.putpixel((x, y), (0, 0, 0))
+        return img
+
+    def test_hash_survives_resize_and_reencode(self):
+        """Re-encoded and resized copies share a hash"""
+        original = self.create_sketch()
+        buffer = io.BytesIO()
+        original.resize((150, 150)).save(buffer, 'JPEG', quality=70)
+        buffer.seek(0)
+        copy = Image.open(buffer).convert('RGB')
+        self.assertEqual(perceptual_hash(original), perceptual_hash(copy))
+
+    def test_flat_colours_do_not_collide(self):
+        """Solid images of different colours get different keys"""
+        red = Image.new('RGB', (50, 50), color='red')
+        blue = Image.new('RGB', (50, 50), color='blue')
+        self.assertNotEqual(perceptual_hash(red), perceptual_hash(blue))
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted first"""
+        cache = CaptionCache(max_entries=2)
+        cache.put('a', 'cat')
+        cache.put('b', 'dog')
+        cache.get('a')
+        cache.put('c', 'bird')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'cat')
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_disk_tier_survives_restart(self):
+        """Captions persisted on disk are found by a fresh cache"""
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'captions.db')
+            CaptionCache(max_entries=4, db_path=db_path).put('k', 'a drawing of a house')
+            fresh = CaptionCache(max_entries=4, db_path=db_path)
+            self.assertEqual(fresh.get('k'), 'a drawing of a house')
+            self.assertEqual(fresh.stats()['diskHits'], 1)
+
+    def test_disk_tier_is_bounded(self):
+        """The disk tier drops its oldest entries when full"""
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = CaptionCache(max_entries=1, db_path=os.path.join(tmp, 'c.db'), max_disk_entries=2)
+            for key in ('a', 'b', 'c'):
+                cache.put(key, key)
+                time.sleep(0.01)
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), 'b')
+            self.assertEqual(cache.stats()['diskEvictions'], 1)
+
+    @patch('backend.app.generate_image_caption')
+    def test_repeat_upload_skips_captioning(self, mock_caption):
+        """A second upload of the same sketch is served from cache"""
+        mock_caption.return_value = "a drawing of a tree"
+        sketch = self.create_sketch()
+        responses = []
+        for size in ((200, 200), (180, 180)):
+            img_io = io.BytesIO()
+            sketch.resize(size).save(img_io, 'PNG')
+            img_io.seek(0)
+            responses.append(self.app.post('/process-image',
+                                           data={'image': (img_io, 'tree.png')},
+                                           content_type='multipart/form-data'))
+
+        first, second = [json.loads(r.data) for r in responses]
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(second['caption'], "a drawing of a tree")
+        mock_caption.assert_called_once()
+
+
+class TestStoryCache(unittest.TestCase):
+    """Test story result caching and single-flight coalescing"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+
+    def test_key_normalization(self):
+        """Whitespace, case and keyword order do not change the key"""
+        self.assertEqual(
+            story_cache_key("A  Cat", "courage, Friendship", "short", "beginner"),
+            story_cache_key("a cat ", "friendship,courage", "short", "beginner")
+        )
+        self.assertNotEqual(
+            story_cache_key("a cat", "courage", "short", "beginner"),
+            story_cache_key("a cat", "courage", "long", "beginner")
+        )
+
+    def test_ttl_expiry(self):
+        """Entries are recomputed after their TTL"""
+        cache = StoryCache(ttl_seconds=0.05, max_entries=4)
+        compute = MagicMock(side_effect=["first", "second"])
+        self.assertEqual(cache.get_or_compute('k', compute), "first")
+        self.assertEqual(cache.get_or_compute('k', compute), "first")
+        time.sleep(0.06)
+        self.assertEqual(cache.get_or_compute('k', compute), "second")
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_size_bound(self):
+        """The oldest entry is evicted once the cache is full"""
+        cache = StoryCache(ttl_seconds=60, max_entries=1)
+        cache.get_or_compute('a', lambda: "A")
+        cache.get_or_compute('b', lambda: "B")
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.get_or_compute('a', lambda: "A2"), "A2")
+
+    def test_concurrent_identical_requests_coalesce(self):
+        """Identical in-flight requests share one computation"""
+        cache = StoryCache(ttl_seconds=60, max_entries=4)
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return "shared story"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["shared story"] * 5)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.generate_story')
+    def test_endpoint_reuses_story(self, mock_story, mock_vocab):
+        """Repeated identical requests make one upstream call"""
+        mock_story.return_value = "Once upon a time..."
+        payload = json.dumps({'imageDescription': 'A cat', 'keywords': 'sharing'})
+        for _ in range(2):
+            response = self.app.post('/generate-story', data=payload, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        mock_story.assert_called_once()
+
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.generate_story')
+    def test_endpoint_does_not_cache_fallback(self, mock_story, mock_vocab):
+        """The apology text returned on upstream failure is not cached"""
+        mock_story.return_value = "I'd love to tell you a story about sharing featuring A cat, but..."
+        payload = json.dumps({'imageDescription': 'A cat', 'keywords': 'sharing'})
+        for _ in range(2):
+            self.app.post('/generate-story', data=payload, content_type='application/json')
+        self.assertEqual(mock_story.call_count, 2)
+
+
+class TestParallelPipeline(unittest.TestCase):
+    """Test the concurrent vocabulary + narration stages"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.payload = json.dumps({
+            'imageDescription': 'A fox',
+            'keywords': 'honesty',
+            'generateAudio': True,
+            'vocabularyMode': 'gpt'
+        })
+
+    @patch('backend.app.STORY_GENERATION_MODE', 'separate')
+    @patch('backend.app.generate_story', return_value="The fox told the truth.")
+    def test_vocabulary_and_audio_overlap(self, mock_story):
+        """End-to-end latency is roughly the slower stage, not the sum"""
+        def slow_vocab(story, level):
+            time.sleep(0.3)
+            return [{"word": "Truth"}]
+
+        def slow_audio(story, voice):
+            time.sleep(0.3)
+            return "a" * 64
+
+        with patch('backend.app.extract_vocabulary_words', side_effect=slow_vocab), \
+                patch('backend.app.generate_audio_narration', side_effect=slow_audio):
+            started = time.monotonic()
+            response = self.app.post('/generate-story', data=self.payload, content_type='application/json')
+            elapsed = time.monotonic() - started
+
+        data = json.loads(response.data)
+        self.assertTrue(data['audioGenerated'])
+        self.assertEqual(data['vocabularyWords'], [{"word": "Truth"}])
+        self.assertLess(elapsed, 0.55)
+
+    @patch('backend.app.STORY_REQUEST_DEADLINE_SECONDS', 0.1)
+    @patch('backend.app.generate_story', return_value="The fox told the truth about the magnificent river.")
+    def test_deadline_falls_back(self, mock_story):
+        """Stages that miss the deadline degrade instead of blocking the response"""
+        release = threading.Event()
+
+        def stuck(*args):
+            release.wait(5)
+            return None
+
+        with patch('backend.app.extract_vocabulary_words', side_effect=stuck), \
+                patch('backend.app.generate_audio_narration', side_effect=stuck):
+            response = self.app.post('/generate-story', data=self.payload, content_type='application/json')
+            release.set()
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(data['audioGenerated'])
+        self.assertEqual(data['audioError'], "Audio generation timed out")
+        self.assertIsInstance(data['vocabularyWords'], list)
+
+
+class TestStoryStreaming(unittest.TestCase):
+    """Test the Server-Sent Events story endpoint"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.payload = json.dumps({'imageDescription': 'A bear', 'keywords': 'patience', 'vocabularyMode': 'gpt'})
+
+    def parse_events(self, body):
+        events = []
+        for block in body.decode('utf-8').strip().split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.split('\n'))
+            events.append((lines['event'], json.loads(lines['data'])))
+        return events
+
+    def make_chunk(self, text):
+        chunk = MagicMock()
+        chunk.choices[0].delta.content = text
+        return chunk
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.extract_vocabulary_words', return_value=[{"word": "Patience"}])
+    @patch('backend.app.client')
+    def test_tokens_then_done(self, mock_client, mock_vocab):
+        """Tokens are relayed as they arrive, followed by a final event"""
+        mock_client.chat.completions.create.return_value = iter(
+            [self.make_chunk("Once "), self.make_chunk("upon a time."), self.make_chunk(None)]
+        )
+        response = self.app.post('/generate-story/stream', data=self.payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.mimetype.startswith('text/event-stream'))
+        events = self.parse_events(response.data)
+        self.assertEqual([e for e, _ in events], ['token', 'token', 'done'])
+        done = events[-1][1]
+        self.assertEqual(done['story'], "Once upon a time.")
+        self.assertEqual(done['vocabularyWords'], [{"word": "Patience"}])
+        self.assertTrue(mock_client.chat.completions.create.call_args.kwargs['stream'])
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.client')
+    def test_cached_story_is_replayed(self, mock_client, mock_vocab):
+        """A story already in the cache is sent without calling GPT-4"""
+        story_cache.put(story_cache_key('A bear', 'patience', 'short', 'intermediate'), "Cached tale.")
+        response = self.app.post('/generate-story/stream', data=self.payload, content_type='application/json')
+        events = self.parse_events(response.data)
+        self.assertEqual(events[0], ('token', {'text': "Cached tale."}))
+        self.assertTrue(events[-1][1]['cached'])
+        mock_client.chat.completions.create.assert_not_called()
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.client')
+    def test_upstream_error_event(self, mock_client):
+        """Upstream failures end the stream with an error event"""
+        mock_client.chat.completions.create.side_effect = Exception("boom")
+        response = self.app.post('/generate-story/stream', data=self.payload, content_type='application/json')
+        events = self.parse_events(response.data)
+        self.assertEqual(events[-1][0], 'error')
+
+    def test_missing_keywords(self):
+        """Validation errors are returned before streaming starts"""
+        response = self.app.post('/generate-story/stream',
+                                 data=json.dumps({'imageDescription': 'A bear'}),
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestNarrationStreaming(unittest.TestCase):
+    """Test the streaming narration endpoint"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = AudioStore(self.tmp.name, max_bytes=10**7)
+        patcher = patch('backend.app.audio_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('backend.app.client')
+    def test_streams_mp3_chunks(self, mock_client):
+        """Upstream audio chunks are relayed as audio/mpeg"""
+        manager = mock_client.audio.speech.with_streaming_response.create.return_value
+        upstream = manager.__enter__.return_value
+        upstream.iter_bytes.return_value = iter([b"ID3", b"frame1", b"frame2"])
+
+        response = self.app.post('/narrate',
+                                 data=json.dumps({'text': 'Once upon a time', 'voice': 'fable'}),
+                                 content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'audio/mpeg')
+        self.assertEqual(response.data, b"ID3frame1frame2")
+        kwargs = mock_client.audio.speech.with_streaming_response.create.call_args.kwargs
+        self.assertEqual(kwargs['voice'], 'fable')
+        self.assertEqual(kwargs['speed'], 0.9)
+        manager.__exit__.assert_called_once()
+
+    @patch('backend.app.client')
+    def test_get_with_query_parameters(self, mock_client):
+        """GET works so the URL can be an audio element source"""
+        upstream = mock_client.audio.speech.with_streaming_response.create.return_value.__enter__.return_value
+        upstream.iter_bytes.return_value = iter([b"mp3"])
+        response = self.app.get('/narrate?text=Hello&voice=nova')
+        self.assertEqual(response.data, b"mp3")
+
+    @patch('backend.app.client')
+    def test_upstream_failure(self, mock_client):
+        """Failures before the first byte return an error status"""
+        mock_client.audio.speech.with_streaming_response.create.side_effect = Exception("TTS down")
+        response = self.app.post('/narrate', data=json.dumps({'text': 'Hi'}), content_type='application/json')
+        self.assertEqual(response.status_code, 502)
+
+    @patch('backend.app.client')
+    def test_replay_served_from_store(self, mock_client):
+        """A narration streamed once is stored and replayed without another TTS call"""
+        create = mock_client.audio.speech.with_streaming_response.create
+        create.return_value.__enter__.return_value.iter_bytes.return_value = iter([b"mp3", b"data"])
+        payload = json.dumps({'text': 'Once upon a time', 'voice': 'echo'})
+
+        first = self.app.post('/narrate', data=payload, content_type='application/json')
+        self.assertEqual(first.data, b"mp3data")
+        replay = self.app.post('/narrate', data=payload, content_type='application/json')
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.data, b"mp3data")
+        create.assert_called_once()
+
+    def test_validation(self):
+        """Missing text, unknown voices and over-long text are rejected"""
+        for payload in ({}, {'text': 'Hi', 'voice': 'robot'}, {'text': 'x' * (NARRATION_MAX_CHARS + 1)}):
+            response = self.app.post('/narrate', data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+
+class TestAudioStore(unittest.TestCase):
+    """Test the narration artifact store and its serving route"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = AudioStore(self.tmp.name, max_bytes=100)
+        patcher = patch('backend.app.audio_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_content_addressed(self):
+        """Identical audio is stored once under its hash"""
+        first = self.store.put(b"same bytes")
+        second = self.store.put(b"same bytes")
+        self.assertEqual(first, second)
+        self.assertEqual(self.store.stats()['files'], 1)
+        self.assertIsNone(self.store.path_for("../etc/passwd"))
+
+    def test_spooled_artifacts_are_hashed_on_disk(self):
+        """Streamed audio is written to a temporary file and moved into place whole"""
+        spool = self.store.spool()
+        spool.write(b"first ")
+        spool.write(b"second")
+        artifact_id = spool.commit()
+        spool.discard()
+        self.assertEqual(artifact_id, hashlib.sha256(b"first second").hexdigest())
+        with open(self.store.get_path(artifact_id), 'rb') as audio_file:
+            self.assertEqual(audio_file.read(), b"first second")
+
+        abandoned = self.store.spool()
+        abandoned.write(b"partial")
+        abandoned.discard()
+        self.assertEqual([name for name in os.listdir(self.tmp.name) if name.endswith(".part")], [])
+
+    def test_garbage_collection_is_size_capped(self):
+        """Least recently used files are removed past the size cap"""
+        old = self.store.put(b"a" * 60)
+        os.utime(self.store.path_for(old), (0, 0))
+        new = self.store.put(b"b" * 60)
+        self.assertIsNone(self.store.get_path(old))
+        self.assertIsNotNone(self.store.get_path(new))
+        self.assertEqual(self.store.stats()['collectedFiles'], 1)
+
+    def test_serves_range_requests_with_etag(self):
+        """The audio route supports Range, ETag and long-lived caching"""
+        artifact_id = self.store.put(b"0123456789")
+        response = self.app.get(f'/audio/{artifact_id}.mp3', headers={'Range': 'bytes=2-5'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, b"2345")
+        self.assertIn('immutable', response.headers['Cache-Control'])
+
+        etag = response.headers['ETag']
+        response = self.app.get(f'/audio/{artifact_id}.mp3', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.assertEqual(self.app.get(f'/audio/{"0" * 64}.mp3').status_code, 404)
+
+    def test_narration_keys_are_revalidated(self):
+        """A narration key can be re-rendered, so its ETag is the content hash and it is not immutable"""
+        key = narration_key("Once upon a time.", "nova")
+        self.store.put(b"first render", artifact_id=key)
+        response = self.app.get(f'/audio/{key}.mp3')
+        self.assertNotIn('immutable', response.headers['Cache-Control'])
+        self.assertIn(hashlib.sha256(b"first render").hexdigest(), response.headers['ETag'])
+
+        os.unlink(self.store.path_for(key))
+        self.store.put(b"second render", artifact_id=key)
+        response = self.app.get(f'/audio/{key}.mp3', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b"second render")
+
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.generate_story', return_value="A short tale.")
+    def test_story_returns_audio_url(self, mock_story, mock_vocab):
+        """Narration is referenced by URL, or inlined for legacy clients"""
+        artifact_id = self.store.put(b"mp3 bytes")
+        with patch('backend.app.generate_audio_narration', return_value=artifact_id):
+            payload = {'imageDescription': 'A owl', 'keywords': 'wisdom', 'generateAudio': True}
+            data = json.loads(self.app.post('/generate-story', data=json.dumps(payload),
+                                            content_type='application/json').data)
+            self.assertEqual(data['audioUrl'], f'/audio/{artifact_id}.mp3')
+            self.assertNotIn('audioData', data)
+
+            payload['audioDelivery'] = 'inline'
+            data = json.loads(self.app.post('/generate-story', data=json.dumps(payload),
+                                            content_type='application/json').data)
+            self.assertTrue(data['audioData'].startswith('data:audio/mp3;base64,'))
+
+
+class TestJobs(unittest.TestCase):
+    """Test the asynchronous job API"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.manager = JobManager(workers=1, queue_limit=1, result_ttl=60)
+        patcher = patch('backend.app.job_manager', self.manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = json.dumps({'imageDescription': 'A turtle', 'keywords': 'perseverance'})
+
+    def wait_for(self, job_id, status):
+        for _ in range(200):
+            data = json.loads(self.app.get(f'/jobs/{job_id}').data)
+            if data['status'] == status:
+                return data
+            time.sleep(0.01)
+        self.fail(f"job never reached {status}")
+
+    def test_job_lifecycle(self):
+        """A job reports per-stage progress and its final result"""
+        def pipeline(params, deadline, on_stage=None):
+            on_stage("story", "running")
+            on_stage("story", "completed")
+            return {"success": True, "story": "Slow and steady."}, 200
+
+        with patch('backend.app.run_story_pipeline', side_effect=pipeline):
+            response = self.app.post('/jobs', data=self.payload, content_type='application/json')
+            self.assertEqual(response.status_code, 202)
+            job_id = json.loads(response.data)['jobId']
+            data = self.wait_for(job_id, 'completed')
+
+        self.assertEqual(data['result']['story'], "Slow and steady.")
+        self.assertEqual(data['stages']['story'], 'completed')
+        self.assertEqual(self.manager.stats()['completed'], 1)
+
+    def test_full_queue_rejects_with_retry_after(self):
+        """Once workers and queue are full, new jobs get 429"""
+        release = threading.Event()
+
+        def pipeline(params, deadline, on_stage=None):
+            release.wait(5)
+            return {"success": True}, 200
+
+        with patch('backend.app.run_story_pipeline', side_effect=pipeline):
+            statuses = [self.app.post('/jobs', data=self.payload, content_type='application/json')
+                        for _ in range(3)]
+            self.assertEqual([r.status_code for r in statuses], [202, 202, 429])
+            self.assertIn('Retry-After', statuses[2].headers)
+            stats = self.manager.stats()
+            self.assertEqual(stats['rejected'], 1)
+            self.assertEqual(stats['running'] + stats['queueDepth'], 2)
+            release.set()
+            self.wait_for(json.loads(statuses[1].data)['jobId'], 'completed')
+
+    def test_events_stream_ends_with_done(self):
+        """Subscribers receive progress and a final done event"""
+        with patch('backend.app.run_story_pipeline', return_value=({"error": "Error: no key"}, 500)):
+            job_id = json.loads(self.app.post('/jobs', data=self.payload,
+                                              content_type='application/json').data)['jobId']
+            self.wait_for(job_id, 'failed')
+        body = self.app.get(f'/jobs/{job_id}/events').data.decode('utf-8')
+        self.assertIn('event: done', body)
+        self.assertIn('Error: no key', body)
+
+    def test_unknown_job_and_validation(self):
+        """Unknown ids are 404 and invalid bodies are 400"""
+        self.assertEqual(self.app.get('/jobs/nope').status_code, 404)
+        response = self.app.post('/jobs', data=json.dumps({'keywords': 'x'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestOnnxCaptioner(unittest.TestCase):
+    """Test the ONNX Runtime captioning engine's decode loop"""
+
+    class FakeSession:
+        def __init__(self, fn):
+            self.fn = fn
+            self.calls = 0
+
+        def run(self, output_names, feeds):
+            self.calls += 1
+            return [self.fn(feeds)]
+
+    def make_captioner(self, script, max_length=10):
+        import numpy as np
+
+        def text(feeds):
+            step = feeds['input_ids'].shape[1] - 1
+            logits = np.zeros((feeds['input_ids'].shape[0], 200), dtype=np.float32)
+            for row, tokens in enumerate(script):
+                logits[row, tokens[min(step, len(tokens) - 1)]] = 1.0
+            return logits
+
+        vision = self.FakeSession(lambda feeds: np.ones((feeds['pixel_values'].shape[0], 4, 8), dtype=np.float32))
+        return OnnxGitCaptioner(vision, self.FakeSession(text), bos_token_id=101, eos_token_id=102,
+                                pad_token_id=0, max_length=max_length)
+
+    def test_greedy_decode_stops_at_eos(self):
+        """Rows stop at the end token and are padded while others finish"""
+        import numpy as np
+        captioner = self.make_captioner([[7, 102], [8, 9, 102]])
+        ids = captioner.generate(np.zeros((2, 3, 224, 224)))
+        self.assertEqual(ids.tolist(), [[101, 7, 102, 0], [101, 8, 9, 102]])
+        self.assertEqual(captioner.vision_session.calls, 1)
+
+    def test_max_length(self):
+        """Decoding stops at max_length tokens"""
+        import numpy as np
+        ids = self.make_captioner([[5]], max_length=4).generate(np.zeros((1, 3, 224, 224)))
+        self.assertEqual(ids.shape, (1, 4))
+
+    @patch('backend.app.image_processor')
+    def test_generate_image_captions_uses_onnx_engine(self, mock_processor):
+        """The ONNX engine is used when loaded"""
+        captioner = MagicMock()
+        mock_processor.return_value = {"pixel_values": "pixels"}
+        mock_processor.batch_decode.return_value = ["a drawing of a dog"]
+        with patch('backend.app.onnx_captioner', captioner):
+            result = generate_image_captions([Image.new('RGB', (10, 10))])
+        self.assertEqual(result, ["a drawing of a dog"])
+        captioner.generate.assert_called_once_with("pixels")
+        self.assertEqual(mock_processor.call_args.kwargs['return_tensors'], 'np')
+
+
+class TestImageDecode(unittest.TestCase):
+    """Test the reduced-resolution upload decode path"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+
+    def encode(self, image, fmt):
+        buffer = io.BytesIO()
+        image.save(buffer, fmt)
+        buffer.seek(0)
+        return buffer
+
+    def test_large_jpeg_uses_draft_decode(self):
+        """Big JPEGs are decoded at reduced scale down to the short side"""
+        before = image_decode_stats.stats()['draftDecodes']
+        image = decode_upload_image(self.encode(Image.new('RGB', (4000, 3000), 'white'), 'JPEG'), short_side=448)
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(min(image.size), 448)
+        stats = image_decode_stats.stats()
+        self.assertEqual(stats['draftDecodes'], before + 1)
+        self.assertLess(stats['peakBitmapBytes']['max'], 4000 * 3000 * 3)
+
+    def test_small_images_are_untouched(self):
+        """Images already below the cap keep their size"""
+        image = decode_upload_image(self.encode(Image.new('RGB', (100, 80), 'blue'), 'PNG'), short_side=448)
+        self.assertEqual(image.size, (100, 80))
+
+    def test_panorama_keeps_model_resolution(self):
+        """Wide images are bounded by their short side, never below the model input"""
+        image = decode_upload_image(self.encode(Image.new('RGB', (3000, 600), 'white'), 'JPEG'))
+        self.assertEqual(image.size, decode_target_size(3000, 600))
+        self.assertGreater(min(image.size), 224)
+        self.assertAlmostEqual(image.width * image.height, 448 * 448 * 4, delta=2000)
+        self.assertEqual(decode_target_size(8000, 400), (4480, 224))
+
+    def test_pixel_limit(self):
+        """Images over the pixel budget are rejected from the header"""
+        with self.assertRaises(ImageTooLarge):
+            decode_upload_image(self.encode(Image.new('L', (300, 300)), 'PNG'), max_pixels=50000)
+
+    def test_transparent_sketch_gets_white_background(self):
+        """Transparent pixels become white, not black"""
+        image = decode_upload_image(self.encode(Image.new('RGBA', (20, 20), (0, 0, 0, 0)), 'PNG'))
+        self.assertEqual(image.getpixel((5, 5)), (255, 255, 255))
+
+    @patch('backend.app.MAX_IMAGE_PIXELS', 100)
+    def test_endpoint_rejects_oversized_and_non_images(self):
+        """The upload route answers 413 for bombs and 400 for non-images"""
+        response = self.app.post('/process-image',
+                                 data={'image': (self.encode(Image.new('RGB', (50, 50)), 'PNG'), 'big.png')},
+                                 content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 413)
+
+        response = self.app.post('/process-image',
+                                 data={'image': (io.BytesIO(b"not an image"), 'fake.png', 'image/png')},
+                                 content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestReadiness(unittest.TestCase):
+    """Test background model warm-up and the readiness endpoint"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+        saved = dict(model_state)
+        self.addCleanup(lambda: model_state.update(saved))
+
+    def test_not_ready_until_model_loaded(self):
+        """/ready is 503 before load and 200 after"""
+        self.assertEqual(self.app.get('/ready').status_code, 503)
+        with patch('backend.app.image_processor', MagicMock()), patch('backend.app.image_model', MagicMock()):
+            response = self.app.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.data)['ready'])
+
+    def test_process_image_fails_fast_while_loading(self):
+        """Caption requests get a quick 503 with Retry-After during warm-up"""
+        img_io = io.BytesIO()
+        Image.new('RGB', (30, 30), 'purple').save(img_io, 'PNG')
+        img_io.seek(0)
+        response = self.app.post('/process-image',
+                                 data={'image': (img_io, 'sketch.png')},
+                                 content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+
+    @patch('backend.app.generate_image_captions', return_value=["warm"])
+    @patch('backend.app.load_image_model')
+    def test_warm_up_reports_progress(self, mock_load, mock_captions):
+        """Warm-up loads the model, runs one caption and marks itself ready"""
+        warm_up_image_model()
+        self.assertEqual(model_state['status'], 'ready')
+        self.assertIsNotNone(model_state['readyAt'])
+        mock_captions.assert_called_once()
+
+    @patch('backend.app.load_image_model', side_effect=ValueError("no token"))
+    def test_warm_up_failure(self, mock_load):
+        """Load failures are reported rather than crashing the server"""
+        warm_up_image_model()
+        self.assertEqual(model_state['status'], 'failed')
+        self.assertIn('no token', model_state['error'])
+        self.assertEqual(json.loads(self.app.get('/ready').data)['model']['status'], 'failed')
+
+
+class TestCaptionServer(unittest.TestCase):
+    """Test out-of-process captioning over a Unix socket"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.socket_path = os.path.join(self.tmp.name, 'caption.sock')
+        self.server = make_caption_server(self.socket_path)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = CaptionServerClient(self.socket_path, timeout=5)
+        # Client and server share one process here, so the block is already tracked once
+        patcher = patch('backend.app.resource_tracker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('backend.app.is_captioner_ready', return_value=True)
+    def test_pixels_travel_through_shared_memory(self, mock_ready):
+        """The server sees the exact pixels the worker decoded"""
+        seen = []
+
+        def caption(images):
+            seen.extend(images)
+            return [f"{image.size[0]}x{image.size[1]}" for image in images]
+
+        image = Image.new('RGB', (40, 30), (10, 20, 30))
+        with patch('backend.app.generate_image_captions', side_effect=caption):
+            self.assertEqual(self.client.caption(image), "40x30")
+            self.assertEqual(self.client.caption(image.convert('L')), "40x30")
+        self.assertEqual(seen[0].tobytes(), image.tobytes())
+
+    def test_server_not_ready(self):
+        """A loading server makes the worker raise ModelNotReady"""
+        with self.assertRaises(ModelNotReady):
+            self.client.caption(Image.new('RGB', (8, 8)))
+        self.assertFalse(self.client.status()['ready'])
+
+    def test_unreachable_server(self):
+        """A missing socket is reported as not ready rather than crashing"""
+        client = CaptionServerClient(os.path.join(self.tmp.name, 'missing.sock'), timeout=1)
+        self.assertIsNone(client.status())
+        with self.assertRaises(ModelNotReady):
+            client.caption(Image.new('RGB', (8, 8)))
+
+    def test_slow_server_times_out_without_resending(self):
+        """A timeout is reported as such and the request is not sent twice"""
+        slow_path = os.path.join(self.tmp.name, 'slow.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(slow_path)
+        listener.listen(2)
+        self.addCleanup(listener.close)
+        received = []
+
+        def accept():
+            conn, _ = listener.accept()
+            received.append(conn.makefile('rb').readline())
+
+        threading.Thread(target=accept, daemon=True).start()
+        client = CaptionServerClient(slow_path, timeout=0.2)
+        with self.assertRaises(CaptionTimeout):
+            client.caption(Image.new('RGB', (8, 8)))
+        time.sleep(0.1)
+        self.assertEqual(len(received), 1)
+
+        with patch('backend.app.caption_server_client', client):
+            data = {'image': (io.BytesIO(self.png()), 'a.png')}
+            response = app.test_client().post('/process-image', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 504)
+
+    def png(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), (1, 2, 3)).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def test_ready_endpoint_uses_server_status(self):
+        """/ready reflects the caption server when one is configured"""
+        with patch('backend.app.caption_server_client', self.client):
+            response = app.test_client().get('/ready')
+        self.assertEqual(response.status_code, 503)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the Prometheus metrics"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+        story_cache.clear()
+
+    def sample(self, name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    def test_metrics_endpoint(self):
+        """/metrics serves the Prometheus text format"""
+        self.app.get('/health')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('text/plain', response.content_type)
+        body = response.data.decode('utf-8')
+        self.assertIn('sketch2story_request_seconds_bucket', body)
+        self.assertIn('endpoint="/health"', body)
+
+    def test_request_labels_use_route_patterns(self):
+        """Ids in URLs are collapsed into the route pattern"""
+        self.app.get('/jobs/abc123')
+        labels = {'endpoint': '/jobs/<job_id>', 'method': 'GET', 'status': '404'}
+        self.assertGreaterEqual(self.sample('sketch2story_request_seconds_count', labels), 1)
+        self.assertEqual(self.sample('sketch2story_requests_in_flight', {'endpoint': '/jobs/<job_id>'}), 0)
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.client')
+    def test_token_usage_per_level(self, mock_client):
+        """Prompt and completion tokens are counted per vocabulary level"""
+        labels = {'operation': 'story', 'kind': 'completion', 'vocabulary_level': 'advanced'}
+        before = self.sample('sketch2story_openai_tokens_total', labels)
+        stage_before = self.sample('sketch2story_stage_seconds_count', {'stage': 'story'})
+        mock_response = MagicMock()
+        mock_response.choices[0].message.content = "A story"
+        mock_response.usage.prompt_tokens = 120
+        mock_response.usage.completion_tokens = 300
+        mock_client.chat.completions.create.return_value = mock_response
+
+        generate_story("A lion", "bravery", "short", "advanced")
+
+        self.assertEqual(self.sample('sketch2story_openai_tokens_total', labels) - before, 300)
+        self.assertEqual(self.sample('sketch2story_stage_seconds_count', {'stage': 'story'}) - stage_before, 1)
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.client')
+    def test_streamed_request_leaves_gauge_at_zero(self, mock_client, mock_vocab):
+        """Streamed responses tear down twice but are only counted out once"""
+        chunk = MagicMock()
+        chunk.choices[0].delta.content = "Once upon a time."
+        mock_client.chat.completions.create.return_value = iter([chunk])
+        payload = json.dumps({'imageDescription': 'A moth', 'keywords': 'light'})
+        response = self.app.post('/generate-story/stream', data=payload, content_type='application/json')
+        response.get_data()
+        response.close()
+        self.assertEqual(self.sample('sketch2story_requests_in_flight', {'endpoint': '/generate-story/stream'}), 0)
+
+    def test_unknown_levels_share_one_label(self):
+        """Client-supplied levels never become new label values"""
+        self.assertEqual(level_label('advanced'), 'advanced')
+        self.assertEqual(level_label('none'), 'none')
+        self.assertEqual(level_label('x' * 40), 'other')
+
+    @patch('backend.app.generate_image_caption', return_value="a drawing")
+    def test_caption_and_decode_stages(self, mock_caption):
+        """Uploads record decode and caption stage latency"""
+        before = {stage: self.sample('sketch2story_stage_seconds_count', {'stage': stage})
+                  for stage in ('decode', 'caption')}
+        img_io = io.BytesIO()
+        Image.new('RGB', (20, 20), 'orange').save(img_io, 'PNG')
+        img_io.seek(0)
+        self.app.post('/process-image', data={'image': (img_io, 'a.png')}, content_type='multipart/form-data')
+        for stage in ('decode', 'caption'):
+            self.assertEqual(self.sample('sketch2story_stage_seconds_count', {'stage': stage}) - before[stage], 1)
+
+    @patch('backend.app.generate_audio_narration', return_value=None)
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.generate_story', return_value="Twelve chars")
+    def test_tts_characters_per_level(self, mock_story, mock_vocab, mock_audio):
+        """Narrated characters are counted per vocabulary level"""
+        before = self.sample('sketch2story_tts_characters_total', {'vocabulary_level': 'beginner'})
+        payload = {'imageDescription': 'A frog', 'keywords': 'jumping', 'vocabularyLevel': 'beginner',
+                   'generateAudio': True}
+        self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(self.sample('sketch2story_tts_characters_total', {'vocabulary_level': 'beginner'}) - before, 12)
+
+
+class TestLocalVocabulary(unittest.TestCase):
+    """Test the local level-aware vocabulary engine"""
+
+    STORY = ("Luna the curious fox wondered where the river went. She packed a tiny bag and set off on a "
+             "brave adventure through the forest. Along the path she discovered a hidden cave that seemed "
+             "mysterious and enormous. Luna felt grateful for her courage and decided to share the "
+             "magnificent treasure with her family.")
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+
+    def test_syllable_helpers(self):
+        self.assertEqual(parse_syllable_range("1-2 syllables"), (1, 2))
+        self.assertEqual(parse_syllable_range("3+ syllables"), (3, 99))
+        self.assertEqual(count_syllables("brave"), 1)
+        self.assertEqual(count_syllables("jumped"), 1)
+        self.assertEqual(count_syllables("adventure"), 3)
+
+    def test_words_match_level_syllables(self):
+        """Each level gets 6-8 lexicon words within its target_length"""
+        for level, info in VOCABULARY_LEVELS.items():
+            low, high = parse_syllable_range(info['target_length'])
+            words = vocabulary_engine.extract(self.STORY, level)
+            self.assertTrue(6 <= len(words) <= 8, level)
+            in_range = [w for w in words if low <= count_syllables(w['word']) <= high]
+            self.assertGreaterEqual(len(in_range), 5, level)
+
+    def test_inflected_words_and_story_sentences(self):
+        words = {w['word']: w for w in vocabulary_engine.extract(self.STORY, "intermediate")}
+        self.assertIn("Discover", words)
+        self.assertEqual(words["Discover"]["story_sentence"],
+                         "Along the path she discovered a hidden cave that seemed mysterious and enormous.")
+        self.assertEqual(words["Discover"]["definition"], "To find something for the first time")
+        self.assertNotIn("Luna", words)
+
+    @patch('backend.app.STORY_GENERATION_MODE', 'separate')
+    @patch('backend.app.generate_story', return_value=STORY)
+    @patch('backend.app.extract_vocabulary_words')
+    def test_pipeline_defaults_to_local(self, mock_gpt_vocab, mock_story):
+        """The story endpoint skips the GPT-4 vocabulary call unless asked for it"""
+        payload = {'imageDescription': 'A fox', 'keywords': 'courage', 'vocabularyLevel': 'advanced'}
+        response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertIn("Magnificent", [w['word'] for w in data['vocabularyWords']])
+        mock_gpt_vocab.assert_not_called()
+
+        mock_gpt_vocab.return_value = [{"word": "Courage"}]
+        payload['vocabularyMode'] = 'gpt'
+        response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(json.loads(response.data)['vocabularyWords'], [{"word": "Courage"}])
+
+    def test_invalid_vocabulary_mode(self):
+        payload = {'imageDescription': 'A fox', 'keywords': 'courage', 'vocabularyMode': 'psychic'}
+        response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestCombinedStoryVocabulary(unittest.TestCase):
+    """Test the single-call story + vocabulary mode"""
+
+    REPLY = json.dumps({
+        "story": "Max the bear waited with patience.",
+        "vocabulary": [{"word": "Patience", "definition": "Waiting calmly",
+                        "story_sentence": "Max the bear waited with patience.",
+                        "example_sentence": "Fishing takes patience."}]
+    })
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.payload = json.dumps({'imageDescription': 'A bear', 'keywords': 'patience', 'vocabularyMode': 'gpt'})
+
+    def reply(self, content):
+        response = MagicMock()
+        response.choices[0].message.content = content
+        return response
+
+    def test_parse_validates_schema(self):
+        story, vocabulary = parse_story_with_vocabulary("```json\n" + self.REPLY + "\n```")
+        self.assertEqual(story, "Max the bear waited with patience.")
+        self.assertEqual(vocabulary[0]["word"], "Patience")
+        self.assertIsNone(parse_story_with_vocabulary("Once upon a time..."))
+        self.assertIsNone(parse_story_with_vocabulary(json.dumps({"story": "Hi", "vocabulary": [{"word": 1}]})))
+        self.assertIsNone(parse_story_with_vocabulary(json.dumps({"story": "", "vocabulary": []})))
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.extract_vocabulary_words')
+    @patch('backend.app.client')
+    def test_one_call_returns_story_and_vocabulary(self, mock_client, mock_vocab):
+        mock_client.chat.completions.create.return_value = self.reply(self.REPLY)
+        response = self.app.post('/generate-story', data=self.payload, content_type='application/json')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['story'], "Max the bear waited with patience.")
+        self.assertEqual(data['vocabularyWords'][0]['word'], "Patience")
+        mock_client.chat.completions.create.assert_called_once()
+        mock_vocab.assert_not_called()
+
+    @patch.dict(os.environ, {'OPENAI_API_KEY': 'sk-test-key'})
+    @patch('backend.app.extract_vocabulary_words', return_value=[{"word": "Calm"}])
+    @patch('backend.app.generate_story', return_value="A plain story.")
+    @patch('backend.app.client')
+    def test_unparseable_reply_falls_back_to_two_calls(self, mock_client, mock_story, mock_vocab):
+        mock_client.chat.completions.create.return_value = self.reply("Sorry, here is a story without JSON.")
+        response = self.app.post('/generate-story', data=self.payload, content_type='application/json')
+        data = json.loads(response.data)
+
+        self.assertEqual(data['story'], "A plain story.")
+        self.assertEqual(data['vocabularyWords'], [{"word": "Calm"}])
+        mock_story.assert_called_once()
+        mock_vocab.assert_called_once()
+
+
+class TestResilientUpstream(unittest.TestCase):
+    """Test deadline budgets, hedging and circuit breaking of upstream calls"""
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown(wait=False)
+
+    def test_stage_budgets_follow_request_deadline(self):
+        token = request_deadline.set(time.monotonic() + 10)
+        try:
+            self.assertAlmostEqual(stage_timeout("story"), 6.0, delta=0.1)
+            self.assertAlmostEqual(stage_timeout("tts"), 10.0, delta=0.1)
+        finally:
+            request_deadline.reset(token)
+
+        token = request_deadline.set(time.monotonic() - 1)
+        try:
+            upstream = ResilientUpstream("test", self.executor)
+            request = MagicMock()
+            with self.assertRaises(DeadlineExceeded):
+                upstream.call(request, stage="story")
+            request.assert_not_called()
+        finally:
+            request_deadline.reset(token)
+
+    def test_breaker_opens_and_recovers(self):
+        upstream = ResilientUpstream("test", self.executor, failure_threshold=2, reset_seconds=0.1)
+
+        def down(timeout):
+            raise ConnectionError("refused")
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                upstream.call(down, stage="story")
+        self.assertEqual(upstream.stats()["state"], "open")
+
+        request = MagicMock(return_value="ok")
+        with self.assertRaises(UpstreamUnavailable):
+            upstream.call(request, stage="story")
+        request.assert_not_called()
+
+        time.sleep(0.15)
+        self.assertEqual(upstream.call(request, stage="story"), "ok")
+        self.assertEqual(upstream.stats()["state"], "closed")
+        self.assertEqual(upstream.stats()["shortCircuited"], 1)
+
+    def test_open_breaker_spends_no_quota(self):
+        scheduler = QuotaScheduler("test", requests_per_minute=60)
+        upstream = ResilientUpstream("test", self.executor, failure_threshold=1, reset_seconds=60, scheduler=scheduler)
+
+        def down(timeout):
+            raise ConnectionError("refused")
+
+        with self.assertRaises(ConnectionError):
+            upstream.call(down, stage="story")
+        available = scheduler.stats()["requestsAvailable"]
+        with self.assertRaises(UpstreamUnavailable):
+            upstream.call(down, stage="story")
+        self.assertGreaterEqual(scheduler.stats()["requestsAvailable"], available)
+
+    def test_retries_get_the_remaining_budget(self):
+        upstream = ResilientUpstream("test", self.executor, retries=1)
+        timeouts = []
+
+        def flaky(timeout):
+            timeouts.append(timeout)
+            if len(timeouts) == 1:
+                time.sleep(0.2)
+                raise ConnectionError("reset")
+            return "ok"
+
+        token = request_deadline.set(time.monotonic() + 5)
+        try:
+            self.assertEqual(upstream.call(flaky, stage="tts"), "ok")
+        finally:
+            request_deadline.reset(token)
+        self.assertEqual(len(timeouts), 2)
+        self.assertLessEqual(timeouts[1], timeouts[0] - 0.2)
+
+    def test_client_errors_do_not_trip_breaker(self):
+        upstream = ResilientUpstream("test", self.executor, failure_threshold=1)
+
+        def bad_request(timeout):
+            raise ValueError("invalid voice")
+
+        with self.assertRaises(ValueError):
+            upstream.call(bad_request, stage="tts")
+        self.assertEqual(upstream.stats()["state"], "closed")
+
+    def test_slow_call_is_hedged(self):
+        upstream = ResilientUpstream("test", self.executor, hedge_percentile=90, hedge_min_samples=3)
+        for _ in range(3):
+            upstream.call(lambda timeout: "warm", stage="story")
+
+        calls = []
+
+        def sometimes_stuck(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                time.sleep(1)
+                return "slow"
+            return "fast"
+
+        started = time.monotonic()
+        self.assertEqual(upstream.call(sometimes_stuck, stage="story"), "fast")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(upstream.stats()["hedgeWins"], 1)
+        self.assertIsNone(upstream.hedge_delay("tts"))
+
+    def test_queued_calls_are_cancelled_at_the_deadline(self):
+        busy = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(busy.shutdown, wait=False)
+        upstream = ResilientUpstream("test", busy, hedge_percentile=90, hedge_min_samples=3)
+        for _ in range(3):
+            upstream.call(lambda timeout: "warm", stage="story")
+        release = threading.Event()
+        busy.submit(release.wait, 5)
+        calls = []
+
+        token = request_deadline.set(time.monotonic() + 0.3)
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                upstream.call(lambda timeout: calls.append(timeout), stage="story")
+        finally:
+            request_deadline.reset(token)
+        release.set()
+        time.sleep(0.1)
+        self.assertEqual(calls, [])
+        self.assertEqual(upstream.stats()["hedged"], 0)
+
+
+class TestClassroomBatch(unittest.TestCase):
+    """Test the multi-sketch classroom endpoint"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+        story_cache.clear()
+
+    def sketch(self, colour):
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), colour).save(buffer, format='PNG')
+        buffer.seek(0)
+        return buffer
+
+    def parse_events(self, body):
+        events = []
+        for block in body.decode('utf-8').strip().split('\n\n'):
+            lines = dict(line.split(': ', 1) for line in block.split('\n'))
+            events.append((lines['event'], json.loads(lines['data'])))
+        return events
+
+    @patch('backend.app.generate_story', side_effect=lambda description, *args: f"A story about {description}.")
+    @patch('backend.app.is_captioner_ready', return_value=True)
+    @patch('backend.app.caption_server_client', None)
+    def test_batch_captions_once_and_streams_each_child(self, mock_ready, mock_story):
+        batches = []
+
+        def captions(images):
+            batches.append(len(images))
+            return [f"drawing {i}" for i in range(len(images))]
+
+        data = {
+            'images': [(self.sketch('red'), 'a.png'), (self.sketch('blue'), 'b.png'),
+                       (io.BytesIO(b'not an image'), 'c.txt')],
+            'names': ['Ava', 'Ben', 'Cy'],
+            'keywords': 'sharing',
+            'vocabularyLevel': 'beginner'
+        }
+        with patch('backend.app.generate_image_captions', side_effect=captions):
+            response = self.app.post('/classroom', data=data, content_type='multipart/form-data')
+            events = self.parse_events(response.get_data())
+
+        self.assertEqual(response.status_code, 200)
+        # Captions go through the shared batcher, which owns the model
+        self.assertEqual(batches, [2])
+        children = {child['index']: child for event, child in events if event == 'child'}
+        self.assertEqual(children[2]['error'], "File must be an image")
+        self.assertEqual(children[0]['name'], 'Ava')
+        self.assertEqual({children[0]['story'], children[1]['story']},
+                         {"A story about drawing 0.", "A story about drawing 1."})
+        self.assertEqual(events[-1], ('done', {'total': 3, 'completed': 2, 'failed': 1}))
+
+    def test_requires_keywords(self):
+        data = {'images': [(self.sketch('red'), 'a.png')]}
+        response = self.app.post('/classroom', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+
+    @patch('backend.app.is_captioner_ready', return_value=False)
+    @patch('backend.app.caption_server_client', None)
+    def test_model_not_ready(self, mock_ready):
+        data = {'images': [(self.sketch('green'), 'a.png')], 'keywords': 'kindness'}
+        response = self.app.post('/classroom', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 503)
+
+
+class TestQuotaScheduler(unittest.TestCase):
+    """Test rate-limit token buckets and priority lanes"""
+
+    def test_waits_for_token_refill(self):
+        scheduler = QuotaScheduler("test", tokens_per_minute=600)  # 10 tokens per second
+        self.assertLess(scheduler.acquire(600), 0.05)
+        waited = scheduler.acquire(5)
+        self.assertGreaterEqual(waited, 0.4)
+        self.assertEqual(scheduler.stats()["granted"]["interactive"], 2)
+
+    def test_interactive_overtakes_batch(self):
+        scheduler = QuotaScheduler("test", tokens_per_minute=6000)  # 100 tokens per second
+        scheduler.acquire(6000)
+        order = []
+
+        def take(lane):
+            scheduler.acquire(20, lane=lane)
+            order.append(lane)
+
+        batch = threading.Thread(target=take, args=("batch",))
+        batch.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=take, args=("interactive",))
+        interactive.start()
+        batch.join(2)
+        interactive.join(2)
+        self.assertEqual(order, ["interactive", "batch"])
+
+    def test_times_out_and_leaves_queue(self):
+        scheduler = QuotaScheduler("test", requests_per_minute=1)
+        scheduler.acquire()
+        with self.assertRaises(QuotaTimeout):
+            scheduler.acquire(timeout=0.05)
+        self.assertEqual(scheduler.stats()["queued"], {"interactive": 0, "batch": 0})
+        self.assertEqual(scheduler.stats()["timeouts"], 1)
+
+    def test_rate_limited_call_is_retried(self):
+        class TooManyRequests(Exception):
+            pass
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown, wait=False)
+        scheduler = QuotaScheduler("test", requests_per_minute=600)
+        upstream = ResilientUpstream("test", executor, failure_threshold=1, scheduler=scheduler)
+        attempts = []
+
+        def request(timeout):
+            attempts.append(timeout)
+            if len(attempts) == 1:
+                raise TooManyRequests()
+            return "ok"
+
+        with patch('backend.app.is_rate_limited', side_effect=lambda e: isinstance(e, TooManyRequests)), \
+                patch('backend.app.retry_after_seconds', return_value=0.05):
+            self.assertEqual(upstream.call(request, stage="story"), "ok")
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(upstream.stats()["state"], "closed")
+        self.assertEqual(scheduler.stats()["rateLimited"], 1)
+
+    def test_estimate_chat_tokens(self):
+        self.assertEqual(estimate_chat_tokens([{"content": "a" * 400}], 100), 200)
+
+
+class TestSimilarStoryReuse(unittest.TestCase):
+    """Test the approximate-match story tier"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.index = SimilarStoryIndex(threshold=0.8)
+        self.index.add(story_cache_key("a drawing of a cat", "kindness", "short", "beginner"), "The cat story.")
+
+    def test_near_identical_caption_reuses_story(self):
+        story, similarity = self.index.lookup(story_cache_key("a sketch of a cat sitting", "Kindness", "short", "beginner"))
+        self.assertEqual(story, "The cat story.")
+        self.assertGreaterEqual(similarity, 0.8)
+
+    def test_different_subject_or_lesson_misses(self):
+        self.assertIsNone(self.index.lookup(story_cache_key("a drawing of a red car", "kindness", "short", "beginner"))[0])
+        self.assertIsNone(self.index.lookup(story_cache_key("a drawing of a cat", "honesty", "short", "beginner"))[0])
+        self.assertIsNone(self.index.lookup(story_cache_key("a drawing of a cat", "kindness", "short", "advanced"))[0])
+        stats = self.index.stats()
+        self.assertEqual((stats["lookups"], stats["hits"]), (3, 0))
+
+    def test_new_stories_match_before_refit(self):
+        """Stories added between refits are vectorized with the current vocabulary"""
+        index = SimilarStoryIndex(threshold=0.5, refit_every=3)
+        index.add(story_cache_key("a drawing of a cat", "kindness", "short", "beginner"), "The kind cat story.")
+        index.add(story_cache_key("a drawing of a cat", "sharing", "short", "beginner"), "The cat story.")
+        self.assertEqual(index.stats()["refits"], 1)
+        story, _ = index.lookup(story_cache_key("a sketch of a cat sitting", "sharing", "short", "beginner"))
+        self.assertEqual(story, "The cat story.")
+
+        with patch.object(index, 'refit') as refit:
+            index.add(story_cache_key("a drawing of a bird", "sharing", "short", "beginner"), "The bird story.")
+            index.add(story_cache_key("a drawing of a fish", "sharing", "short", "beginner"), "The fish story.")
+            deadline = time.monotonic() + 1
+            while not refit.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+        refit.assert_called_once()
+
+    @patch('backend.app.generate_story', return_value="A fresh story.")
+    def test_pipeline_serves_similar_story(self, mock_story):
+        payload = {'imageDescription': 'a drawing of a cat sitting', 'keywords': 'kindness',
+                   'vocabularyLevel': 'beginner'}
+        with patch('backend.app.similar_story_index', self.index):
+            response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(json.loads(response.data)['story'], "The cat story.")
+            mock_story.assert_not_called()
+
+            payload['imageDescription'] = 'a drawing of a rocket ship'
+            response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(json.loads(response.data)['story'], "A fresh story.")
+        self.assertEqual(self.index.stats()["entries"], 2)
+        self.assertEqual(self.index.stats()["hitRate"], 0.5)
+
+    @patch('backend.app.generate_story', return_value="A fresh story.")
+    def test_exact_cache_answers_before_similarity(self, mock_story):
+        payload = {'imageDescription': 'a drawing of a cat', 'keywords': 'kindness', 'vocabularyLevel': 'beginner'}
+        story_cache.put(story_cache_key('a drawing of a cat', 'kindness', 'short', 'beginner'), "The exact story.")
+        with patch('backend.app.similar_story_index', self.index):
+            response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(json.loads(response.data)['story'], "The exact story.")
+        self.assertEqual(self.index.stats()["lookups"], 0)
+
+
+class TestChunkedNarration(unittest.TestCase):
+    """Test paragraph-chunked parallel narration and MP3 stitching"""
+
+    FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413  # 128 kbps 44.1 kHz MPEG-1 Layer III frame
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = patch('backend.app.audio_store', AudioStore(self.tmp.name, max_bytes=10**7))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mp3(self, label):
+        """A chunk as TTS returns it: ID3v2 tag, Xing frame, audio frames, ID3v1 tag"""
+        id3 = b"ID3\x04\x00\x00\x00\x00\x00\x05" + b"meta!"
+        xing = self.FRAME[:36] + b"Xing" + self.FRAME[40:]
+        return id3 + xing + self.FRAME + label.encode() + b"TAG" + b"\x00" * 125
+
+    def fake_speech(self, **kwargs):
+        time.sleep(0.05 if kwargs['input'].startswith('First') else 0)
+        return MagicMock(content=self.mp3(kwargs['input'].split()[0]))
+
+    def test_split_at_paragraphs_then_sentences(self):
+        text = "Short one.\n\nShort two.\n\n" + "A long sentence that keeps going and going. " * 3
+        chunks = split_narration_text(text, max_chars=60)
+        self.assertEqual(chunks[0], "Short one.\n\nShort two.")
+        self.assertTrue(all(len(chunk) <= 60 for chunk in chunks))
+        self.assertTrue(all(chunk.endswith(".") for chunk in chunks))
+        self.assertEqual(split_narration_text("Tiny story."), ["Tiny story."])
+
+    def test_strip_mp3_metadata(self):
+        self.assertEqual(strip_mp3_metadata(self.mp3("x")), self.FRAME + b"x")
+        self.assertEqual(strip_mp3_metadata(self.FRAME), self.FRAME)
+
+    @patch('backend.app.client')
+    def test_chunks_synthesized_in_parallel_and_joined_in_order(self, mock_client):
+        mock_client.audio.speech.create.side_effect = self.fake_speech
+        story = "First part of the story is here.\n\nSecond part follows it.\n\nThird part ends it all well."
+        with patch('backend.app.NARRATION_CHUNK_CHARS', 40), patch('backend.app.NARRATION_SPLIT_MIN_CHARS', 0):
+            artifact_id = generate_audio_narration(story, voice="fable")
+
+        with open(self.tmp.name + f"/{artifact_id}.mp3", "rb") as audio_file:
+            audio = audio_file.read()
+        self.assertEqual(audio, b"".join(self.FRAME + label for label in (b"First", b"Second", b"Third")))
+        calls = mock_client.audio.speech.create.call_args_list
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(all(c.kwargs['voice'] == 'fable' and c.kwargs['speed'] == 0.9 for c in calls))
+
+    @patch('backend.app.client')
+    def test_short_story_is_one_tts_call(self, mock_client):
+        mock_client.audio.speech.create.side_effect = self.fake_speech
+        story = "\n\n".join(["First the little fox looked around the quiet forest and wondered where to go. " * 4] * 3)
+        self.assertGreater(len(story), 700)
+        generate_audio_narration(story, voice="nova")
+        mock_client.audio.speech.create.assert_called_once()
+        self.assertEqual(mock_client.audio.speech.create.call_args.kwargs['input'], story)
+
+    @patch('backend.app.client')
+    def test_narrate_streams_chunks_in_order(self, mock_client):
+        mock_client.audio.speech.create.side_effect = self.fake_speech
+        text = "First part of the story is here.\n\nSecond part follows it."
+        with patch('backend.app.NARRATION_CHUNK_CHARS', 40), patch('backend.app.NARRATION_SPLIT_MIN_CHARS', 0):
+            response = self.app.post('/narrate', data=json.dumps({'text': text}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.FRAME + b"First" + self.FRAME + b"Second")
+        mock_client.audio.speech.with_streaming_response.create.assert_not_called()
+
+    @patch('backend.app.client')
+    def test_narrate_accepts_text_over_tts_limit(self, mock_client):
+        mock_client.audio.speech.create.side_effect = self.fake_speech
+        text = "\n\n".join(["Once upon a time a small fox walked through the forest. " * 20] * 6)
+        self.assertGreater(len(text), TTS_MAX_INPUT_CHARS)
+        with patch('backend.app.NARRATION_SPLIT_MIN_CHARS', 10**6):
+            response = self.app.post('/narrate', data=json.dumps({'text': text}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        inputs = [c.kwargs['input'] for c in mock_client.audio.speech.create.call_args_list]
+        self.assertGreater(len(inputs), 1)
+        self.assertTrue(all(len(chunk) <= TTS_MAX_INPUT_CHARS for chunk in inputs))
+        mock_client.audio.speech.with_streaming_response.create.assert_not_called()
+
+    @patch('backend.app.client')
+    def test_chunk_failure(self, mock_client):
+        mock_client.audio.speech.create.side_effect = Exception("TTS down")
+        text = "First part of the story is here.\n\nSecond part follows it."
+        with patch('backend.app.NARRATION_CHUNK_CHARS', 40), patch('backend.app.NARRATION_SPLIT_MIN_CHARS', 0):
+            self.assertIsNone(generate_audio_narration(text))
+            response = self.app.post('/narrate', data=json.dumps({'text': text}), content_type='application/json')
+        self.assertEqual(response.status_code, 502)
+
+
+class TestNarrationCache(unittest.TestCase):
+    """Test the narration cache keyed by text, voice, model and speed"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = AudioStore(self.tmp.name, max_bytes=10**7)
+        patcher = patch('backend.app.audio_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_narration_key(self):
+        key = narration_key("A tale.", "nova")
+        self.assertEqual(key, narration_key("A tale.", "nova"))
+        self.assertNotEqual(key, narration_key("A tale.", "fable"))
+        self.assertNotEqual(key, narration_key("A tale.", "nova", speed=1.0))
+        self.assertNotEqual(key, narration_key("A tale!", "nova"))
+
+    @patch('backend.app.client')
+    def test_repeat_narration_hits_cache(self, mock_client):
+        mock_client.audio.speech.create.return_value = MagicMock(content=b"audio")
+        first = generate_audio_narration("The owl hooted.", "nova")
+        self.assertEqual(generate_audio_narration("The owl hooted.", "nova"), first)
+        mock_client.audio.speech.create.assert_called_once()
+
+        generate_audio_narration("The owl hooted.", "shimmer")
+        self.assertEqual(mock_client.audio.speech.create.call_count, 2)
+        stats = self.store.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_concurrent_requests_render_once(self):
+        calls = []
+
+        def create():
+            calls.append(1)
+            time.sleep(0.1)
+            return b"audio"
+
+        key = narration_key("Shared story.", "nova")
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: self.store.get_or_create(key, create), range(4)))
+        self.assertEqual(results, [key] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.store.stats()['coalesced'], 3)
+
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.generate_story', return_value="A prerendered tale.")
+    @patch('backend.app.client')
+    def test_prerender_in_batch_lane(self, mock_client, mock_story, mock_vocab):
+        lanes = []
+
+        def fake_speech(**kwargs):
+            lanes.append(request_priority.get())
+            return MagicMock(content=b"nova audio")
+
+        mock_client.audio.speech.create.side_effect = fake_speech
+        prerenderer = NarrationPrerenderer(voice="nova", workers=1, queue_limit=1)
+        with patch('backend.app.narration_prerenderer', prerenderer), \
+                patch('backend.app.STORY_GENERATION_MODE', 'separate'):
+            payload = {'imageDescription': 'An owl', 'keywords': 'night', 'vocabularyMode': 'gpt'}
+            response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            prerenderer._executor.shutdown(wait=True)
+
+        self.assertEqual(lanes, ["batch"])
+        self.assertIsNotNone(self.store.get_path(narration_key("A prerendered tale.", "nova")))
+        self.assertEqual(prerenderer.stats()['rendered'], 1)
+        self.assertFalse(prerenderer.submit("A prerendered tale."))
+
+
+class TestUploadLimits(unittest.TestCase):
+    """Test size caps, header sniffing and spooling of uploads"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        caption_cache.clear()
+
+    def png(self, size=(64, 64)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'green').save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def upload(self, data, filename='sketch.png'):
+        return self.app.post('/process-image', data={'image': (io.BytesIO(data), filename)},
+                             content_type='multipart/form-data')
+
+    def test_sniff_rejects_before_rest_is_buffered(self):
+        upload = SniffedUpload(max_bytes=10**6, memory_bytes=10**5, sniff_bytes=1024, max_pixels=100)
+        with self.assertRaises(UploadRejected) as raised:
+            upload.write(self.png()[:512])
+        self.assertEqual((raised.exception.code, raised.exception.reason), (413, "too_many_pixels"))
+        self.assertEqual(upload.tell(), 0)
+
+        upload = SniffedUpload(max_bytes=10**6, memory_bytes=10**5, sniff_bytes=1024, max_pixels=100, strict=False)
+        upload.write(b"%PDF-1.7 not a sketch")
+        upload.write(b"x" * 4096)
+        self.assertEqual(upload.rejection.reason, "not_an_image")
+        self.assertEqual(upload.tell(), 0)
+
+    def test_large_upload_spools_to_disk(self):
+        data = self.png() + b"\x00" * 5000
+        upload = SniffedUpload(max_bytes=10**6, memory_bytes=1000, sniff_bytes=1024, max_pixels=10**6)
+        for start in range(0, len(data), 1000):
+            upload.write(data[start:start + 1000])
+        self.assertTrue(upload.spooled_to_disk)
+        self.assertLessEqual(upload.peak_memory_bytes, 1000)
+        self.assertEqual(upload.received, len(data))
+
+    @patch('backend.app.generate_image_caption', return_value="a sketch")
+    def test_process_image_rejections(self, mock_caption):
+        before = upload_stats.stats()['rejected']
+        response = self.upload(b"GIF? no, just text pretending to be an image")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['error'], "File must be an image")
+
+        with patch('backend.app.MAX_IMAGE_PIXELS', 1000):
+            response = self.upload(self.png())
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("64x64", json.loads(response.data)['error'])
+
+        with patch.dict(app.config, MAX_CONTENT_LENGTH=100):
+            response = self.upload(self.png())
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('error', json.loads(response.data))
+
+        rejected = upload_stats.stats()['rejected']
+        for reason in ("not_an_image", "too_many_pixels", "too_many_bytes"):
+            self.assertEqual(rejected.get(reason, 0), before.get(reason, 0) + 1)
+        mock_caption.assert_not_called()
+
+    @patch('backend.app.generate_image_caption', return_value="a sketch")
+    def test_upload_stats(self, mock_caption):
+        files = upload_stats.stats()['files']
+        self.assertEqual(self.upload(self.png()).status_code, 200)
+        stats = json.loads(self.app.get('/stats').data)['uploads']
+        self.assertEqual(stats['files'], files + 1)
+        self.assertGreater(stats['requestMemoryBytes']['max'], 0)
+
+
+class TestAsyncServing(unittest.TestCase):
+    """Test the ASGI /generate-story route and the async upstream policy"""
+
+    def setUp(self):
+        story_cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patches = {
+            'audio_store': AudioStore(self.tmp.name, max_bytes=10**7),
+            'chat_upstream': ResilientUpstream("chat", upstream_executor, hedge_percentile=0),
+            'tts_upstream': ResilientUpstream("tts", upstream_executor, hedge_percentile=0),
+            'similar_story_index': None
+        }
+        for name, value in patches.items():
+            patcher = patch(f'backend.app.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, body):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/generate-story"}
+        asyncio.run(generate_story_asgi(scope, receive, send))
+        return messages[0]["status"], json.loads(messages[1]["body"])
+
+    @patch('backend.app.client')
+    @patch('backend.app.async_client')
+    def test_story_and_audio_use_async_client(self, mock_async, mock_sync):
+        completion = MagicMock(usage=None)
+        completion.choices[0].message.content = "The brave kitten shared her yarn with a friend."
+        mock_async.chat.completions.create = AsyncMock(return_value=completion)
+        mock_async.audio.speech.create = AsyncMock(return_value=MagicMock(content=b"mp3"))
+
+        payload = {'imageDescription': 'A kitten', 'keywords': 'sharing', 'generateAudio': True,
+                   'vocabularyMode': 'local'}
+        status, data = self.call(json.dumps(payload).encode())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['story'], "The brave kitten shared her yarn with a friend.")
+        self.assertTrue(data['audioGenerated'])
+        self.assertIsInstance(data['vocabularyWords'], list)
+        self.assertEqual(mock_async.audio.speech.create.call_args.kwargs['speed'], 0.9)
+        mock_sync.chat.completions.create.assert_not_called()
+
+    def test_validation(self):
+        self.assertEqual(self.call(b"not json")[0], 400)
+        self.assertEqual(self.call(json.dumps({'imageDescription': 'A kitten'}).encode())[0], 400)
+        with patch('backend.app.UPLOAD_MAX_BYTES', 10):
+            self.assertEqual(self.call(b'{"imageDescription": "A kitten"}')[0], 413)
+
+    def test_async_call_timeout_opens_breaker(self):
+        upstream = ResilientUpstream("slow", upstream_executor, failure_threshold=1, hedge_percentile=0)
+
+        async def scenario():
+            request_deadline.set(time.monotonic() + 0.05)
+            with self.assertRaises(DeadlineExceeded):
+                await upstream.call_async(lambda timeout: asyncio.sleep(1), stage="vocabulary")
+            request_deadline.set(time.monotonic() + 5)
+            with self.assertRaises(UpstreamUnavailable):
+                await upstream.call_async(lambda timeout: asyncio.sleep(0), stage="vocabulary")
+
+        asyncio.run(scenario())
+        self.assertEqual(upstream.stats()['state'], 'open')
+
+    def test_acquire_async_waits_in_the_quota_queue(self):
+        scheduler = QuotaScheduler("test", requests_per_minute=6000)
+        scheduler.back_off(0.1)
+        self.assertGreaterEqual(asyncio.run(scheduler.acquire_async()), 0.09)
+
+        scheduler.back_off(1.0)
+        with self.assertRaises(QuotaTimeout):
+            asyncio.run(scheduler.acquire_async(timeout=0.05))
+        self.assertEqual(scheduler.stats()['queued']['interactive'], 0)
+
+
+class TestRequestTracing(unittest.TestCase):
+    """Test trace ids, span waterfalls and the sampled JSON-lines log"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        story_cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.log = TraceLog(os.path.join(self.tmp.name, "traces.jsonl"), flush_seconds=60)
+        patches = {
+            'trace_log': self.log,
+            'audio_store': AudioStore(self.tmp.name, max_bytes=10**7),
+            'chat_upstream': ResilientUpstream("chat", upstream_executor, hedge_percentile=0),
+            'tts_upstream': ResilientUpstream("tts", upstream_executor, hedge_percentile=0),
+            'similar_story_index': None
+        }
+        for name, value in patches.items():
+            patcher = patch(f'backend.app.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def records(self):
+        self.log.flush()
+        with open(self.log.path) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    @patch('backend.app.TRACE_SAMPLE_RATE', 1.0)
+    @patch('backend.app.client')
+    def test_sampled_request_logs_span_waterfall(self, mock_client):
+        completion = MagicMock(usage=None)
+        completion.choices[0].message.content = "The owl learned to share the moonlight."
+        mock_client.chat.completions.create.return_value = completion
+        mock_client.audio.speech.create.return_value = MagicMock(content=b"mp3")
+
+        payload = {'imageDescription': 'An owl', 'keywords': 'sharing', 'generateAudio': True,
+                   'audioDelivery': 'inline', 'vocabularyMode': 'local'}
+        response = self.app.post('/generate-story', data=json.dumps(payload), content_type='application/json',
+                                 headers={'X-Request-ID': 'owl-42'})
+        self.assertEqual(response.headers['X-Request-ID'], 'owl-42')
+
+        record, = self.records()
+        self.assertEqual((record['traceId'], record['reason'], record['status']), ('owl-42', 'sampled', 200))
+        spans = {span['name']: span for span in record['spans']}
+        self.assertLessEqual({'story', 'vocabulary', 'tts', 'base64'}, set(spans))
+        self.assertLessEqual(spans['story']['startMs'] + spans['story']['durationMs'], spans['tts']['startMs'])
+        self.assertNotEqual(spans['tts']['thread'], spans['story']['thread'])
+
+    @patch('backend.app.TRACE_SAMPLE_RATE', 1.0)
+    @patch('backend.app.extract_vocabulary_words', return_value=[])
+    @patch('backend.app.client')
+    def test_streamed_request_is_traced_until_closed(self, mock_client, mock_vocab):
+        def chunks():
+            time.sleep(0.05)
+            for text in ("Once ", "upon a time."):
+                chunk = MagicMock()
+                chunk.choices[0].delta.content = text
+                yield chunk
+
+        mock_client.chat.completions.create.return_value = chunks()
+        payload = {'imageDescription': 'A moth', 'keywords': 'light', 'vocabularyMode': 'gpt'}
+        response = self.app.post('/generate-story/stream', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(self.log.stats()['pending'], 0)
+        response.get_data()
+        response.close()
+
+        record, = self.records()
+        self.assertGreaterEqual(record['durationMs'], 50)
+        self.assertIn('story', {span['name'] for span in record['spans']})
+
+    @patch('backend.app.TRACE_SAMPLE_RATE', 0.0)
+    def test_only_slow_or_sampled_requests_are_logged(self):
+        response = self.app.get('/voices', headers={'X-Request-ID': 'bad id with spaces'})
+        self.assertEqual(len(response.headers['X-Request-ID']), 32)
+        with patch('backend.app.TRACE_SLOW_MS', 0):
+            self.app.get('/voices')
+        record, = self.records()
+        self.assertEqual((record['endpoint'], record['reason']), ('/voices', 'slow'))
+
+    def test_log_drops_instead_of_growing(self):
+        log = TraceLog(os.path.join(self.tmp.name, "small.jsonl"), flush_seconds=60, max_pending=1)
+        self.assertTrue(log.submit({"reason": "slow"}))
+        self.assertFalse(log.submit({"reason": "slow"}))
+        log.flush()
+        self.assertEqual((log.stats()['written'], log.stats()['dropped']), (1, 1))
+
+
 if __name__ == '__main__':
     # Run all tests
     unittest.main(verbosity=2)
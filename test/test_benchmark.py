@@ -0,0 +1,106 @@
+import unittest
+import io
+import json
+import os
+import random
+import sys
+import urllib.request
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.fake_openai import FakeOpenAIConfig, FakeOpenAIServer, LatencyModel
+from benchmark.run_benchmark import percentile, response_ok, summarize, synthetic_sketch_uploads
+
+
+class TestFakeOpenAI(unittest.TestCase):
+    """Test the local OpenAI stand-in used by the benchmark"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = FakeOpenAIConfig(
+            chat_latency=LatencyModel(0), first_token_latency=LatencyModel(0),
+            tokens_per_second=0, speech_latency=LatencyModel(0),
+            story_words=12, audio_bytes=5000, audio_chunk_bytes=1024
+        )
+        cls.server = FakeOpenAIServer(config=config).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def post(self, path, payload):
+        request = urllib.request.Request(f"{self.server.base_url}{path}", data=json.dumps(payload).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        return urllib.request.urlopen(request, timeout=5)
+
+    def test_chat_completion_story_and_vocabulary(self):
+        """Test story prompts get prose and vocabulary prompts get a JSON array"""
+        with self.post("/chat/completions", {"messages": [{"role": "user", "content": "Write a story"}]}) as response:
+            story = json.loads(response.read())
+        self.assertEqual(len(story["choices"][0]["message"]["content"].split()), 12)
+        self.assertGreater(story["usage"]["completion_tokens"], 0)
+
+        vocab_prompt = {"messages": [{"role": "user", "content": "Format your response as a JSON array"}]}
+        with self.post("/chat/completions", vocab_prompt) as response:
+            content = json.loads(response.read())["choices"][0]["message"]["content"]
+        self.assertIn("word", json.loads(content)[0])
+
+    def test_streamed_chat_completion(self):
+        """Test streaming sends content deltas, a usage chunk and [DONE]"""
+        payload = {"stream": True, "stream_options": {"include_usage": True},
+                   "messages": [{"role": "user", "content": "Write a story"}]}
+        with self.post("/chat/completions", payload) as response:
+            events = [line[len(b"data: "):] for line in response.read().split(b"\n") if line.startswith(b"data: ")]
+
+        self.assertEqual(events[-1], b"[DONE]")
+        chunks = [json.loads(event) for event in events[:-1]]
+        text = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks if chunk["choices"])
+        self.assertEqual(len(text.split()), 12)
+        self.assertIn("usage", chunks[-1])
+
+    def test_speech_payload_size(self):
+        """Test speech returns audio of the configured size"""
+        with self.post("/audio/speech", {"input": "hello", "voice": "nova"}) as response:
+            self.assertEqual(response.headers["Content-Type"], "audio/mpeg")
+            self.assertEqual(len(response.read()), 5000)
+
+
+class TestBenchmarkHelpers(unittest.TestCase):
+    """Test synthetic sketches and report maths"""
+
+    def test_synthetic_sketches_are_valid_images(self):
+        uploads = synthetic_sketch_uploads(2, seed=1)
+        self.assertEqual([content_type for _, content_type, _ in uploads], ["image/jpeg", "image/png"])
+        for _, _, data in uploads:
+            Image.open(io.BytesIO(data)).verify()
+        self.assertEqual(uploads, synthetic_sketch_uploads(2, seed=1))
+
+    def test_latency_model_median(self):
+        rng = random.Random(3)
+        samples = [LatencyModel(200, 0.5).sample(rng) for _ in range(2000)]
+        self.assertAlmostEqual(percentile(samples, 50), 0.2, delta=0.02)
+
+    def test_summarize(self):
+        row = summarize("generate-story", 4, [0.1] * 98 + [1.0, 2.0], errors=1, elapsed=10)
+        self.assertEqual(row["requests"], 101)
+        self.assertEqual(row["requestsPerSecond"], 10.0)
+        self.assertEqual(row["p50Ms"], 100.0)
+        self.assertEqual(row["p99Ms"], 1000.0)
+
+    def test_fallbacks_are_not_successes(self):
+        story = json.dumps({"success": True, "story": "The fox crossed the river.", "audioGenerated": False}).encode()
+        apology = json.dumps({"success": True, "story": "I'd love to tell you a story about a fox, but..."}).encode()
+        self.assertTrue(response_ok("generate-story", story))
+        self.assertFalse(response_ok("generate-story", apology))
+        self.assertFalse(response_ok("generate-story-audio", story))
+        self.assertFalse(response_ok("process-image", b'{"error": "Model is still loading"}'))
+
+        done = b'event: token\ndata: {"text": "The fox"}\n\nevent: done\ndata: ' + story + b'\n\n'
+        self.assertTrue(response_ok("generate-story-stream", done))
+        self.assertFalse(response_ok("generate-story-stream", b'event: token\ndata: {"text": "The fox"}\n\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()